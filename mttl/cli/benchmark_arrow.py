@@ -0,0 +1,85 @@
+import os
+import sys
+import tempfile
+import time
+
+import click
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+
+def _add_expert(library, name, n_layers, d_model, rank):
+    from mttl.models.library.expert import Expert, ExpertInfo
+    from mttl.models.modifiers.lora import LoRAConfig
+
+    config = LoRAConfig(modify_layers="q_proj|k_proj|v_proj|o_proj", lora_rank=rank)
+    weights = {}
+    for layer in range(n_layers):
+        for proj in ["q_proj", "k_proj", "v_proj", "o_proj"]:
+            prefix = f"model.layers.{layer}.self_attn.{proj}"
+            weights[f"{prefix}.lora_a"] = torch.randn(d_model, rank)
+            weights[f"{prefix}.lora_b"] = torch.randn(rank, d_model)
+    library.add_expert(
+        Expert(
+            expert_info=ExpertInfo(name, expert_config=config),
+            expert_weights=weights,
+        )
+    )
+
+
+def per_layer_prototypes(transform, expert):
+    """Previous computation: one low rank SVD per layer, checked against the dense W.T @ W."""
+    prototypes = {}
+    for parent in transform._get_unique_parent_names(expert.expert_weights):
+        A = expert.expert_weights[f"{parent}.lora_a"].float()
+        B = expert.expert_weights[f"{parent}.lora_b"].float()
+        W = (A @ B).T
+        U_W, Sigma_W, _ = transform._low_rank_svd(A, B)
+        WTW = W.T @ W
+        assert (WTW @ U_W[:, 0]).pow(2).sum() > (WTW @ U_W[:, -1]).pow(2).sum()
+        prototypes[parent] = U_W[:, 0]
+    return prototypes
+
+
+@click.command()
+@click.option("--n_experts", default=16)
+@click.option("--n_layers", default=24)
+@click.option("--d_model", default=2048)
+@click.option("--rank", default=4)
+def main(n_experts, n_layers, d_model, rank):
+    """Time of computing the Arrow prototypes of a library of random experts, layer by
+    layer and batched, and of updating them after adding an expert."""
+    from mttl.models.library.expert_library import LocalExpertLibrary
+    from mttl.models.library.library_transforms import ArrowConfig, ArrowTransform
+
+    torch.manual_seed(0)
+    with tempfile.TemporaryDirectory() as path:
+        library = LocalExpertLibrary(path, create=True)
+        for i in range(n_experts):
+            _add_expert(library, f"expert_{i}", n_layers, d_model, rank)
+        transform = ArrowTransform(ArrowConfig())
+
+        with torch.no_grad():
+            start = time.perf_counter()
+            for _, expert in library.items():
+                per_layer_prototypes(transform, expert)
+            per_layer = time.perf_counter() - start
+
+        start = time.perf_counter()
+        transform.transform(library, persist=True)
+        batched = time.perf_counter() - start
+
+        _add_expert(library, f"expert_{n_experts}", n_layers, d_model, rank)
+        start = time.perf_counter()
+        transform.transform(library, persist=True)
+        incremental = time.perf_counter() - start
+
+    print(f"{n_experts} experts, {4 * n_layers} layers of {d_model}x{d_model}")
+    print(f"per layer: {per_layer:.2f}s")
+    print(f"batched: {batched:.2f}s ({per_layer / batched:.1f}x)")
+    print(f"one more expert: {incremental:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import click
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+
+def _add_experts(model_name, n_experts, modify_layers, bulk, queue):
+    """Runs in a fresh process, so that the peak RSS only accounts for this run."""
+    import torch
+
+    from mttl.models.expert_model import MultiExpertModel, MultiExpertModelConfig
+    from mttl.models.library.expert import Expert, ExpertInfo
+    from mttl.models.modifiers.lora import LoRAConfig
+
+    torch.set_grad_enabled(False)
+    model = MultiExpertModel(MultiExpertModelConfig(model_name))
+    config = LoRAConfig(modify_layers=modify_layers)
+    experts = [
+        Expert(expert_info=ExpertInfo(f"expert_{i}", expert_config=config))
+        for i in range(n_experts)
+    ]
+
+    start = time.perf_counter()
+    if bulk:
+        model.add_expert_instances(experts)
+    else:
+        for expert in experts:
+            model.add_expert_instance(expert)
+    model.experts_containers
+    elapsed = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on linux
+    queue.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+@click.command()
+@click.option("--model", default="EleutherAI/gpt-neo-125m")
+@click.option("--n_experts", default="10,50,100,200")
+@click.option("--modify_layers", default="k_proj|v_proj|q_proj|out_proj")
+@click.option("--one_by_one/--no-one_by_one", default=True)
+def main(model, n_experts, modify_layers, one_by_one):
+    """Reports the time and peak RSS of adding experts to a model, with
+    `add_expert_instances` and, for comparison, one `add_expert_instance` at a time."""
+    context = multiprocessing.get_context("spawn")
+    modes = [("bulk", True)] + ([("one_by_one", False)] if one_by_one else [])
+
+    print(f"{'n_experts':>10} {'mode':>12} {'time (s)':>10} {'peak rss (MB)':>14}")
+    for n in map(int, n_experts.split(",")):
+        for mode, bulk in modes:
+            queue = context.Queue()
+            process = context.Process(
+                target=_add_experts, args=(model, n, modify_layers, bulk, queue)
+            )
+            process.start()
+            elapsed, peak_rss = queue.get()
+            process.join()
+            print(f"{n:>10} {mode:>12} {elapsed:>10.2f} {peak_rss:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
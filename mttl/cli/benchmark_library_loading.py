@@ -0,0 +1,81 @@
+import os
+import sys
+import tempfile
+import time
+
+import click
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from mttl.models.expert_model import (
+    ExpertModel,
+    ExpertModelConfig,
+    MultiExpertModel,
+    MultiExpertModelConfig,
+)
+from mttl.models.library.expert_cache import expert_cache
+from mttl.models.library.expert_library import ExpertLibrary
+from mttl.models.modifiers.lora import LoRAConfig
+
+
+def create_library(repo_id, model_name, n_experts, modify_layers, lora_rank):
+    source = ExpertModel(
+        ExpertModelConfig(
+            model_name,
+            modifier_config=LoRAConfig(
+                modify_layers=modify_layers, lora_rank=lora_rank
+            ),
+        )
+    )
+    expert = source.as_expert()
+    library = ExpertLibrary.get_expert_library(repo_id, create=True)
+    with library.batched_commit():
+        for i in range(n_experts):
+            expert.expert_weights = {
+                name: torch.randn_like(weight)
+                for name, weight in expert.expert_weights.items()
+            }
+            library.add_expert(expert, f"expert_{i}")
+    return library
+
+
+@click.command()
+@click.option("--model", default="EleutherAI/gpt-neo-125m")
+@click.option("--n_experts", default=100)
+@click.option("--modify_layers", default="k_proj|v_proj|q_proj|out_proj")
+@click.option("--lora_rank", default=16)
+@click.option("--library_id", default=None, help="Existing library to load.")
+@click.option("--max_concurrency", default=16)
+def main(model, n_experts, modify_layers, lora_rank, library_id, max_concurrency):
+    """Measures the wall-clock time of loading all the experts of a library into a model,
+    one expert at a time and with the pipelined `add_experts_from_library`."""
+    # the decoded experts must not be reused across runs
+    expert_cache.configure(max_bytes=0)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if library_id is None:
+            library = create_library(
+                f"local://{tmp_dir}", model, n_experts, modify_layers, lora_rank
+            )
+        else:
+            library = ExpertLibrary.get_expert_library(library_id)
+
+        multi_model = MultiExpertModel(MultiExpertModelConfig(model))
+        start = time.perf_counter()
+        for expert_name in library.keys():
+            multi_model.add_expert_instance(library[expert_name])
+        serial = time.perf_counter() - start
+
+        multi_model = MultiExpertModel(MultiExpertModelConfig(model))
+        start = time.perf_counter()
+        multi_model.add_experts_from_library(library, max_concurrency=max_concurrency)
+        pipelined = time.perf_counter() - start
+
+    print(f"{len(library)} experts")
+    print(f"one by one: {serial:.2f}s")
+    print(f"add_experts_from_library: {pipelined:.2f}s ({serial / pipelined:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import os
+import sys
+
+import click
+import torch
+from torch.utils import benchmark
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from mttl.models.modifiers.grouped_lora import (
+    grouped_lora_forward,
+    grouped_lora_forward_reference,
+)
+
+
+def stacked_lora_forward(input, lora_a, lora_b, example_indices, scaling):
+    """Previous implementation, copies the weights of the expert of every example."""
+    A = torch.stack([lora_a[i] for i in example_indices.tolist()], dim=0)
+    B = torch.stack([lora_b[i] for i in example_indices.tolist()], dim=0)
+    scaling = torch.tensor(
+        [scaling[i] for i in example_indices.tolist()], device=input.device
+    )
+    return torch.bmm(torch.bmm(input, A), B) * scaling[:, None, None]
+
+
+@click.command()
+@click.option("--batch_size", default=32)
+@click.option("--seq_len", default=256)
+@click.option("--d_model", default=2048)
+@click.option("--rank", default=16)
+@click.option("--n_experts", default="1,2,4,8,16,32", help="Unique experts per batch.")
+@click.option("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+@click.option("--dtype", default="float32")
+def main(batch_size, seq_len, d_model, rank, n_experts, device, dtype):
+    """Compares the grouped lora routing to stacking the weights of every example,
+    for an increasing number of unique experts in the batch."""
+    dtype = getattr(torch, dtype)
+    results = []
+
+    for n_unique in map(int, n_experts.split(",")):
+        lora_a = [
+            torch.randn(d_model, rank, device=device, dtype=dtype)
+            for _ in range(n_unique)
+        ]
+        lora_b = [
+            torch.randn(rank, d_model, device=device, dtype=dtype)
+            for _ in range(n_unique)
+        ]
+        scaling = [1.0 / rank] * n_unique
+        input = torch.randn(batch_size, seq_len, d_model, device=device, dtype=dtype)
+        example_indices = torch.arange(batch_size, device=device) % n_unique
+        token_indices = example_indices.repeat_interleave(seq_len)
+
+        # check the grouped kernel against the reference on a few tokens
+        n_check = min(64, batch_size * seq_len)
+        check = grouped_lora_forward(
+            input.view(-1, d_model)[:n_check],
+            lora_a,
+            lora_b,
+            token_indices[:n_check],
+            scaling,
+        )
+        reference = grouped_lora_forward_reference(
+            input.view(-1, d_model)[:n_check],
+            lora_a,
+            lora_b,
+            token_indices[:n_check],
+            scaling,
+        )
+        assert torch.allclose(check.cpu().float(), reference.float(), atol=1e-2)
+
+        label = f"bs={batch_size} seq={seq_len} d={d_model} r={rank}"
+        for name, stmt in [
+            (
+                "stacked",
+                "stacked_lora_forward(input, lora_a, lora_b, example_indices, scaling)",
+            ),
+            (
+                "grouped",
+                "grouped_lora_forward(input.view(-1, input.size(-1)), lora_a, lora_b, token_indices, scaling)",
+            ),
+        ]:
+            results.append(
+                benchmark.Timer(
+                    stmt=stmt,
+                    globals={
+                        "stacked_lora_forward": stacked_lora_forward,
+                        "grouped_lora_forward": grouped_lora_forward,
+                        "input": input,
+                        "lora_a": lora_a,
+                        "lora_b": lora_b,
+                        "example_indices": example_indices,
+                        "token_indices": token_indices,
+                        "scaling": scaling,
+                    },
+                    label=label,
+                    sub_label=f"{n_unique} experts",
+                    description=name,
+                ).blocked_autorange(min_run_time=0.5)
+            )
+
+    benchmark.Compare(results).print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import os
+import sys
+import time
+
+import click
+import torch
+from torch.utils import benchmark
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from mttl.models.modifiers.routing import RoutingInfo
+from mttl.models.packed_attention_monkey_patch import (
+    packed_attention_mask,
+    packed_scaled_dot_product_attention,
+)
+
+
+def loop_packed_attention_mask(seq_lens, seq_len):
+    """Dense mask as the collator used to build it, with python loops."""
+    mask = torch.zeros(len(seq_lens), 1, seq_len, seq_len, dtype=torch.bool)
+    for i, row_lens in enumerate(seq_lens):
+        start = 0
+        for length in row_lens:
+            mask[i, :, start : start + length, start : start + length] = True
+            start += length
+        mask[i, :, start:, :start] = True
+    return mask.tril()
+
+
+def random_seq_lens(batch_size, pack_length, max_seq_per_pack, generator):
+    """Lengths of `max_seq_per_pack` sequences filling most of each pack."""
+    seq_lens = torch.zeros(batch_size, max_seq_per_pack, dtype=torch.long)
+    for i in range(batch_size):
+        cuts = torch.randperm(pack_length - 1, generator=generator)[
+            : max_seq_per_pack - 1
+        ]
+        bounds = torch.cat([torch.tensor([0]), cuts.sort().values + 1])
+        # leave some padding at the end of the pack
+        bounds = torch.cat([bounds, torch.tensor([pack_length - pack_length // 16])])
+        seq_lens[i] = bounds.diff().clamp(min=0)
+    return seq_lens
+
+
+def timeit(fn, n_runs):
+    start = time.perf_counter()
+    for _ in range(n_runs):
+        fn()
+    return (time.perf_counter() - start) / n_runs
+
+
+@click.command()
+@click.option("--batch_size", default=4)
+@click.option("--pack_length", default="512,1024,2048,4096")
+@click.option("--max_seq_per_pack", default="2,4,8")
+@click.option("--n_heads", default=12)
+@click.option("--head_dim", default=64)
+@click.option("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+def main(batch_size, pack_length, max_seq_per_pack, n_heads, head_dim, device):
+    """Compares packed attention with the dense (bs, 1, L, L) mask built by the collator and
+    with the block-diagonal `packed_scaled_dot_product_attention`: collate latency, memory of
+    the mask, and attention throughput."""
+    generator = torch.Generator().manual_seed(0)
+    sdpa = getattr(
+        torch.nn.functional,
+        "_default_scaled_dot_product_attention",
+        torch.nn.functional.scaled_dot_product_attention,
+    )
+
+    print(
+        f"{'L':>6} {'seqs':>5} {'collate dense (ms)':>19} {'collate blocks (ms)':>20} "
+        f"{'mask (MB)':>10}"
+    )
+    results = []
+    for length in map(int, pack_length.split(",")):
+        for n_seqs in map(int, max_seq_per_pack.split(",")):
+            seq_lens = random_seq_lens(batch_size, length, n_seqs, generator)
+
+            collate_dense = timeit(
+                lambda: loop_packed_attention_mask(seq_lens.tolist(), length), 3
+            )
+            collate_blocks = timeit(
+                lambda: RoutingInfo(seq_lens=seq_lens).packed_segments(), 3
+            )
+            mask = packed_attention_mask(seq_lens, length).to(device)
+            print(
+                f"{length:>6} {n_seqs:>5} {collate_dense * 1000:>19.2f} "
+                f"{collate_blocks * 1000:>20.3f} {mask.numel() / 2**20:>10.1f}"
+            )
+
+            query, key, value = (
+                torch.randn(batch_size, n_heads, length, head_dim, device=device)
+                for _ in range(3)
+            )
+            segments = RoutingInfo(seq_lens=seq_lens).packed_segments()
+            for description, stmt in [
+                ("dense mask", "sdpa(query, key, value, attn_mask=mask)"),
+                ("blocks", "packed_sdpa(query, key, value, segments)"),
+            ]:
+                results.append(
+                    benchmark.Timer(
+                        stmt=stmt,
+                        globals={
+                            "sdpa": sdpa,
+                            "packed_sdpa": packed_scaled_dot_product_attention,
+                            "query": query,
+                            "key": key,
+                            "value": value,
+                            "mask": mask,
+                            "segments": segments,
+                        },
+                        label="packed attention",
+                        sub_label=f"L={length} seqs={n_seqs}",
+                        description=description,
+                    ).blocked_autorange(min_run_time=0.5)
+                )
+
+    benchmark.Compare(results).print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+import os
+import sys
+import time
+
+import click
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from mttl.datamodule.packing import PackingStrategy, packing_efficiency
+
+
+@click.command()
+@click.option("--n_sequences", default=100_000)
+@click.option("--max_length", default="1024,2048")
+@click.option("--max_seq_per_pack", default="4,8")
+@click.option("--mean_log_length", default=5.0, help="Lengths are log-normal.")
+@click.option("--seed", default=42)
+def main(n_sequences, max_length, max_seq_per_pack, mean_log_length, seed):
+    """Packing efficiency and packing time of every packing strategy, on sequences with
+    skewed (log-normal) lengths."""
+    rng = np.random.default_rng(seed)
+    lengths = (rng.lognormal(mean_log_length, 1.0, size=n_sequences) + 1).astype(int)
+    lengths = lengths.tolist()
+
+    print(
+        f"{'L':>6} {'seqs':>5} {'strategy':>22} {'packs':>8} {'seqs/pack':>10} "
+        f"{'padding':>8} {'time (s)':>9}"
+    )
+    for length in map(int, max_length.split(",")):
+        for max_sequences in map(int, max_seq_per_pack.split(",")):
+            for name in PackingStrategy.registered_names():
+                strategy = PackingStrategy.from_name(
+                    name, max_length=length, max_sequences=max_sequences, seed=seed
+                )
+                start = time.perf_counter()
+                packs = strategy.pack(lengths)
+                elapsed = time.perf_counter() - start
+
+                stats = packing_efficiency(packs, lengths, length)
+                print(
+                    f"{length:>6} {max_sequences:>5} {name:>22} {stats['packs']:>8} "
+                    f"{stats['sequences_per_pack']:>10.2f} "
+                    f"{stats['padding_fraction']:>8.1%} {elapsed:>9.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
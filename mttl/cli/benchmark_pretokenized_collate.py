@@ -0,0 +1,102 @@
+import os
+import sys
+import tempfile
+import time
+
+import click
+import numpy as np
+from datasets import Dataset
+from torch.utils.data import DataLoader
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from mttl.datamodule.base import DataModule, DatasetConfig
+
+
+def make_datamodule(config, n_examples, seed):
+    rng = np.random.RandomState(seed)
+    words = open(__file__).read().split()
+    examples = {
+        "source": [
+            " ".join(rng.choice(words, rng.randint(50, 400))) for _ in range(n_examples)
+        ],
+        "target": [
+            " ".join(rng.choice(words, rng.randint(1, 50))) for _ in range(n_examples)
+        ],
+        "task_name": [f"task_{i % 10}" for i in range(n_examples)],
+    }
+
+    class _DataModule(DataModule):
+        def setup_dataset(self):
+            self.train_dataset = Dataset.from_dict(examples)
+            self.dev_dataset = self.test_dataset = None
+            self._task_names = sorted(set(examples["task_name"]))
+            self._task_to_id = {t: i for i, t in enumerate(self._task_names)}
+
+    return _DataModule(config)
+
+
+def throughput(dataset, collate_fn, batch_size, num_workers, max_batches=200):
+    loader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=True,
+        num_workers=num_workers,
+        collate_fn=collate_fn,
+    )
+    start, n_examples = time.perf_counter(), 0
+    for i, batch in enumerate(loader):
+        n_examples += batch["input_ids"].size(0)
+        if i + 1 == max_batches:
+            break
+    return n_examples / (time.perf_counter() - start)
+
+
+@click.command()
+@click.option("--model", default="EleutherAI/gpt-neo-125m")
+@click.option("--n_examples", default=5_000)
+@click.option("--batch_size", default=16)
+@click.option("--max_input_length", default=1024)
+@click.option("--num_workers", default="0,2,4")
+def main(model, n_examples, batch_size, max_input_length, num_workers):
+    """Collate time per example and dataloader throughput, collating raw texts and
+    pre-tokenized examples."""
+    with tempfile.TemporaryDirectory() as cache_dir:
+        config = DatasetConfig(
+            model=model,
+            max_input_length=max_input_length,
+            tokenized_cache_dir=cache_dir,
+            num_proc=4,
+        )
+        raw = make_datamodule(config, n_examples, seed=0)
+        start = time.perf_counter()
+        pretokenized = raw.pretokenize_dataset(raw.train_dataset)
+        print(f"pre-tokenization: {time.perf_counter() - start:.1f}s (once)")
+
+        for name, dataset in [
+            ("raw", raw.train_dataset),
+            ("pretokenized", pretokenized),
+        ]:
+            collate_fn = raw.collate_fn
+            batches = [
+                [dataset[j] for j in range(i, i + batch_size)]
+                for i in range(0, min(len(dataset), 100 * batch_size), batch_size)
+            ]
+            start = time.perf_counter()
+            for batch in batches:
+                collate_fn(batch)
+            elapsed = time.perf_counter() - start
+            print(
+                f"{name:>12} collate: "
+                f"{elapsed / (len(batches) * batch_size) * 1e6:.1f} us/example"
+            )
+
+            for workers in map(int, num_workers.split(",")):
+                print(
+                    f"{name:>12} dataloader, {workers} workers: "
+                    f"{throughput(dataset, collate_fn, batch_size, workers):.0f} examples/s"
+                )
+
+
+if __name__ == "__main__":
+    main()
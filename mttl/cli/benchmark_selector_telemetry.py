@@ -0,0 +1,85 @@
+import os
+import sys
+
+import click
+import torch
+from torch.utils import benchmark
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from mttl.models.containers.selectors.arrow_selector import ArrowSelectorConfig
+from mttl.models.containers.selectors.base import get_selector
+from mttl.models.expert_context import InfoContainer
+from mttl.models.modifiers.routing import RoutingInfo
+from mttl.models.utils import MetricLogger
+
+
+def forward(selectors, input, read_every_step):
+    for selector in selectors:
+        selector(input)
+        if read_every_step:
+            # previous behavior, every statistic was copied to the host during the forward
+            for meter in selector.metric_logger.meters.values():
+                meter.value
+
+
+@click.command()
+@click.option("--n_layers", default=24)
+@click.option("--n_experts", default=32)
+@click.option("--d_model", default=2048)
+@click.option("--batch_size", default=8)
+@click.option("--seq_len", default="1,128", help="1 for generation steps.")
+@click.option("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+def main(n_layers, n_experts, d_model, batch_size, seq_len, device):
+    """Cost per forward of the per-token selectors with the routing telemetry disabled,
+    sampled, enabled, and enabled with the statistics read at every step."""
+    selectors = []
+    for i in range(n_layers):
+        selector = get_selector(
+            ArrowSelectorConfig(), layer=torch.nn.Linear(d_model, d_model).to(device)
+        )
+        selector.__layer_name__ = f"layer_{i}"
+        selector.total_calls_per_forward = 1
+        for j in range(n_experts):
+            selector.add_expert(f"expert_{j}")
+        selector.overwrite_prototypes(torch.randn(n_experts, d_model))
+        selectors.append(selector)
+
+    results = []
+    for sq in map(int, seq_len.split(",")):
+        input = torch.randn(batch_size, sq, d_model, device=device)
+        routing_infos = RoutingInfo(
+            attention_mask=torch.ones(batch_size, sq, device=device),
+            task_names=["expert_0"] * batch_size,
+        )
+
+        for name, metric_logger, read_every_step in [
+            ("disabled", MetricLogger(enabled=False), False),
+            ("sampled 1/10", MetricLogger(sample_rate=0.1), False),
+            ("enabled", MetricLogger(), False),
+            ("enabled, read every step", MetricLogger(), True),
+        ]:
+            for selector in selectors:
+                selector.metric_logger = metric_logger
+
+            with InfoContainer(None, routing_infos), torch.no_grad():
+                results.append(
+                    benchmark.Timer(
+                        stmt="forward(selectors, input, read_every_step)",
+                        globals={
+                            "forward": forward,
+                            "selectors": selectors,
+                            "input": input,
+                            "read_every_step": read_every_step,
+                        },
+                        label=f"{n_layers} selectors, {n_experts} experts, d={d_model}",
+                        sub_label=f"bs={batch_size} seq={sq}",
+                        description=name,
+                    ).blocked_autorange(min_run_time=0.5)
+                )
+
+    benchmark.Compare(results).print()
+
+
+if __name__ == "__main__":
+    main()
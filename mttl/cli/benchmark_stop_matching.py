@@ -0,0 +1,67 @@
+import os
+import sys
+import time
+
+import click
+import torch
+from transformers import AutoTokenizer
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from mttl.evaluators.base import StoppingCriteriaSub
+
+
+def decode_every_step(stop_tokens, tokenizer, input_ids, prompt_length):
+    """Previous criterion: the last generated tokens of every sequence are decoded and
+    searched at each step."""
+    max_length = max(len(stop) for stop in stop_tokens)
+    num_tokens = input_ids.shape[1] - prompt_length
+    decoded = tokenizer.batch_decode(input_ids[:, -min(max_length, num_tokens) :])
+    return [any(stop in text for stop in stop_tokens) for text in decoded]
+
+
+@click.command()
+@click.option("--model", default="EleutherAI/gpt-neo-125m")
+@click.option("--batch_size", default=32)
+@click.option("--n_steps", default=512)
+@click.option("--stop_tokens", default="\n\n,Question:,###")
+def main(model, batch_size, n_steps, stop_tokens):
+    """Time spent in the stopping criteria during the generation of random tokens, never
+    matching the stop sequences, with the previous and the incremental matching."""
+    tokenizer = AutoTokenizer.from_pretrained(model)
+    stop_tokens = stop_tokens.split(",") + [tokenizer.eos_token]
+
+    generator = torch.Generator().manual_seed(0)
+    # common tokens, without the characters ending the stop sequences
+    vocab = [
+        token_id
+        for token_id in range(min(len(tokenizer), 20000))
+        if not any(stop[-1] in tokenizer.decode([token_id]) for stop in stop_tokens)
+    ]
+    tokens = torch.tensor(vocab)[
+        torch.randint(len(vocab), (batch_size, n_steps + 16), generator=generator)
+    ]
+    prompt_length = 16
+
+    start = time.perf_counter()
+    for step in range(prompt_length + 1, prompt_length + n_steps + 1):
+        decode_every_step(stop_tokens, tokenizer, tokens[:, :step], prompt_length)
+    previous = time.perf_counter() - start
+
+    # built once per evaluator
+    criteria = StoppingCriteriaSub(stop_tokens, tokenizer=tokenizer)
+    start = time.perf_counter()
+    for step in range(prompt_length + 1, prompt_length + n_steps + 1):
+        criteria(tokens[:, :step], None)
+    incremental = time.perf_counter() - start
+
+    print(f"batch size {batch_size}, {n_steps} steps")
+    print(f"decode every step: {previous * 1000 / n_steps:.3f} ms/step")
+    print(
+        f"incremental: {incremental * 1000 / n_steps:.3f} ms/step "
+        f"({previous / incremental:.1f}x)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import click
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+
+def _create_library(path, n_experts, n_params, n_modules):
+    import torch
+
+    from mttl.models.library.expert import Expert, ExpertInfo
+    from mttl.models.library.expert_library import LocalExpertLibrary
+    from mttl.models.modifiers.lora import LoRAConfig
+
+    library = LocalExpertLibrary(path, create=True)
+    config = LoRAConfig(modify_layers="k_proj")
+    rows = n_params // n_modules // 2
+    for i in range(n_experts):
+        weights = {}
+        for j in range(n_modules):
+            weights[f"model.layers.{j}.k_proj.lora_a"] = torch.randn(rows, 1)
+            weights[f"model.layers.{j}.k_proj.lora_b"] = torch.randn(1, rows)
+        library.add_expert(
+            Expert(
+                expert_info=ExpertInfo(f"expert_{i}", expert_config=config),
+                expert_weights=weights,
+            )
+        )
+
+
+def _embed(path, streaming, block_size, queue):
+    """Runs in a fresh process, so that the peak RSS only accounts for this fit."""
+    from mttl.models.library.expert_cache import expert_cache
+    from mttl.models.library.expert_library import LocalExpertLibrary
+    from mttl.models.library.library_transforms import (
+        SVDEmbeddingTransform,
+        SVDEmbeddingTransformConfig,
+    )
+
+    # the experts must not be kept in memory between the blocks
+    expert_cache.configure(max_bytes=0)
+    library = LocalExpertLibrary(path)
+
+    start = time.perf_counter()
+    SVDEmbeddingTransform(
+        SVDEmbeddingTransformConfig(
+            n_components=16, streaming=streaming, block_size=block_size
+        )
+    ).transform(library, persist=False, recompute=True)
+    elapsed = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on linux
+    queue.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+@click.command()
+@click.option("--n_experts", default=50)
+@click.option("--n_params", default=4_000_000, help="Parameters per expert.")
+@click.option("--n_modules", default=24)
+@click.option("--block_size", default=16)
+def main(n_experts, n_params, n_modules, block_size):
+    """Time and peak RSS of the SVD embeddings of a library of random experts, with
+    sklearn on all the experts stacked in memory, and with the gram matrix of the experts
+    streamed in blocks."""
+    context = multiprocessing.get_context("spawn")
+
+    with tempfile.TemporaryDirectory() as path:
+        _create_library(path, n_experts, n_params, n_modules)
+
+        print(f"{n_experts} experts of {n_params} parameters")
+        print(f"{'mode':>10} {'time (s)':>10} {'peak rss (MB)':>14}")
+        for mode, streaming in [("in memory", False), ("streaming", True)]:
+            queue = context.Queue()
+            process = context.Process(
+                target=_embed, args=(path, streaming, block_size, queue)
+            )
+            process.start()
+            elapsed, peak_rss = queue.get()
+            process.join()
+            print(f"{mode:>10} {elapsed:>10.2f} {peak_rss:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+import os
+import sys
+
+import click
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from mttl.models.library.expert_library import SAFETENSORS_FORMAT, ExpertLibrary
+
+
+@click.command()
+@click.option("--library_id")  # e.g. local:///path/to/library
+@click.option("--remote_token", default=None)
+@click.option(
+    "--weights_format",
+    default=SAFETENSORS_FORMAT,
+    help="Target format of the expert weights, either 'safetensors' or 'ckpt'.",
+)
+def main(library_id, remote_token, weights_format=SAFETENSORS_FORMAT):
+    """Migrates the weights of all the experts in a library to another format, in place.
+
+    Metadata files are updated, and the weights in the previous format are deleted.
+    """
+    library = ExpertLibrary.get_expert_library(
+        repo_id=library_id,
+        token=remote_token if remote_token else None,
+    )
+    converted = library.convert_weights_format(weights_format)
+    click.echo(f"Converted {converted} experts of {library_id} to {weights_format}.")
+
+
+if __name__ == "__main__":
+    main()
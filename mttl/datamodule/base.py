@@ -16,6 +16,11 @@ from torch.utils.data.dataset import ConcatDataset
 from transformers import AutoTokenizer
 from transformers.tokenization_utils_base import PaddingStrategy
 
+from mttl.datamodule.packing import PackingStrategy, packing_efficiency
+from mttl.datamodule.tokenized_cache import (
+    load_or_write_tokenized_cache,
+    tokenized_cache_key,
+)
 from mttl.datamodule.utils import get_tokenizer
 from mttl.logging import logger
 from mttl.registrable import Registrable
@@ -97,6 +102,13 @@ class DatasetConfig:
     pack_sequences: bool = False  # True
     pad_to_multiple_of: int = 8
     max_seq_per_pack: int = 4
+    # see `mttl.datamodule.packing` for the available strategies
+    packing_strategy: str = "greedy"
+    # number of processes of the dataset preprocessing, e.g. tokenization and packing
+    num_proc: int = 20
+    # tokenize the datasets once and cache them on disk, see `mttl.datamodule.tokenized_cache`
+    pretokenize: bool = False
+    tokenized_cache_dir: str = None
 
 
 class PackedMixin:
@@ -159,26 +171,8 @@ class PackedMixin:
         packed_seq_lens = output_batch["seq_lens"].flatten().cumsum(0)
         output_batch["packed_seq_lens"] = F.pad(packed_seq_lens, (1, 0)).to(torch.int32)
 
-        # build the appropriate "block"-lower triangular mask for sdpa attention
-        bs, seq_len = output_batch["input_ids"].shape
-        packed_attn_mask = torch.zeros(bs, 1, seq_len, seq_len, dtype=torch.bool)
-        for i in range(bs):
-            start_idx = 0
-            for seq_len in output_batch["seq_lens"][i]:
-                packed_attn_mask[
-                    i,
-                    :,
-                    start_idx : start_idx + seq_len,
-                    start_idx : start_idx + seq_len,
-                ] = True
-                start_idx += seq_len
-
-            # For whatever reason, we need to let padding tokens attend the previous context ¯\_(ツ)_/¯
-            # Otherwise SDPA has nans
-            packed_attn_mask[i, :, start_idx:, :start_idx] = True
-
-        packed_attn_mask = packed_attn_mask.tril()
-        output_batch["packed_attn_mask"] = packed_attn_mask
+        # the attention is restricted to each packed sequence from `seq_lens`, see
+        # `packed_scaled_dot_product_attention`, no (seq_len, seq_len) mask is built
         return dict(output_batch)
 
 
@@ -407,8 +401,60 @@ class DefaultCollator(PackedMixin):
         output_batch["labels"] = targets
         return output_batch
 
+    def pretokenized_collate(self, batch):
+        """Pads examples tokenized ahead of time, see `TokenizedDataset`."""
+        output_batch = {}
+        pad_left = self.tokenizer.padding_side == "left"
+
+        input_lens = [len(b["input_ids"]) for b in batch]
+        width = max(input_lens)
+        if self.pad_to_multiple_of:
+            width = -(-width // self.pad_to_multiple_of) * self.pad_to_multiple_of
+        label_lens = [len(b["labels"]) for b in batch]
+        # inputs and labels are aligned for causal language models
+        label_width = width if self.model_family == "gpt" else max(label_lens)
+
+        for key, lengths, key_width, pad_value in [
+            ("input_ids", input_lens, width, self.tokenizer.pad_token_id),
+            ("labels", label_lens, label_width, self.label_pad_token_id),
+        ]:
+            values = np.full((len(batch), key_width), pad_value, dtype=np.int64)
+            for i, (b, length) in enumerate(zip(batch, lengths)):
+                if pad_left:
+                    values[i, key_width - length :] = b[key]
+                else:
+                    values[i, :length] = b[key]
+            output_batch[key] = torch.from_numpy(values)
+
+        positions = torch.arange(width).unsqueeze(0)
+        input_lens = torch.tensor(input_lens).unsqueeze(1)
+        if pad_left:
+            attention_mask = positions >= width - input_lens
+        else:
+            attention_mask = positions < input_lens
+        output_batch["attention_mask"] = attention_mask.long()
+
+        task_ids = [b["task_id"] for b in batch]
+        task_names = [b["task_name"] for b in batch]
+        task_sources = [b["task_source"] for b in batch]
+        has_task_names = all(tn is not None for tn in task_names)
+        if all(tid is not None for tid in task_ids):
+            output_batch["task_ids"] = torch.LongTensor(task_ids)
+        elif has_task_names and self.task_to_id:
+            output_batch["task_ids"] = torch.LongTensor(
+                [self.task_to_id[tn] for tn in task_names]
+            )
+        if has_task_names and not all(ts is not None for ts in task_sources):
+            task_sources = task_names
+
+        output_batch["task_names"] = task_names
+        output_batch["task_sources"] = task_sources
+        return output_batch
+
     def __call__(self, batch):
         if "input_ids" in batch[0]:
+            if "seq_lens" not in batch[0]:
+                return self.pretokenized_collate(batch)
             return self.packed_collate(batch)
 
         # Otherwise process as expected
@@ -738,89 +784,123 @@ class DataModule(LightningDataModule, Registrable):
         dataset = dataset.map(
             collate_fn_wrapper,
             batched=False,
-            num_proc=20,
+            num_proc=self.config.num_proc,
             remove_columns=dataset_columns,
         )
         return dataset
 
-    def pack_sequences(self, dataset, max_sequences=4, shuffle=True):
+    def pretokenize_dataset(self, dataset):
+        """Tokenizes `dataset` once, and caches the token ids on disk, keyed by the tokenizer,
+        the dataset and the options of the collator. Batches of the returned dataset are
+        only padded by the collator. Texts of the sources and labels are not kept.
+        """
+        if not isinstance(dataset, ArrowDataset):
+            logger.warning(
+                f"Cannot pre-tokenize a {type(dataset).__name__}, only huggingface datasets."
+            )
+            return dataset
+
+        key = tokenized_cache_key(
+            self.tokenizer,
+            dataset._fingerprint,
+            model_family=self.config.model_family,
+            max_input_length=self.config.max_input_length,
+            max_output_length=self.config.max_output_length,
+            truncation_side=self.tokenizer.truncation_side,
+            train_on_inputs=self.config.train_on_inputs,
+            add_eos_to_targets=self.config.add_eos_to_targets,
+        )
+
+        def examples():
+            tokenized = self.tokenize_dataset(dataset)
+            for batch in tokenized.iter(batch_size=1_000):
+                for i in range(len(batch["input_ids"])):
+                    yield {k: v[i] for k, v in batch.items()}
+
+        return load_or_write_tokenized_cache(
+            key, examples, self.config.tokenized_cache_dir
+        )
+
+    def pack_sequences(
+        self, dataset, max_sequences=4, shuffle=True, strategy=None, seed=42
+    ):
         """
-        Combine sequences together in larger chunks closer to `max_input_length`
+        Combine sequences together in larger chunks closer to `max_input_length`.
+
+        Sequences are assigned to packs by `strategy`, `config.packing_strategy` by default,
+        see `mttl.datamodule.packing`. The statistics of the packing are stored in
+        `self.packing_stats`.
         """
         # first, let's shuffle the dataset
         if shuffle:
-            dataset = dataset.shuffle(seed=42)
+            dataset = dataset.shuffle(seed=seed)
 
-        # Very basic code that will iterate over sequences one by one,
-        # and merge together until the max_input_length is reached
-        # This is not optimal, but it's a start
         max_length = self.config.max_input_length
+        num_proc = self.config.num_proc
+        strategy = PackingStrategy.from_name(
+            strategy or self.config.packing_strategy,
+            max_length=max_length,
+            max_sequences=max_sequences,
+            seed=seed,
+        )
 
-        def group(examples):
-            def new_container():
-                # for when starting a new packed batch
-                return {k: [] for k in list(examples.keys()) + ["seq_lens"]}
-
-            grouped_samples = new_container()
-
-            def append_to_running_seq(container, example):
-                for k, v in example.items():
-                    if isinstance(v, int) or isinstance(v, str):
-                        container[k] += [v]
-                    elif isinstance(v, list):
-                        container[k] += v
-                    else:
-                        raise ValueError(f"Unknown type {type(v)}")
-
-                container["seq_lens"] += [len(example["input_ids"])]
-
-            def add_finished_sequence(container, example):
-                for k, v in example.items():
-                    container[k].append(v)
-
-            def trim_ex(ex):
-                for key in ex.keys():
-                    value = ex[key]
-                    if isinstance(value, list):
-                        ex[key] = value[:max_length]
-
-            def dict_get_item(ex, i):
-                return {k: v[i] for k, v in ex.items()}
-
-            num_examples = len(examples["input_ids"])
-            packed = new_container()
-            current_lens = []
-            for i in range(num_examples):
-                ex = dict_get_item(examples, i)
-                ex_len = len(ex["input_ids"])
-                # can pack
-                if (
-                    sum(current_lens) + ex_len <= max_length
-                    and len(current_lens) < max_sequences
-                ):
-                    append_to_running_seq(packed, ex)
-                    current_lens += [ex_len]
-                else:
-                    if len(current_lens) > 0:
-                        add_finished_sequence(grouped_samples, packed)
-
-                    packed = new_container()
-                    current_lens = []
-                    trim_ex(ex)
-                    append_to_running_seq(packed, ex)
-                    current_lens += [ex_len]
-
-            if len(current_lens) > 0:
-                add_finished_sequence(grouped_samples, packed)
+        lengths = dataset.map(
+            lambda examples: {"length": [len(x) for x in examples["input_ids"]]},
+            batched=True,
+            num_proc=num_proc,
+            remove_columns=dataset.column_names,
+        )["length"]
+        packs = strategy.pack(lengths)
+        if shuffle:
+            # strategies sorting the sequences by length also sort the packs
+            packs = [
+                packs[i] for i in np.random.default_rng(seed).permutation(len(packs))
+            ]
+
+        self.packing_stats = packing_efficiency(packs, lengths, max_length)
+        logger.info(
+            "Packed {sequences} sequences into {packs} packs with {strategy}, "
+            "{sequences_per_pack:.2f} sequences per pack, "
+            "{padding_fraction:.2%} of padding".format(
+                strategy=type(strategy).__name__, **self.packing_stats
+            )
+        )
 
+        columns = dataset.column_names
+
+        def group(batch):
+            grouped_samples = {k: [] for k in columns + ["seq_lens"]}
+            # fetch the examples of all the packs of the batch at once
+            examples = dataset[[i for pack in batch["indices"] for i in pack]]
+
+            start = 0
+            for pack in batch["indices"]:
+                packed = {k: [] for k in grouped_samples}
+                for k in columns:
+                    for v in examples[k][start : start + len(pack)]:
+                        if isinstance(v, int) or isinstance(v, str):
+                            packed[k] += [v]
+                        elif isinstance(v, list):
+                            # sequences longer than the packs are truncated
+                            packed[k] += v[:max_length]
+                        else:
+                            raise ValueError(f"Unknown type {type(v)}")
+                packed["seq_lens"] = [
+                    min(len(x), max_length)
+                    for x in examples["input_ids"][start : start + len(pack)]
+                ]
+                start += len(pack)
+
+                for k, v in packed.items():
+                    grouped_samples[k].append(v)
             return grouped_samples
 
-        dataset = dataset.map(
+        dataset = ArrowDataset.from_dict({"indices": packs}).map(
             group,
-            num_proc=20,
+            num_proc=num_proc,
             batched=True,
-            batch_size=10_000,
-            remove_columns=list(dataset.features),
+            batch_size=1_000,
+            remove_columns=["indices"],
         )
 
         return dataset
@@ -840,6 +920,21 @@ class DataModule(LightningDataModule, Registrable):
 
                 setattr(self, f"{split}_dataset", sub_dataset)
 
+            if (
+                self.config.pretokenize
+                and not self.for_generation
+                and not (self.config.pack_sequences and split == "train")
+                and getattr(self, f"{split}_dataset") is not None
+            ):
+                if type(self.collate_fn) is not DefaultCollator:
+                    logger.warning(
+                        f"Not pre-tokenizing, {type(self.collate_fn).__name__} collates raw examples."
+                    )
+                else:
+                    dataset = getattr(self, f"{split}_dataset")
+                    logger.info(f"Pre-tokenizing the {split} dataset")
+                    setattr(self, f"{split}_dataset", self.pretokenize_dataset(dataset))
+
             if self.config.pack_sequences and split == "train":
                 dataset = getattr(self, f"{split}_dataset")
 
@@ -949,6 +1044,10 @@ def get_datamodule(args, for_generation=False, dataset_override=None):
         "pad_to_multiple_of": args.pad_to_multiple_of,
         "padding_side": args.padding_side,
         "max_seq_per_pack": args.max_seq_per_pack,
+        "packing_strategy": args.packing_strategy,
+        "num_proc": args.num_proc,
+        "pretokenize": args.pretokenize,
+        "tokenized_cache_dir": args.tokenized_cache_dir,
     }
 
     if dataset in [
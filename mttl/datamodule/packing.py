@@ -0,0 +1,189 @@
+import bisect
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+from mttl.registrable import Registrable
+
+
+def packing_efficiency(
+    packs: List[List[int]], lengths: Sequence[int], max_length: int
+) -> Dict[str, float]:
+    """Statistics of a packing: the fraction of the packs' capacity lost to padding and
+    the number of sequences per pack."""
+    n_tokens = sum(min(lengths[i], max_length) for pack in packs for i in pack)
+    n_sequences = sum(len(pack) for pack in packs)
+    capacity = len(packs) * max_length
+    return {
+        "packs": len(packs),
+        "sequences": n_sequences,
+        "sequences_per_pack": n_sequences / max(len(packs), 1),
+        "padding_fraction": 1.0 - n_tokens / capacity if capacity else 0.0,
+    }
+
+
+class PackingStrategy(Registrable):
+    """Groups sequences into packs of at most `max_length` tokens and `max_sequences`
+    sequences. Sequences longer than `max_length` are truncated and take a pack alone.
+
+    Strategies are deterministic given `seed`.
+    """
+
+    def __init__(self, max_length: int, max_sequences: int, seed: int = 42):
+        self.max_length = max_length
+        self.max_sequences = max_sequences
+        self.seed = seed
+
+    @classmethod
+    def from_name(cls, name: str, **kwargs) -> "PackingStrategy":
+        if name not in cls.registered_names():
+            raise ValueError(
+                f"Unknown packing strategy {name}, available: {cls.registered_names()}."
+            )
+        return cls.get_class_by_name(name)(**kwargs)
+
+    def pack(self, lengths: Sequence[int]) -> List[List[int]]:
+        """Returns the indices of the sequences in each pack."""
+        raise NotImplementedError()
+
+    def _decreasing_order(self, lengths: Sequence[int]) -> np.ndarray:
+        # ties are broken by position, so that the order is deterministic
+        lengths = np.minimum(np.asarray(lengths, dtype=np.int64), self.max_length)
+        return np.argsort(-lengths, kind="stable")
+
+
+@PackingStrategy.register("greedy")
+class GreedyPacking(PackingStrategy):
+    """Packs the sequences in order, a new pack is started when the next sequence doesn't fit."""
+
+    def pack(self, lengths: Sequence[int]) -> List[List[int]]:
+        packs, pack, pack_length = [], [], 0
+        for i, length in enumerate(lengths):
+            length = min(length, self.max_length)
+            if pack and (
+                pack_length + length > self.max_length
+                or len(pack) >= self.max_sequences
+            ):
+                packs.append(pack)
+                pack, pack_length = [], 0
+            pack.append(i)
+            pack_length += length
+        if pack:
+            packs.append(pack)
+        return packs
+
+
+@PackingStrategy.register("first_fit_decreasing")
+class FirstFitDecreasingPacking(PackingStrategy):
+    """Longest sequences first, each into the first pack with enough room.
+
+    The first pack with enough room is found in a max segment tree over the remaining
+    room of the packs, in O(log n) per sequence.
+    """
+
+    def pack(self, lengths: Sequence[int]) -> List[List[int]]:
+        order = self._decreasing_order(lengths)
+        size = 1
+        while size < max(len(order), 1):
+            size *= 2
+        # leaves hold the remaining room of each pack, -1 when it is closed
+        tree = [-1] * (2 * size)
+        packs: List[List[int]] = []
+
+        def update(position, room):
+            position += size
+            tree[position] = room
+            position //= 2
+            while position:
+                tree[position] = max(tree[2 * position], tree[2 * position + 1])
+                position //= 2
+
+        for i in order.tolist():
+            length = min(lengths[i], self.max_length)
+            if tree[1] >= length:
+                node = 1
+                while node < size:
+                    node = 2 * node if tree[2 * node] >= length else 2 * node + 1
+                position = node - size
+            else:
+                position = len(packs)
+                packs.append([])
+                tree[size + position] = self.max_length
+
+            packs[position].append(i)
+            room = tree[size + position] - length
+            update(position, room if len(packs[position]) < self.max_sequences else -1)
+        return packs
+
+
+@PackingStrategy.register("best_fit")
+class BestFitPacking(PackingStrategy):
+    """Fills the packs one at a time, starting with the longest remaining sequence, then
+    each slot with the longest remaining sequence that fits.
+
+    Room is kept for the shortest sequences in the remaining slots of the pack, so that
+    packs are also filled when `max_sequences` binds before `max_length`. The remaining
+    sequences are kept in a histogram of their lengths, the longest sequence that fits is
+    found by bisecting over the distinct lengths, at most `max_length` of them.
+    """
+
+    def pack(self, lengths: Sequence[int]) -> List[List[int]]:
+        return self._best_fit(lengths, range(len(lengths)))
+
+    def _best_fit(self, lengths, indices) -> List[List[int]]:
+        # length -> sequences of that length, the first of `indices` at the end
+        by_length: Dict[int, List[int]] = {}
+        for i in reversed(indices):
+            by_length.setdefault(min(lengths[i], self.max_length), []).append(i)
+        present = sorted(by_length)
+
+        def take(position):
+            length = present[position]
+            index = by_length[length].pop()
+            if not by_length[length]:
+                del by_length[length]
+                present.pop(position)
+            return index, length
+
+        packs: List[List[int]] = []
+        while present:
+            index, length = take(len(present) - 1)
+            pack, room = [index], self.max_length - length
+            while len(pack) < self.max_sequences and present:
+                # leave room for the shortest sequences in the other free slots
+                limit = room - (self.max_sequences - len(pack) - 1) * present[0]
+                position = bisect.bisect_right(present, limit) - 1
+                if position < 0:
+                    position = bisect.bisect_right(present, room) - 1
+                    if position < 0:
+                        break
+                index, length = take(position)
+                pack.append(index)
+                room -= length
+            packs.append(pack)
+        return packs
+
+
+@PackingStrategy.register("shuffled_window")
+class ShuffledWindowPacking(BestFitPacking):
+    """Shuffles the sequences, then packs with best fit within consecutive windows of
+    `window_size` sequences. Packs mix sequences from random positions of the dataset,
+    at the cost of a slightly lower efficiency than packing everything at once.
+    """
+
+    def __init__(
+        self, max_length: int, max_sequences: int, seed: int = 42, window_size=1000
+    ):
+        super().__init__(max_length, max_sequences, seed)
+        self.window_size = window_size
+
+    def pack(self, lengths: Sequence[int]) -> List[List[int]]:
+        rng = np.random.default_rng(self.seed)
+        permutation = rng.permutation(len(lengths))
+
+        packs = []
+        for start in range(0, len(lengths), self.window_size):
+            window = permutation[start : start + self.window_size].tolist()
+            window_packs = self._best_fit(lengths, window)
+            packs.extend(window_packs[j] for j in rng.permutation(len(window_packs)))
+        return packs
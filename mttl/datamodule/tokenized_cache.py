@@ -0,0 +1,245 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Union
+
+import numpy as np
+from torch.utils.data import Dataset
+
+from mttl.logging import logger
+
+# bump when the on-disk format changes
+FORMAT_VERSION = 1
+
+
+def default_tokenized_cache_dir() -> Path:
+    if "MTTL_TOKENIZED_CACHE_DIR" in os.environ:
+        return Path(os.environ["MTTL_TOKENIZED_CACHE_DIR"])
+    return Path.home() / ".cache" / "mttl" / "tokenized"
+
+
+def tokenizer_hash(tokenizer) -> str:
+    """Hash of everything that determines the token ids produced by `tokenizer`."""
+    state = {
+        "class": type(tokenizer).__name__,
+        "name_or_path": tokenizer.name_or_path,
+        "vocab": sorted(tokenizer.get_vocab().items()),
+        "special_tokens": {
+            str(k): str(v) for k, v in tokenizer.special_tokens_map.items()
+        },
+        "truncation_side": tokenizer.truncation_side,
+        "add_eos_token": getattr(tokenizer, "add_eos_token", None),
+        "mttl_merges_space": getattr(tokenizer, "mttl_merges_space", None),
+        "mttl_enforces_eos": getattr(tokenizer, "mttl_enforces_eos", None),
+    }
+    return hashlib.sha256(json.dumps(state).encode()).hexdigest()
+
+
+def tokenized_cache_key(tokenizer, dataset_fingerprint: str, **options) -> str:
+    """Key of a pre-tokenized dataset: the tokenizer, the dataset and the options of the
+    collator changing the tokens, e.g. `max_input_length`, `truncation_side` and
+    `train_on_inputs`."""
+    key = {
+        "version": FORMAT_VERSION,
+        "tokenizer": tokenizer_hash(tokenizer),
+        "dataset": dataset_fingerprint,
+        **options,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:32]
+
+
+class _ShardWriter:
+    def __init__(self, path: Path):
+        os.makedirs(path)
+        self.path = path
+        self.files = {
+            name: open(path / f"{name}.bin", "wb") for name in ["input_ids", "labels"]
+        }
+        self.offsets = {"input_ids": [0], "labels": [0]}
+        self.task_ids: List[int] = []
+        self.task_names: List[int] = []
+        self.task_sources: List[int] = []
+
+    def __len__(self):
+        return len(self.task_ids)
+
+    def write(self, name, values):
+        values = np.asarray(values, dtype=np.int32)
+        values.tofile(self.files[name])
+        self.offsets[name].append(self.offsets[name][-1] + len(values))
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+        for name, offsets in self.offsets.items():
+            np.save(self.path / f"{name}_offsets.npy", np.asarray(offsets, np.int64))
+        np.save(self.path / "task_ids.npy", np.asarray(self.task_ids, np.int64))
+        np.save(self.path / "task_names.npy", np.asarray(self.task_names, np.int32))
+        np.save(self.path / "task_sources.npy", np.asarray(self.task_sources, np.int32))
+
+
+def write_tokenized_cache(
+    examples: Iterable[Dict],
+    path: Union[str, Path],
+    shard_size: int = 100_000,
+):
+    """Writes tokenized examples, i.e. with `input_ids` and `labels`, and optionally
+    `task_ids`, `task_names` and `task_sources`, in shards of `shard_size` examples.
+
+    Each shard holds the concatenated token ids and labels as flat int32 files, which are
+    memory-mapped by `TokenizedDataset`, with the offsets of each example. The cache is
+    written in a temporary directory and moved to `path` once complete.
+    """
+    path = Path(path)
+    os.makedirs(path.parent, exist_ok=True)
+    tmp_path = Path(tempfile.mkdtemp(dir=path.parent, prefix=".tmp-"))
+
+    try:
+        # string tables of the task names and sources
+        names: Dict[str, int] = {}
+
+        def name_index(name):
+            if name is None:
+                return -1
+            return names.setdefault(name, len(names))
+
+        shards, writer = [], None
+        for example in examples:
+            if writer is None:
+                writer = _ShardWriter(tmp_path / f"shard_{len(shards):05d}")
+
+            writer.write("input_ids", example["input_ids"])
+            writer.write("labels", example["labels"])
+            task_id = example.get("task_ids")
+            writer.task_ids.append(-1 if task_id is None else int(task_id))
+            writer.task_names.append(name_index(example.get("task_names")))
+            writer.task_sources.append(name_index(example.get("task_sources")))
+
+            if len(writer) == shard_size:
+                writer.close()
+                shards.append(len(writer))
+                writer = None
+
+        if writer is not None:
+            writer.close()
+            shards.append(len(writer))
+
+        with open(tmp_path / "meta.json", "w") as f:
+            json.dump(
+                {
+                    "version": FORMAT_VERSION,
+                    "shards": shards,
+                    "names": sorted(names, key=names.get),
+                },
+                f,
+            )
+
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another process wrote the same cache in the meantime
+            if not (path / "meta.json").exists():
+                raise
+            shutil.rmtree(tmp_path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+
+class TokenizedDataset(Dataset):
+    """Pre-tokenized examples, memory-mapped from a cache written by `write_tokenized_cache`.
+
+    Examples are numpy arrays of token ids and labels, `DefaultCollator` only pads them.
+    The memory maps are opened lazily in each process, so the dataset is cheap to send to
+    the workers of a dataloader.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        with open(self.path / "meta.json") as f:
+            meta = json.load(f)
+
+        if meta["version"] != FORMAT_VERSION:
+            raise ValueError(
+                f"Tokenized cache {path} has version {meta['version']}, expected {FORMAT_VERSION}."
+            )
+
+        self.names = meta["names"]
+        self.shard_offsets = np.cumsum([0] + meta["shards"])
+        self._shards = None
+
+    @classmethod
+    def exists(cls, path: Union[str, Path]) -> bool:
+        return (Path(path) / "meta.json").exists()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_shards"] = None
+        return state
+
+    def _load_shards(self):
+        shards = []
+        for i in range(len(self.shard_offsets) - 1):
+            shard_path = self.path / f"shard_{i:05d}"
+            shard = {}
+            for name in ["input_ids", "labels"]:
+                offsets = np.load(shard_path / f"{name}_offsets.npy")
+                shard[name] = (
+                    (
+                        np.memmap(shard_path / f"{name}.bin", dtype=np.int32, mode="r")
+                        if offsets[-1] > 0
+                        else np.zeros(0, dtype=np.int32)
+                    ),
+                    offsets,
+                )
+            for name in ["task_ids", "task_names", "task_sources"]:
+                shard[name] = np.load(shard_path / f"{name}.npy")
+            shards.append(shard)
+        return shards
+
+    def __len__(self):
+        return int(self.shard_offsets[-1])
+
+    def __getitem__(self, index) -> Dict:
+        if self._shards is None:
+            self._shards = self._load_shards()
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+
+        shard_index = int(np.searchsorted(self.shard_offsets, index, side="right")) - 1
+        shard = self._shards[shard_index]
+        index -= self.shard_offsets[shard_index]
+
+        example = {}
+        for name in ["input_ids", "labels"]:
+            values, offsets = shard[name]
+            example[name] = values[offsets[index] : offsets[index + 1]]
+
+        task_id = int(shard["task_ids"][index])
+        example["task_id"] = None if task_id < 0 else task_id
+        for name, key in [("task_names", "task_name"), ("task_sources", "task_source")]:
+            name_index = int(shard[name][index])
+            example[key] = None if name_index < 0 else self.names[name_index]
+        return example
+
+
+def load_or_write_tokenized_cache(
+    key: str,
+    examples_fn,
+    cache_dir: Optional[Union[str, Path]] = None,
+    shard_size: int = 100_000,
+) -> TokenizedDataset:
+    """Returns the tokenized dataset cached under `key`, writing the examples returned by
+    `examples_fn()` on a miss."""
+    path = Path(cache_dir or default_tokenized_cache_dir()) / key
+    if not TokenizedDataset.exists(path):
+        logger.info(f"Writing tokenized dataset to {path}")
+        write_tokenized_cache(examples_fn(), path, shard_size=shard_size)
+    else:
+        logger.info(f"Loading tokenized dataset from {path}")
+    return TokenizedDataset(path)
@@ -10,6 +10,7 @@ import numpy as np
 import torch
 from transformers import StoppingCriteria, StoppingCriteriaList
 
+from mttl.evaluators.stop_sequences import StopSequenceMatcher, StopSequenceState
 from mttl.logging import logger
 
 
@@ -184,41 +185,31 @@ class StoppingCriteriaSub(StoppingCriteria):
     We decide to stop on strings rather than stopping on particular ids is a bit difficult to do,
     i.e. \n\n might be tokenized differently if it is preceeded by a particular token or followed
     by a particular token, i.e. the model can generate \n\na, which is tokenized as a whole.
+
+    The stop strings are matched incrementally, one generated token at a time, see
+    `StopSequenceMatcher`. Each sequence stops on its own: finished sequences are padded by
+    `generate` and not matched anymore.
     """
 
-    def __init__(self, stop_tokens=[], tokenizer=None):
+    def __init__(self, stop_tokens=[], tokenizer=None, matcher=None):
         super().__init__()
         self.stop = stop_tokens
-        self.max_length = max([len(s) for s in stop_tokens])
         self.tokenizer = tokenizer
-        self.finished = None
-        self.num_tokens = 1
+        self.matcher = matcher or StopSequenceMatcher(stop_tokens, tokenizer)
+        self.state = None
+
+    @property
+    def finished(self):
+        return self.state.finished if self.state is not None else None
 
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor):
         """Stops on matching token strings and not ids."""
-        if self.finished is None:
-            self.finished = [None for _ in range(input_ids.shape[0])]
-
-        batch_size = input_ids.shape[0]
-        # must look as far as the number of generated tokens
-        decoded = self.tokenizer.batch_decode(
-            input_ids[:, -min(self.max_length, self.num_tokens) :]
-        )
-        self.num_tokens += 1
-
-        for j in range(batch_size):
-            # fill the rest of input ids with pad tokens, the generation finished!
-            if self.finished[j]:
-                input_ids[j, self.finished[j][1] :] = self.tokenizer.pad_token_id
-                continue
-            # check which stop token is in the decoded text
-            for stop in self.stop:
-                pos = decoded[j].find(stop)
-                if pos != -1:
-                    self.finished[j] = (stop, input_ids.shape[1])
-                if self.finished[j]:
-                    break
-        return all(self.finished)
+        if self.state is None:
+            # called once the first token has been generated
+            self.state = StopSequenceState(
+                self.matcher, input_ids.shape[0], input_ids.shape[1] - 1
+            )
+        return self.state.update(input_ids).to(input_ids.device)
 
 
 class GenerativeEvaluator(Evaluator):
@@ -234,6 +225,8 @@ class GenerativeEvaluator(Evaluator):
         super().__init__(datamodule, config, use_vllm)
 
         self.generation_kwargs = generation_kwargs or {}
+        # stop sequences matchers, reused across batches
+        self._stop_matchers = {}
 
         if self.generation_kwargs.pop("auto_max_new_tokens", None):
             self.generation_kwargs["max_new_tokens"] = self._detect_max_new_tokens()
@@ -284,8 +277,18 @@ class GenerativeEvaluator(Evaluator):
         stop_tokens = extra_kwargs.pop("stop_tokens", None)
         if stop_tokens:
             stop_tokens = stop_tokens + [self.tokenizer.eos_token]
+            if tuple(stop_tokens) not in self._stop_matchers:
+                self._stop_matchers[tuple(stop_tokens)] = StopSequenceMatcher(
+                    stop_tokens, self.tokenizer
+                )
             stopping_criteria = StoppingCriteriaList(
-                [StoppingCriteriaSub(stop_tokens, tokenizer=self.tokenizer)]
+                [
+                    StoppingCriteriaSub(
+                        stop_tokens,
+                        tokenizer=self.tokenizer,
+                        matcher=self._stop_matchers[tuple(stop_tokens)],
+                    )
+                ]
             )
             extra_kwargs["stopping_criteria"] = stopping_criteria
 
@@ -7,9 +7,110 @@ from mttl.logging import logger
 from mttl.models.utils import compute_loglike_loss
 
 
+def _repeat_past_key_values(past_key_values, repeats: int):
+    """Repeats the cache of a single sequence for `repeats` sequences."""
+    if hasattr(past_key_values, "batch_repeat_interleave"):
+        past_key_values.batch_repeat_interleave(repeats)
+        return past_key_values
+    return tuple(
+        tuple(tensor.repeat_interleave(repeats, dim=0) for tensor in layer)
+        for layer in past_key_values
+    )
+
+
+def shared_prefix_loglike_loss(forward, batch, num_options, routing_fields=False):
+    """Per-option losses of multiple-choice examples, as `compute_loglike_loss` over the
+    logits of the full sequences, but encoding the tokens shared by the options of an
+    example once.
+
+    The longest common prefix of the options is encoded with the key/values cached, and
+    only the continuations of the options are encoded against the cache.
+
+    Args:
+        forward: the forward of the model, called with keyword arguments.
+        batch: output of `MultipleChoiceCollator`, the options of each example are
+            consecutive rows.
+        num_options: number of options of each example.
+        routing_fields: pass the other fields of the batch, e.g. the task names, for the
+            rows being encoded.
+    """
+    input_ids, attention_mask = batch["input_ids"], batch["attention_mask"].bool()
+    n_rows = input_ids.size(0)
+
+    def fields(rows):
+        if not routing_fields:
+            return {}
+        selected = {}
+        for key, value in batch.items():
+            if key in ["input_ids", "attention_mask", "labels"]:
+                continue
+            if isinstance(value, torch.Tensor) and value.size(0) == n_rows:
+                selected[key] = value[rows]
+            elif isinstance(value, list) and len(value) == n_rows:
+                selected[key] = [value[row] for row in rows]
+            else:
+                selected[key] = value
+        return selected
+
+    losses, start = [], 0
+    for n in num_options:
+        rows = list(range(start, start + n))
+        start += n
+        tokens = [input_ids[row][attention_mask[row]] for row in rows]
+        labels = [batch["labels"][row][attention_mask[row]] for row in rows]
+
+        # longest common prefix, leaving at least one token to each option
+        min_length = min(len(t) for t in tokens)
+        same = torch.stack([t[:min_length] == tokens[0][:min_length] for t in tokens])
+        mismatch = (~same.all(0)).nonzero()
+        prefix_length = int(mismatch[0]) if len(mismatch) else min_length
+        prefix_length = min(prefix_length, min_length - 1)
+
+        past_key_values, prefix_logits = None, None
+        if prefix_length > 0:
+            outputs = forward(
+                input_ids=tokens[0][None, :prefix_length],
+                attention_mask=attention_mask.new_ones(1, prefix_length).long(),
+                use_cache=True,
+                **fields(rows[:1]),
+            )
+            prefix_logits = outputs.logits[0]
+            past_key_values = _repeat_past_key_values(outputs.past_key_values, n)
+
+        continuations = torch.nn.utils.rnn.pad_sequence(
+            [t[prefix_length:] for t in tokens], batch_first=True
+        )
+        continuation_mask = torch.nn.utils.rnn.pad_sequence(
+            [torch.ones_like(t[prefix_length:]) for t in tokens], batch_first=True
+        )
+        outputs = forward(
+            input_ids=continuations,
+            attention_mask=torch.cat(
+                [continuation_mask.new_ones(n, prefix_length), continuation_mask], 1
+            ),
+            past_key_values=past_key_values,
+            use_cache=past_key_values is not None,
+            **fields(rows),
+        )
+
+        for j in range(n):
+            logits = outputs.logits[j, : len(tokens[j]) - prefix_length]
+            if prefix_length > 0:
+                logits = torch.cat([prefix_logits, logits], 0)
+            losses.append(compute_loglike_loss(logits[None], labels[j][None])[0])
+    return torch.stack(losses)
+
+
 class LogLikeEvaluator(Evaluator):
-    def __init__(self, datamodule, **kwargs):
+    def __init__(self, datamodule, share_prefix=None, **kwargs):
+        """
+        Args:
+            share_prefix: encode the tokens shared by the options of an example once, see
+                `shared_prefix_loglike_loss`. By default, only done for models whose output
+                can't depend on the full sequence through the routing, i.e. not expert models.
+        """
         super().__init__(datamodule=datamodule, **kwargs)
+        self.share_prefix = share_prefix
 
     @switch_to_eval_mode
     def evaluate(
@@ -41,6 +142,10 @@ class LogLikeEvaluator(Evaluator):
         all_predictions = []
 
         device = next(model.parameters()).device
+        is_expert_model = isinstance(model, (ExpertModule, BaseExpertModel))
+        share_prefix = (
+            self.share_prefix if self.share_prefix is not None else not is_expert_model
+        )
 
         for num_batch, batch in pbar:
             if num_batches is not None and num_batch >= num_batches:
@@ -55,19 +160,25 @@ class LogLikeEvaluator(Evaluator):
             batch = transfer_batch_to_device(batch, device)
 
             with torch.no_grad():
-                if isinstance(model, ExpertModule) or isinstance(
-                    model, BaseExpertModel
-                ):
-                    logits = model.forward(**batch).logits
+                if share_prefix:
+                    loss_per_option = shared_prefix_loglike_loss(
+                        model.forward if is_expert_model else model,
+                        batch,
+                        num_options,
+                        routing_fields=is_expert_model,
+                    )
                 else:
-                    logits = model.forward(
-                        input_ids=batch["input_ids"],
-                        attention_mask=batch["attention_mask"],
-                    ).logits
-
-                loss_per_option = compute_loglike_loss(
-                    logits, batch["labels"], reduction="none"
-                )
+                    if is_expert_model:
+                        logits = model.forward(**batch).logits
+                    else:
+                        logits = model.forward(
+                            input_ids=batch["input_ids"],
+                            attention_mask=batch["attention_mask"],
+                        ).logits
+
+                    loss_per_option = compute_loglike_loss(
+                        logits, batch["labels"], reduction="none"
+                    )
                 loss_per_option = loss_per_option.cpu().numpy()
                 loss_per_example = [
                     loss_per_option[
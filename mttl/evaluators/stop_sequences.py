@@ -0,0 +1,165 @@
+from collections import deque
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+
+import torch
+
+
+class AhoCorasick:
+    """Aho–Corasick automaton over sequences of symbols, e.g. token ids.
+
+    `step` advances a state by one symbol and returns the patterns ending at that symbol,
+    so that the patterns found in a stream are tracked in O(1) amortized per symbol.
+    """
+
+    def __init__(self, patterns: Sequence[Sequence[Hashable]]):
+        # state 0 is the root
+        self.goto: List[Dict[Hashable, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.outputs: List[Tuple[int, ...]] = [()]
+
+        for index, pattern in enumerate(patterns):
+            if not len(pattern):
+                raise ValueError("Patterns must not be empty.")
+            state = 0
+            for symbol in pattern:
+                if symbol not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.outputs.append(())
+                    self.goto[state][symbol] = len(self.goto) - 1
+                state = self.goto[state][symbol]
+            self.outputs[state] += (index,)
+
+        # breadth-first, so that the failure link of a state is resolved before its children
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for symbol, child in self.goto[state].items():
+                queue.append(child)
+                fail = self.fail[state]
+                while fail and symbol not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(symbol, 0)
+                if self.fail[child] == child:
+                    self.fail[child] = 0
+                self.outputs[child] += self.outputs[self.fail[child]]
+
+    def step(self, state: int, symbol: Hashable) -> Tuple[int, Tuple[int, ...]]:
+        while state and symbol not in self.goto[state]:
+            state = self.fail[state]
+        state = self.goto[state].get(symbol, 0)
+        return state, self.outputs[state]
+
+
+class StopSequenceMatcher:
+    """Finds stop sequences, given as strings, in generated token ids.
+
+    The token ids of each stop sequence are matched with an Aho–Corasick automaton, one
+    token at a time. A stop sequence can also be generated with other tokens than its
+    tokenization, e.g. "\\n\\n" as part of ".\\n\\n", so the decoded text of the last tokens
+    is also searched, but only after the tokens whose text may end a stop sequence: the
+    tokens containing the last character of a stop sequence, and the tokens without a
+    text of their own, e.g. byte fallbacks and partial UTF-8 characters.
+
+    The tokens to look at are found for the whole vocabulary at once, so the matcher
+    should be reused across generations.
+    """
+
+    def __init__(self, stop_sequences: Sequence[str], tokenizer):
+        self.stop_sequences = list(stop_sequences)
+        self.tokenizer = tokenizer
+
+        patterns, self.pattern_stops = [], []
+        for stop in self.stop_sequences:
+            token_ids = tokenizer.encode(stop, add_special_tokens=False)
+            # the tokenization may add a prefix, e.g. a space for sentencepiece tokenizers
+            if token_ids and stop in tokenizer.decode(token_ids):
+                patterns.append(token_ids)
+                self.pattern_stops.append(stop)
+        self.automaton = AhoCorasick(patterns)
+
+        # a stop sequence spans at most 4 tokens per character, one per UTF-8 byte
+        self.window = 4 * max([len(stop) for stop in self.stop_sequences] + [1])
+
+        last_chars = {stop[-1] for stop in self.stop_sequences if stop}
+        texts = tokenizer.batch_decode([[i] for i in range(len(tokenizer))])
+        self._may_end_stop = torch.tensor(
+            [
+                not text or "\ufffd" in text or any(char in text for char in last_chars)
+                for text in texts
+            ],
+            dtype=torch.bool,
+        )
+        self._in_patterns = torch.zeros(len(tokenizer), dtype=torch.bool)
+        for pattern in patterns:
+            self._in_patterns[[i for i in pattern if i < len(tokenizer)]] = True
+
+    def _lookup(self, table, token_ids, default):
+        in_vocab = token_ids < len(table)
+        return torch.where(
+            in_vocab, table[torch.where(in_vocab, token_ids, 0)], default
+        )
+
+    def may_end_stop(self, token_ids: torch.Tensor) -> torch.Tensor:
+        """Whether a stop sequence can end with the text of each token."""
+        return self._lookup(self._may_end_stop, token_ids, True)
+
+    def in_patterns(self, token_ids: torch.Tensor) -> torch.Tensor:
+        """Whether each token is in the tokenization of a stop sequence."""
+        return self._lookup(self._in_patterns, token_ids, False)
+
+    def search_text(self, token_ids: torch.Tensor) -> Optional[str]:
+        """The first stop sequence found in the decoded text of `token_ids`."""
+        text = self.tokenizer.decode(token_ids)
+        for stop in self.stop_sequences:
+            if stop in text:
+                return stop
+        return None
+
+
+class StopSequenceState:
+    """State of a `StopSequenceMatcher` for a batch of generations: the automaton state
+    and the stop sequence found, if any, of each sequence."""
+
+    def __init__(self, matcher: StopSequenceMatcher, batch_size: int, prompt_length):
+        self.matcher = matcher
+        self.prompt_length = prompt_length
+        self.states = [0] * batch_size
+        self.finished: List[Optional[Tuple[str, int]]] = [None] * batch_size
+        # sequences which are finished, or in a state of the automaton other than the root
+        self.done = torch.zeros(batch_size, dtype=torch.bool)
+        self.matching = torch.zeros(batch_size, dtype=torch.bool)
+
+    def update(self, input_ids) -> torch.Tensor:
+        """Advances the matching of the unfinished sequences by the last token of
+        `input_ids`, returns whether each sequence is finished.
+
+        Only the sequences whose last token is in a stop sequence, or may end one, are
+        looked at, the others go back to the root of the automaton.
+        """
+        matcher = self.matcher
+        length = input_ids.shape[1]
+        last_tokens = input_ids[:, -1].cpu()
+
+        may_end_stop = matcher.may_end_stop(last_tokens)
+        candidates = ~self.done & (
+            may_end_stop | matcher.in_patterns(last_tokens) | self.matching
+        )
+        for j in candidates.nonzero()[:, 0].tolist():
+            self.states[j], matches = matcher.automaton.step(
+                self.states[j], int(last_tokens[j])
+            )
+            self.matching[j] = self.states[j] != 0
+
+            if matches:
+                stop = matcher.pattern_stops[matches[0]]
+            elif may_end_stop[j]:
+                start = max(self.prompt_length, length - matcher.window)
+                stop = matcher.search_text(input_ids[j, start:])
+            else:
+                stop = None
+
+            if stop is not None:
+                self.finished[j] = (stop, length)
+                self.done[j] = True
+        return self.done.clone()
@@ -1,5 +1,5 @@
 import re
-from typing import Tuple
+from typing import Dict, Iterable, List, Tuple, Union
 
 from mttl.logging import logger, warn_once
 from mttl.models.containers.base import ExpertContainer
@@ -251,15 +251,18 @@ class Trie:
             self._print_all_words_helper(child_node, prefix + char)
 
 
-def get_modifiable_modules(transformer):
+def get_modifiable_modules(transformer, named_modules=None):
     """Get modules to modify in the transformer model.
     Filter out modules that are inside expert containers."""
+    if named_modules is None:
+        named_modules = dict(transformer.named_modules())
+
     trie = Trie()
-    for m_name, module in dict(transformer.named_modules()).items():
+    for m_name, module in named_modules.items():
         # if m_name is ExpertContainer, insert to the trie
         if isinstance(module, ExpertContainer):
             trie.insert(m_name)
-    for m_name, module in dict(transformer.named_modules()).items():
+    for m_name, module in named_modules.items():
         # for all the sub modules in the trie, skip if it is inside an expert container
         if not trie.search(m_name) and trie.has_leaf_prefix(
             m_name
@@ -421,3 +424,198 @@ def add_expert_to_transformer(
         )
 
     logger.debug("Patched layers: %s", added_layers)
+
+
+class ModifiableModulesIndex:
+    """Index of the modules of a transformer that experts can be added to.
+
+    Built with a single traversal of the model, and kept in sync when expert containers
+    replace the modules, so that adding many experts does not walk the model for each of them.
+    """
+
+    def __init__(self, transformer):
+        self.transformer = transformer
+        self.modules = dict(transformer.named_modules())
+        self.modifiable = dict(get_modifiable_modules(transformer, self.modules))
+        self._matches = {}
+
+    def match(self, modify_modules: str):
+        """Same as `match_modules_to_modify`, the matches of each regex are computed once."""
+        if modify_modules not in self._matches:
+            self._matches[modify_modules] = [
+                m_name
+                for m_name in self.modifiable
+                if re.fullmatch(modify_modules, m_name)
+            ]
+        return [
+            (m_name, self.modifiable[m_name])
+            for m_name in self._matches[modify_modules]
+            if m_name in self.modifiable
+        ]
+
+    def replace(self, m_name: str, container: ExpertContainer):
+        """Replaces the module `m_name` with `container`."""
+        parent_name, child_name = m_name.rsplit(".", 1)
+        setattr(self.modules[parent_name], child_name, container)
+
+        # the children of the module now live inside the container
+        prefix = m_name + "."
+        for index in (self.modules, self.modifiable):
+            for name in [name for name in index if name.startswith(prefix)]:
+                del index[name]
+            index[m_name] = container
+
+
+def _split_expert_weights_by_layer(expert_weights, layer_names):
+    """Assigns each weight of the expert to the layer whose name prefixes it, in a single
+    pass over the weights instead of one pass per layer as in `filter_expert_weights`.
+    """
+    weights_by_layer = {}
+    for name, weight in expert_weights.items():
+        parts = name.split(".")
+        for i in range(len(parts) - 1, 0, -1):
+            layer_name = ".".join(parts[:i])
+            if layer_name in layer_names:
+                weights_by_layer.setdefault(layer_name, {})[name] = weight
+                break
+    return weights_by_layer
+
+
+def add_experts_to_transformer(
+    transformer,
+    experts: Iterable[Expert],
+    action: str = "route",
+    default_expert_name: str = None,
+    selector_config: Union[SelectorConfig, Dict[str, SelectorConfig]] = None,
+    selector_cache: SelectorsCache = None,
+) -> List[str]:
+    """
+    Adds many experts to the transformer architecture, equivalent to calling
+    `add_expert_to_transformer` for each of them.
+
+    The modifiable modules are indexed once, the weights of each expert are dispatched to
+    their containers in a single pass, and parameters are tied and selectors are assigned
+    once, after all the experts have been added.
+
+    Params:
+        transformer: the transformer model to modify
+        experts: expert instances that need to be added, can be a generator
+        action: whether to route or merge these experts, default is `route`
+        default_expert_name: name of the expert to set as default, if any
+        selector_config: selector configuration to use for the model, or one per modifier name
+        selector_cache: cache to store the selectors for the model
+
+    Returns:
+        the names of the added experts.
+    """
+    from mttl.models.containers.hard_prompts_container import (
+        add_hard_prompt_to_transformer,
+    )
+    from mttl.models.modifiers.base import get_target_2_source_param_mapping, tie_params
+    from mttl.models.modifiers.modify_model import get_modifier_name
+
+    index = ModifiableModulesIndex(transformer)
+    expert_names = []
+    added_layers = set()
+    added_modifiers = set()
+    tie_configs = {}
+
+    for expert in experts:
+        expert_config = expert.expert_config
+
+        if not expert.name:
+            raise ValueError("Expert name cannot be empty!")
+
+        is_default = expert.name == default_expert_name
+        model_modifier = get_modifier_name(expert_config)
+        expert_names.append(expert.name)
+
+        if model_modifier == "hard_prompt":
+            add_hard_prompt_to_transformer(
+                transformer,
+                expert,
+                action=action,
+                is_default=is_default,
+            )
+            continue
+
+        modify_modules = create_modif_regex(
+            expert_config.modify_modules, expert_config.modify_layers
+        )
+        matched_modules = index.match(modify_modules)
+        if not matched_modules:
+            raise ValueError(
+                "You were trying to add an expert but no expert containers were created, this is likely due to a misconfiguration of the expert config."
+                " `modify_layers` and `modify_modules` did not return a match for the current model."
+            )
+
+        weights_by_layer = {}
+        if expert.expert_weights:
+            expert_weights = expert.expert_weights
+            # phi-huggingface weights are renamed by `filter_expert_weights`
+            if not "transformer.h" in next(iter(expert_weights)):
+                weights_by_layer = _split_expert_weights_by_layer(
+                    expert_weights, {m_name for m_name, _ in matched_modules}
+                )
+
+        for m_name, module in matched_modules:
+            if not isinstance(module, ExpertContainer):
+                CONTAINER_CLASS = get_container_class(model_modifier)
+                expert_container = CONTAINER_CLASS(
+                    expert_config,
+                    module,
+                )
+                expert_container.__layer_name__ = m_name
+                index.replace(m_name, expert_container)
+            else:
+                expert_container = module
+
+            added_layers.add(expert_container.__layer_name__)
+            expert_container.add_expert(
+                (
+                    expert.with_weights(weights_by_layer[m_name])
+                    if m_name in weights_by_layer
+                    else expert
+                ),
+                action=action,
+                is_default=is_default,
+            )
+
+        added_modifiers.add(model_modifier)
+        if expert_config.tie_params:
+            tie_configs.setdefault(expert_config.tie_params, expert_config)
+
+    ### PARAM TYING ###
+    # see `add_expert_to_transformer`, parameters are tied once per tying pattern
+    for expert_config in tie_configs.values():
+        target_2_source_param = get_target_2_source_param_mapping(
+            transformer.named_parameters(), expert_config.tie_params
+        )
+        tie_params(transformer, expert_config, target_2_source_param)
+
+    if selector_config is not None:
+        for model_modifier in sorted(added_modifiers):
+            modifier_selector_config = (
+                selector_config.get(model_modifier)
+                if isinstance(selector_config, dict)
+                else selector_config
+            )
+            if modifier_selector_config is None:
+                continue
+
+            replace_selector_for_container(
+                transformer,
+                model_modifier,
+                modifier_selector_config,
+                selector_cache,
+            )
+
+            if not selector_cache.get(model_modifier):
+                raise ValueError(
+                    "No selectors were created but a routing config was specified. Check your selector_config and model architecture."
+                )
+
+    logger.debug(
+        "Added %s experts, patched layers: %s", len(expert_names), added_layers
+    )
+    return expert_names
@@ -122,6 +122,11 @@ class ExpertContainer(nn.Module, Container):
             experts.append(expert)
         return experts
 
+    def reserve(self, n_experts: int) -> None:
+        """Preallocates storage for `n_experts` experts, for containers keeping the weights
+        of their experts in shared tensors."""
+        pass
+
     @abstractmethod
     def on_add_expert(
         self,
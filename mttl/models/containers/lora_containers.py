@@ -12,6 +12,7 @@ from mttl.models.containers.selectors.selector_output import (
     SelectorOutput,
 )
 from mttl.models.library.expert import Expert
+from mttl.models.modifiers.grouped_lora import sparse_topk_lora_forward, use_sparse_topk
 from mttl.models.modifiers.lora import LoRA, LoRAConfig, SkilledLoRA, SkilledLoRAConfig
 from mttl.models.modifiers.modify_model import get_modifier_name
 
@@ -39,6 +40,9 @@ class LoRAExpertContainer(ExpertContainer):
 
         self.merged_expert_names = []
         self.experts = nn.ModuleDict({})
+        # bumped whenever the set of experts changes, invalidates the stacked views
+        self._experts_version = 0
+        self._skilled_lora_cache = {}
 
     def on_add_expert(
         self,
@@ -72,6 +76,7 @@ class LoRAExpertContainer(ExpertContainer):
             self.merged_expert_names.append(expert.name)
         else:
             self.experts[expert.name] = modifier_module
+            self._invalidate_skilled_loras()
 
     def merge_with_layer(self):
         if not len(self.experts):
@@ -83,6 +88,82 @@ class LoRAExpertContainer(ExpertContainer):
         self.merged_expert_names.extend(self.experts)
         self.expert_infos.clear()
         self.experts.clear()
+        self._invalidate_skilled_loras()
+
+    def _invalidate_skilled_loras(self):
+        self._experts_version += 1
+        self._skilled_lora_cache.clear()
+
+    def _get_skilled_lora(self, experts) -> "SkilledLoRAView":
+        """Stacks the weights of the given experts (names or indices) into a SkilledLoRAView.
+
+        The stack is cached and reused until experts are added or their weights are modified,
+        which is tracked with the version counters of the tensors. When gradients must flow to
+        the experts the stack is rebuilt, it is then part of the autograd graph.
+        """
+        from mttl.models.modifiers.lora import SkilledLoRAView
+
+        loras = [self.get(expert) for expert in experts]
+        if torch.is_grad_enabled() and any(
+            lora.lora_a.requires_grad or lora.lora_b.requires_grad for lora in loras
+        ):
+            return SkilledLoRAView.from_loras(loras)
+
+        version = (
+            self._experts_version,
+            tuple(
+                (
+                    lora.lora_a.data_ptr(),
+                    lora.lora_a._version,
+                    lora.lora_b.data_ptr(),
+                    lora.lora_b._version,
+                )
+                for lora in loras
+            ),
+        )
+        key = tuple(experts)
+        cached = self._skilled_lora_cache.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        with torch.no_grad():
+            skilled_lora = SkilledLoRAView.from_loras(loras)
+        self._skilled_lora_cache[key] = (version, skilled_lora)
+        return skilled_lora
+
+    def _use_sparse_topk(self, selection) -> bool:
+        """Whether the top-k experts selected per example or per token are few enough
+        to be applied sparsely, see `_sparse_topk_forward`."""
+        return (
+            isinstance(selection.experts, torch.Tensor)
+            and selection.dim_names
+            in (["batch", "experts"], ["batch", "sequence", "experts"])
+            and use_sparse_topk(selection.experts.size(-1), len(self))
+        )
+
+    def _sparse_topk_forward(self, input, selection, lora_a, lora_b, modifier):
+        """Applies the top-k experts of each token, without expanding the routing weights
+        to all the experts. `modifier` provides the dropout and the scaling of the experts.
+        """
+        experts, weights = selection.experts, selection.weights
+        if "sequence" not in selection.dim_names and input.ndim == 3:
+            # all the tokens of an example share its experts
+            experts = experts.unsqueeze(1).expand(-1, input.size(1), -1)
+            weights = weights.unsqueeze(1).expand(-1, input.size(1), -1)
+
+        layer_out = self.layer(input)
+        input_lora = modifier.dropout_layer(input.to(modifier.lora_a.dtype))
+        adapter_out = sparse_topk_lora_forward(
+            input_lora.reshape(-1, input_lora.size(-1)),
+            lora_a,
+            lora_b,
+            experts.reshape(-1, experts.size(-1)),
+            weights.reshape(-1, weights.size(-1)).to(modifier.lora_a.dtype),
+            modifier.scaling,
+            merge_after=self.lora_merge_after,
+        )
+        adapter_out = adapter_out.view(*layer_out.shape[:-1], -1)
+        return layer_out + adapter_out.to(dtype=input.dtype)
 
     def _convert_expert_names_to_indices(
         self, expert_names, use_default_expert=True
@@ -113,9 +194,7 @@ class LoRAExpertContainer(ExpertContainer):
         if isinstance(selection, ExpertsAndWeightsSelectorOutput):
             # In this case, we have a list of experts and their weights
             # and these are shared across all the batch examples
-            skilled_lora = SkilledLoRAView.from_loras(
-                [self.get(module) for module in selection.experts]
-            )
+            skilled_lora = self._get_skilled_lora(selection.experts)
             return SkilledLoRA.parallel_linear_weighted_forward(
                 input,
                 [skilled_lora],
@@ -148,6 +227,16 @@ class LoRAExpertContainer(ExpertContainer):
                         )
                     ).to(selection.weights.device)
 
+                if self._use_sparse_topk(selection):
+                    loras = [self.get(index) for index in range(len(self))]
+                    return self._sparse_topk_forward(
+                        input,
+                        selection,
+                        [lora.lora_a for lora in loras],
+                        [lora.lora_b for lora in loras],
+                        loras[0],
+                    )
+
                 # set of active indices
                 unique_indices, inverse_indices = torch.unique(
                     selection.experts, return_inverse=True
@@ -194,16 +283,8 @@ class LoRAExpertContainer(ExpertContainer):
                     "Creating skilled loras for all experts, you might want to use CoalescedLoRAContainer instead, set USE_COALESCED_LORA=True in your environment variables."
                 )
 
-                # store skilled lora view for reuse locally
-                skilled_loras = [
-                    SkilledLoRAView.from_loras(
-                        [
-                            self.get(int(expert_index))
-                            for expert_index in range(len(self))
-                        ]
-                    )
-                ]
-                self._skilled_loras = skilled_loras
+                # the stacked view is reused across calls, e.g. decoding steps
+                skilled_loras = [self._get_skilled_lora(range(len(self)))]
 
                 module_output = SkilledLoRA.parallel_linear_weighted_forward(
                     input,
@@ -317,6 +398,9 @@ class CoalescedLoRAExpertContainer(LoRAExpertContainer):
 
         self.experts.add_skill(modifier_module)
 
+    def reserve(self, n_experts: int) -> None:
+        self.experts.reserve(n_experts)
+
     def route(self, input, selection, **kwargs):
         if isinstance(selection, BatchExpertsSelectorOutput):
             # in order to use this container, we need to create one-hot weights for the experts
@@ -363,6 +447,20 @@ class CoalescedLoRAExpertContainer(LoRAExpertContainer):
                         )
                     ).to(selection.weights.device)
 
+                if (
+                    self.experts.n_splits == 1
+                    and not self.dummy_config.phi_2_align_heads
+                    and self._use_sparse_topk(selection)
+                ):
+                    # views on the weights of the skills, nothing is copied
+                    return self._sparse_topk_forward(
+                        input,
+                        selection,
+                        self.experts.lora_a[:, 0],
+                        self.experts.lora_b[:, :, 0],
+                        self.experts,
+                    )
+
                 # we need to expand the weights to the full size of the expert set
                 weights = torch.zeros(
                     (selection.weights.shape[:-1] + (self.experts.n_skills,)),
@@ -1,7 +1,8 @@
 import functools
+import os
 import threading
 from abc import ABC
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from dataclasses import dataclass, field
 from typing import Dict, Union
 
@@ -19,6 +20,7 @@ from mttl.models.containers.selectors.selector_output import (
     ExpertsSplitsAndWeightsSelectorOutput,
     SelectorOutput,
 )
+from mttl.models.expert_context import tensors_nbytes
 from mttl.models.library.expert import ExpertInfo
 from mttl.models.modifiers.base import Modifier
 from mttl.models.ranker.adapter_ranker import AdapterRankerHelper
@@ -199,22 +201,44 @@ class LoadableSelectorConfig(SelectorConfig):
 
 
 def forward_with_cache(func):
+    """Computes the routing once per forward pass for all the layers sharing the selector.
+
+    The output is cached in the routing cache of the current request context, keyed by the
+    selector and the index of the forward pass, so that concurrent requests never share
+    routing outputs. Outside of a request context, the routing is computed at every call.
+    """
+
     def wrapper(self: Selector, input, **kwargs):
-        if self.forward_cache is not None and not self.clear_cache:
-            self.count_call()
-            return self.forward_cache
+        def _forward():
+            output = func(self, input, **kwargs)
+            self.forward_step += 1
+            return output
 
-        output = func(self, input, **kwargs)
-        self.forward_cache = output
-        self.count_call()
-        return output
+        context = self.info_container
+        if context is None or self.total_calls_per_forward <= 1:
+            return _forward()
+
+        forward_index = context.next_forward_index(self, self.total_calls_per_forward)
+        if forward_index > 0:
+            # the previous forward pass is over, its routing is not needed anymore
+            context.routing_cache.pop((id(self), forward_index - 1))
+        return context.routing_cache.get_or_compute((id(self), forward_index), _forward)
 
     return wrapper
 
 
 def safe_logging(func):
+    """Wraps the logging methods of the selectors, which push tensors to the metric logger
+    without calling `.item()`, so that logging does not synchronize with the device.
+
+    Nothing is computed when logging is disabled, or when the current step is not sampled.
+    """
+
     def wrapper(selector, *args, **kwargs):
-        if not selector.config.selector_logging:
+        if not (
+            selector.config.selector_logging
+            and selector.metric_logger.should_log(selector.forward_step)
+        ):
             return None
         try:
             result = func(selector, *args, **kwargs)
@@ -228,21 +252,101 @@ def safe_logging(func):
     return wrapper
 
 
-def artifacts_cache(func):
-    cache = {}
-    lock = threading.Lock()
+class ArtifactsCache:
+    """LRU cache of the library artifacts loaded by the selectors, e.g. prototypes, bounded
+    by the number of bytes of their tensors.
+
+    Each artifact is loaded once even if requested concurrently, loading only blocks the
+    callers requesting the same artifact.
+    """
+
+    def __init__(self, max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self._loading_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key):
+        # must be called with the lock held
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+        return None
+
+    def get_or_load(self, key, load):
+        with self._lock:
+            entry = self._get(key)
+            if entry is not None:
+                return entry[0]
+            loading_lock = self._loading_locks.setdefault(key, threading.Lock())
+
+        with loading_lock:
+            with self._lock:
+                # loaded by another thread in the meantime
+                entry = self._get(key)
+                if entry is not None:
+                    return entry[0]
+                self.misses += 1
+
+            try:
+                artifacts = load()
+                nbytes = tensors_nbytes(artifacts)
+                with self._lock:
+                    if nbytes <= self.max_bytes:
+                        self._entries[key] = (artifacts, nbytes)
+                        self._nbytes += nbytes
+                        self._evict()
+                    else:
+                        logger.debug(
+                            f"Artifacts {key} larger than the cache, not cached."
+                        )
+            finally:
+                with self._lock:
+                    self._loading_locks.pop(key, None)
+        return artifacts
+
+    def _evict(self):
+        while self._entries and self._nbytes > self.max_bytes:
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self._nbytes -= nbytes
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self._nbytes,
+        }
+
+
+# shared by all the selectors, set ARTIFACTS_CACHE_MAX_BYTES=0 to disable it
+selector_artifacts_cache = ArtifactsCache(
+    max_bytes=int(os.environ.get("ARTIFACTS_CACHE_MAX_BYTES", 2**31))
+)
+
+
+def artifacts_cache(func):
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        # wrapper expects
-        key = args[1].artifacts_hash
-
-        with lock:
-            if key in cache:
-                return cache[key]
-            result = func(*args, **kwargs)
-            cache[key] = result
-        return result
+        # wrapper expects (cls, config)
+        key = (func.__qualname__, args[1].artifacts_hash)
+        return selector_artifacts_cache.get_or_load(key, lambda: func(*args, **kwargs))
 
     return wrapper
 
@@ -256,10 +360,11 @@ class Selector(nn.Module, Registrable):
         self.config = config
         self.expert_infos = {}
         self.selector_views = []
-        self.forward_cache = None
         self.default_expert_name = None
+        # number of layers sharing this selector, i.e. of calls per forward pass
         self.total_calls_per_forward = 0
-        self._calls_counter = 0
+        # number of forward passes actually computed, used to sample the logged steps
+        self.forward_step = 0
         self._task_to_expert_name = {}
         # dependency injection filled from ExpertContainer
         self.__layer_name__ = None
@@ -268,16 +373,6 @@ class Selector(nn.Module, Registrable):
     def expert_names(self) -> list:
         return list(self.expert_infos.keys())
 
-    @property
-    def clear_cache(self):
-        reset_cache = self._calls_counter >= self.total_calls_per_forward
-        if reset_cache:
-            self._calls_counter = 0
-        return reset_cache
-
-    def count_call(self):
-        self._calls_counter += 1
-
     @abstractmethod
     def forward(self, input, **kwargs) -> SelectorOutput:
         pass
@@ -335,6 +430,10 @@ class Selector(nn.Module, Registrable):
     ):
         pass
 
+    def reserve(self, n_experts: int):
+        """Preallocates the per-expert parameters of the selector for `n_experts` experts."""
+        pass
+
     def add_expert(
         self, expert_name: str, expert_info: ExpertInfo = None, is_default=False
     ):
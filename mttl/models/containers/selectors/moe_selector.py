@@ -15,6 +15,7 @@ from mttl.models.containers.selectors.selector_output import (
     SelectorOutput,
 )
 from mttl.models.library.expert import ExpertInfo
+from mttl.models.utils import append_rows, reserve_rows
 
 
 @dataclass
@@ -87,16 +88,12 @@ class MOERKHSSelector(Selector):
     def get_routing_weights(self):
         raise ValueError("Not supported for MOESelector.")
 
+    def reserve(self, n_experts: int):
+        self.rkhs_embeddings.data = reserve_rows(self.rkhs_embeddings.data, n_experts)
+
     def on_add_expert(
         self, expert_name: str, expert_info: ExpertInfo = None, is_default=False
     ):
         # just initialize the expert embeddings
-        self.rkhs_embeddings.data = torch.cat(
-            [
-                self.rkhs_embeddings.data,
-                torch.zeros(
-                    1, self.emb_dim, device=self.rkhs_embeddings.device
-                ).uniform_(-0.02, 0.02),
-            ],
-            dim=0,
-        )
+        self.rkhs_embeddings.data = append_rows(self.rkhs_embeddings.data)
+        self.rkhs_embeddings.data[-1].uniform_(-0.02, 0.02)
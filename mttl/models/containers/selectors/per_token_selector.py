@@ -20,6 +20,7 @@ from mttl.models.containers.selectors.selector_output import (
     SelectorOutput,
 )
 from mttl.models.library.expert import ExpertInfo
+from mttl.models.utils import append_rows, reserve_rows
 
 
 @dataclass
@@ -96,39 +97,35 @@ class PerTokenSelector(Selector, LoadableLibraryMixin):
             dtype=self.prototypes.dtype, device=self.prototypes.device
         )
 
-    @safe_logging
-    def _log_angle(self, angle):
-        bs, sq, n_exp = angle.size()
+    def _masked_mean(self, values):
+        """Mean of the (batch, sequence) values over the tokens of the attention mask, computed
+        without boolean indexing, which would synchronize with the device."""
+        if values.size(1) == 1:
+            return values.mean()
+        attn_mask = (self.routing_infos.attention_mask == 1.0).to(values.dtype)
+        return (values * attn_mask).sum() / attn_mask.sum()
 
-        if sq > 1:
-            attn_mask = self.routing_infos.attention_mask == 1.0
-            mean_angle = angle[attn_mask].sum() / attn_mask.sum() / n_exp
-        else:
-            mean_angle = angle.mean()
+    @safe_logging
+    def _log_angle(self, router_logits, input, prototypes):
+        angle = router_logits / input.norm(p=2, dim=-1, keepdim=True).clamp(min=EPS)
+        angle = angle / prototypes.norm(p=2, dim=-1).view(1, 1, -1).clamp(min=EPS)
+        mean_angle = self._masked_mean(angle.mean(dim=-1))
 
         task = self.routing_infos.task_names[0]
 
-        to_store = {"angle": mean_angle.item()}
+        to_store = {"angle": mean_angle}
         self.metric_logger.update(prefix=f"task_{task}", value_dict=to_store)
         self.metric_logger.update(prefix=self.__layer_name__, value_dict=to_store)
 
     @safe_logging
     def _log_entropy(self, logits):
         # uniform routing entropy
-        bs, sq, dim = logits.size()
-
         dist = torch.distributions.Categorical(logits=logits)
-        entropy = dist.entropy()
-
-        if sq > 1:
-            attn_mask = self.routing_infos.attention_mask == 1.0
-            mean_entropy = entropy[attn_mask].sum() / attn_mask.sum()
-        else:
-            mean_entropy = entropy.mean()
+        mean_entropy = self._masked_mean(dist.entropy())
 
         task = self.routing_infos.task_names[0]
 
-        to_store = {"ent_routing": mean_entropy.item()}
+        to_store = {"ent_routing": mean_entropy}
         self.metric_logger.update(prefix=f"task_{task}", value_dict=to_store)
         self.metric_logger.update(prefix=self.__layer_name__, value_dict=to_store)
 
@@ -152,15 +149,10 @@ class PerTokenSelector(Selector, LoadableLibraryMixin):
                 probs, index=expert_ids.view(bs, 1, 1).expand(-1, seq_len, -1), dim=-1
             )
 
-            attn_mask = self.routing_infos.attention_mask == 1.0
-
-            # are we teacher forcing or generating ?
-            if seq_len == 1:
-                mean_correct_p = expert_p.mean()
-            else:
-                mean_correct_p = expert_p[attn_mask].mean()
+            # averaged over the tokens of the attention mask if we are teacher forcing
+            mean_correct_p = self._masked_mean(expert_p.squeeze(-1))
 
-            to_store = {"expert_p": mean_correct_p.item()}
+            to_store = {"expert_p": mean_correct_p}
             self.metric_logger.update(
                 prefix=f"task_{task_names[0]}", value_dict=to_store
             )
@@ -187,10 +179,7 @@ class PerTokenSelector(Selector, LoadableLibraryMixin):
             router_logits = router_logits.abs()
 
         # log angle between input and prototypes
-        angle = router_logits / input.norm(p=2, dim=-1, keepdim=True).clamp(min=EPS)
-        angle = angle / prototypes.norm(p=2, dim=-1).view(1, 1, -1).clamp(min=EPS)
-
-        self._log_angle(angle)
+        self._log_angle(router_logits, input, prototypes)
 
         # control entropy of distribution
         router_logits /= temp
@@ -217,6 +206,9 @@ class PerTokenSelector(Selector, LoadableLibraryMixin):
             experts=experts, weights=router_probs
         )
 
+    def reserve(self, n_experts: int):
+        self.prototypes.data = reserve_rows(self.prototypes.data, n_experts)
+
     def on_add_expert(
         self, expert_name: str, expert_info: ExpertInfo = None, is_default=False
     ):
@@ -235,5 +227,5 @@ class PerTokenSelector(Selector, LoadableLibraryMixin):
                 device=self.prototypes.device,
             )
 
-        dev = self.prototypes.device
-        self.prototypes.data = torch.cat([self.prototypes.data, proto.to(dev)])
+        self.prototypes.data = append_rows(self.prototypes.data)
+        self.prototypes.data[-1] = proto.to(self.prototypes.device)
@@ -118,14 +118,25 @@ class PhatgooseTrainerSelector(Selector):
 
     @forward_with_cache
     def forward(self, input, **kwargs) -> BatchSequenceExpertsAndWeightsSelectorOutput:
-        # selectors for tasks are trained independently
-        # all samples go through the same selector
-        scores = self.gates[self.default_expert_name](input)
+        if len(self.gates) == 1:
+            # selectors for tasks are trained independently
+            # all samples go through the same selector
+            scores = self.gates[self.default_expert_name](input)
+            experts = torch.zeros_like(scores, dtype=torch.long)
+        else:
+            # the gates of several experts are trained at once, each example goes through
+            # the gate of the expert given as its task name
+            expert_names = self.routing_infos.task_names
+            v = torch.cat([self.gates[name].v for name in expert_names])
+            scores = torch.sigmoid(torch.bmm(input, v.unsqueeze(-1)))
+            experts = torch.tensor(
+                [self.expert_names.index(name) for name in expert_names],
+                device=scores.device,
+            )
+            experts = experts.view(-1, 1, 1).expand_as(scores)
         self.routing_gates.append(scores.detach().cpu().float())
 
-        return BatchSequenceExpertsAndWeightsSelectorOutput(
-            torch.zeros_like(scores, dtype=torch.long), scores
-        )
+        return BatchSequenceExpertsAndWeightsSelectorOutput(experts, scores)
 
     def on_add_expert(
         self, expert_name: str, expert_info: "ExpertInfo", is_default: bool = False
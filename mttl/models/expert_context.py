@@ -1,18 +1,102 @@
+import dataclasses
 import functools
+import os
 import threading
-from typing import List
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List
+
+import numpy as np
+import torch
+
+
+def tensors_nbytes(obj) -> int:
+    """Bytes held by the tensors and arrays of a (nested) object."""
+    if isinstance(obj, torch.Tensor):
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sum(tensors_nbytes(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(tensors_nbytes(value) for value in obj)
+    if dataclasses.is_dataclass(obj):
+        return sum(tensors_nbytes(value) for value in vars(obj).values())
+    return 0
+
+
+class RoutingCache:
+    """LRU cache of the routing outputs computed during the forward passes of a request,
+    bounded by the number of bytes of the cached tensors.
+
+    Entries are keyed by (owner, forward pass index), the index of the forward pass being
+    explicit so that outputs of a previous pass are never returned.
+    """
+
+    def __init__(self, max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+        self.misses += 1
+        value = compute()
+        nbytes = tensors_nbytes(value)
+        if nbytes <= self.max_bytes:
+            self._entries[key] = (value, nbytes)
+            self._nbytes += nbytes
+            self._evict()
+        return value
+
+    def pop(self, key: Hashable):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._nbytes -= entry[1]
+
+    def _evict(self):
+        while self._entries and self._nbytes > self.max_bytes:
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self._nbytes -= nbytes
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self._nbytes,
+        }
 
 
 class InfoContainer:
     local = threading.local()
     local.context = None
 
+    # byte budget of the routing outputs cached during a request
+    routing_cache_max_bytes = int(os.environ.get("ROUTING_CACHE_MAX_BYTES", 2**28))
+
     def __init__(self, model, routing_infos=None, **kwargs):
         self.model = model
         # stores the routing info for the model
         self._routing_infos = routing_infos
         # stores the routing gates for each layer, if any
         self._routing_gates = []
+        # routing outputs shared by the layers within a forward pass, private to this request
+        self.routing_cache = RoutingCache(self.routing_cache_max_bytes)
+        # number of calls of each shared selector, gives the index of the current forward pass
+        self._calls = {}
 
     def __enter__(self):
         InfoContainer.local.context = self
@@ -24,7 +108,14 @@ class InfoContainer:
 
     @classmethod
     def get(cls):
-        return cls.local.context
+        return getattr(cls.local, "context", None)
+
+    def next_forward_index(self, owner, calls_per_forward: int) -> int:
+        """Counts a call of `owner`, which is called `calls_per_forward` times per forward pass,
+        and returns the index of the forward pass the call belongs to."""
+        calls = self._calls.get(id(owner), 0)
+        self._calls[id(owner)] = calls + 1
+        return calls // calls_per_forward
 
     @property
     def routing_infos(self):
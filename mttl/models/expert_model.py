@@ -1,14 +1,14 @@
 import re
 import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
-from functools import partial
-from typing import Dict, List, Union
+from typing import Dict, Iterable, List, Union
 
 import torch
 
 from mttl.logging import logger
 from mttl.models.base_model import BaseExpertModel
-from mttl.models.containers import add_expert_to_transformer
+from mttl.models.containers import add_expert_to_transformer, add_experts_to_transformer
 from mttl.models.containers.base import ContainerFullException, ExpertContainer
 from mttl.models.containers.selectors.base import (
     AutoSelectorConfig,
@@ -25,6 +25,17 @@ from mttl.models.modifiers.base import AutoModifierConfig
 from mttl.models.modifiers.modify_model import modify_transformer
 
 
+def _convert_expert_weights(expert: Expert, device, dtype) -> Expert:
+    """Moves the weights of the expert to `device`, floating point weights are cast to `dtype`."""
+    expert_weights = {
+        name: weight.to(
+            device=device, dtype=dtype if weight.is_floating_point() else None
+        )
+        for name, weight in expert.expert_weights.items()
+    }
+    return expert.with_weights(expert_weights)
+
+
 @dataclass
 class ExpertModelConfig(BaseExpertModelConfig):
     task_name: str = None
@@ -160,12 +171,21 @@ class MultiExpertMixin:
 
     @property
     def experts_containers(self) -> List[ExpertContainer]:
-        containers = []
-        for _, module in self.model.named_modules():
-            for _, child in dict(module.named_children()).items():
-                if isinstance(child, ExpertContainer) and len(child.experts) > 0:
-                    containers.append(child)
-        return containers
+        # the model is only walked again after containers are added or removed
+        if getattr(self, "_experts_containers", None) is None:
+            self._experts_containers = []
+            for _, module in self.model.named_modules():
+                for _, child in dict(module.named_children()).items():
+                    if isinstance(child, ExpertContainer):
+                        self._experts_containers.append(child)
+        return [
+            container
+            for container in self._experts_containers
+            if len(container.experts) > 0
+        ]
+
+    def _invalidate_experts_containers(self):
+        self._experts_containers = None
 
     @property
     def selectors(self) -> Dict[str, List[Selector]]:
@@ -183,33 +203,91 @@ class MultiExpertMixin:
                 if isinstance(child, ExpertContainer) and len(child.experts) > 0:
                     setattr(module, c_name, child.layer)
 
+        self._invalidate_experts_containers()
         self.selector_cache.clear()
         self.experts_infos.clear()
 
-    def add_experts_from_library(self, library):
-        import concurrent.futures
-
+    def reserve_experts(self, n_experts: int):
+        """Preallocates the containers and selectors of the model for `n_experts` experts
+        in total, so that adding them does not repeatedly grow their tensors."""
+        for container in self.experts_containers:
+            container.reserve(n_experts)
+        for selectors in self.selectors.values():
+            for selector in selectors:
+                selector.reserve(n_experts)
+
+    def add_experts_from_library(
+        self, library, max_concurrency: int = 16, skip_failed: bool = False
+    ) -> Dict[str, Exception]:
+        """Adds the experts of the library to the model, in three stages running concurrently:
+        the experts are downloaded and decoded in parallel, their weights are converted to the
+        device and dtype of the adapters in parallel, and a single writer adds them to the
+        containers.
+
+        Failures are reported per expert, the other experts are still added. A ValueError
+        listing the failed experts is then raised, unless `skip_failed` is set, in which
+        case the failures are returned.
+        """
         import tqdm
 
-        def add_module(self, module_name):
-            expert_dump = library[module_name]
-            self.add_expert_instance(expert_dump)
-
-        with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
-            # Create a list to hold the futures
-            futures = []
-            for element in library.keys():
-                futures.append(executor.submit(partial(add_module, self), element))
-
-            # Progress bar setup
-            with tqdm.tqdm(
-                total=len(library), desc="Adding experts...", unit="expert"
-            ) as progress_bar:
-                for result in concurrent.futures.as_completed(futures):
-                    # raise exception
-                    if result.exception():
-                        raise result.exception()
-                    progress_bar.update(1)
+        n_experts = len(self.experts_names) + len(library)
+        self.reserve_experts(n_experts)
+
+        # adapters are created on the device of the model, in the default dtype
+        device = next(self.model.parameters()).device
+        dtype = torch.get_default_dtype()
+        failed = {}
+
+        def _on_error(expert_name, error):
+            logger.error(f"Failed to load expert {expert_name}: {error!r}")
+            failed[expert_name] = error
+            progress_bar.update(1)
+
+        def _converted_experts():
+            with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+                converting = {}
+                for expert in library.prefetch(
+                    library.keys(), max_concurrency=max_concurrency, on_error=_on_error
+                ):
+                    future = executor.submit(
+                        _convert_expert_weights, expert, device, dtype
+                    )
+                    converting[future] = expert.name
+
+                    for future in [future for future in converting if future.done()]:
+                        yield converting.pop(future), future
+
+                for future in as_completed(list(converting)):
+                    yield converting.pop(future), future
+
+        def _experts():
+            n_added = 0
+            for expert_name, future in _converted_experts():
+                try:
+                    expert = future.result()
+                except Exception as error:
+                    _on_error(expert_name, error)
+                    continue
+
+                yield expert
+                n_added += 1
+                if n_added == 1:
+                    # containers are created with the first expert
+                    self._invalidate_experts_containers()
+                    self.reserve_experts(n_experts)
+                progress_bar.set_postfix_str(expert_name, refresh=False)
+                progress_bar.update(1)
+
+        with tqdm.tqdm(
+            total=len(library), desc="Adding experts...", unit="expert"
+        ) as progress_bar:
+            self.add_expert_instances(_experts())
+
+        if failed and not skip_failed:
+            raise ValueError(
+                f"Failed to load {len(failed)} experts: {', '.join(sorted(failed))}"
+            )
+        return failed
 
     def add_experts_from_dict(self, experts_dict, action="route"):
         for expert_name, expert_dump in experts_dict.items():
@@ -300,6 +378,7 @@ class MultiExpertMixin:
                 selector_config=selector_config,
                 selector_cache=self.selector_cache,
             )
+            self._invalidate_experts_containers()
 
             if action != "merge":
                 self.experts_infos[expert_instance.name] = expert_instance.expert_info
@@ -307,6 +386,40 @@ class MultiExpertMixin:
                 expert_instance = self.get_expert_instance(expert_instance.name)
             return expert_instance
 
+    def add_expert_instances(
+        self,
+        expert_instances: Iterable[Expert],
+        action="route",
+        default_expert_name=None,
+    ) -> List[str]:
+        """
+        Adds many experts at once, see `add_experts_to_transformer`. Much faster than calling
+        `add_expert_instance` for each of them when there are many experts.
+        """
+        expert_infos = {}
+
+        def _experts():
+            for expert_instance in expert_instances:
+                expert_infos[expert_instance.name] = expert_instance.expert_info
+                yield expert_instance
+
+        with self.lock:
+            try:
+                expert_names = add_experts_to_transformer(
+                    self.model,
+                    _experts(),
+                    action=action,
+                    default_expert_name=default_expert_name,
+                    selector_config=self.selector_config or None,
+                    selector_cache=self.selector_cache,
+                )
+            finally:
+                self._invalidate_experts_containers()
+
+            if action != "merge":
+                self.experts_infos.update(expert_infos)
+            return expert_names
+
     def set_selector(
         self,
         modifier_name: str,
@@ -415,6 +528,7 @@ class MultiExpertMixin:
                 if isinstance(c, ExpertContainer):
                     setattr(m, cn, c.layer)
 
+        self._invalidate_experts_containers()
         self.experts_infos.clear()
         self.selector_cache.clear()
         self.selector_config = None
@@ -475,12 +589,16 @@ class MultiExpertModel(BaseExpertModel, MultiExpertMixin):
         super().__init__(config, **loading_kwargs)
 
         if self.config.expert_infos is not None:
-            for expert_info in self.config.expert_infos:
-                expert_info: ExpertInfo
-                self.add_empty_expert(
-                    expert_info.expert_name,
-                    expert_info.expert_config,
+            self.add_expert_instances(
+                Expert(
+                    expert_info=ExpertInfo(
+                        expert_info.expert_name,
+                        expert_config=expert_info.expert_config,
+                        expert_model=self.config.base_model,
+                    )
                 )
+                for expert_info in self.config.expert_infos
+            )
 
             if self.config.default_expert_name:
                 self.set_default_expert(self.config.default_expert_name)
@@ -1,15 +1,25 @@
 import asyncio
+import base64
+import contextvars
 import datetime
 import glob
+import hashlib
+import io
 import logging
 import os
+import queue
+import threading
 from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import asynccontextmanager
 from fnmatch import fnmatch
 from pathlib import Path
-from typing import List, Optional, Tuple, Union
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
+from azure.core import MatchConditions
 from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
-from azure.storage.blob import BlobServiceClient
+from azure.storage.blob import BlobServiceClient, ContentSettings
 from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
 from huggingface_hub import (
     CommitOperationAdd,
@@ -72,6 +82,52 @@ class BackendEngine(ABC):
     def list_repo_files(self, repo_id):
         raise NotImplementedError
 
+    def download_files(
+        self,
+        repo_id,
+        filenames: List[str],
+        max_concurrency: int = 8,
+        max_bytes_in_flight: Optional[int] = None,
+        sizes: Optional[Dict[str, int]] = None,
+        return_exceptions: bool = False,
+    ) -> Iterator[Tuple[str, Union[str, Exception]]]:
+        """Downloads files concurrently, yields `(filename, local_path)` in completion order.
+
+        If `max_bytes_in_flight` is provided, a download is only started if the running
+        downloads do not exceed it. Sizes are read from `sizes`, unknown sizes count as 0.
+        If `return_exceptions` is True, failed downloads yield `(filename, exception)` instead
+        of raising, and the other downloads go on.
+        """
+        sizes = sizes or {}
+        to_download = deque(filenames)
+        running, in_flight = {}, 0
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            while to_download or running:
+                while (
+                    to_download
+                    and len(running) < max_concurrency
+                    and (
+                        not running
+                        or max_bytes_in_flight is None
+                        or in_flight + sizes.get(to_download[0], 0)
+                        <= max_bytes_in_flight
+                    )
+                ):
+                    filename = to_download.popleft()
+                    in_flight += sizes.get(filename, 0)
+                    future = executor.submit(self.hf_hub_download, repo_id, filename)
+                    running[future] = filename
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    filename = running.pop(future)
+                    in_flight -= sizes.get(filename, 0)
+                    if return_exceptions and future.exception() is not None:
+                        yield filename, future.exception()
+                    else:
+                        yield filename, future.result()
+
 
 class HuggingfaceHubEngine(BackendEngine):
     def snapshot_download(self, repo_id, allow_patterns=None):
@@ -106,13 +162,30 @@ class HuggingfaceHubEngine(BackendEngine):
         return HfApi().list_repo_files(repo_id)
 
 
+# pool of async clients shared by the transfers of the running batch operation
+_blob_client_pool = contextvars.ContextVar("blob_client_pool", default=None)
+
+
 class BlobStorageEngine(BackendEngine):
-    def __init__(self, token: Optional[str] = None, cache_dir: Optional[str] = None):
+    def __init__(
+        self,
+        token: Optional[str] = None,
+        cache_dir: Optional[str] = None,
+        max_concurrency: Optional[int] = None,
+        block_size: int = 8 * 1024 * 1024,
+        max_block_concurrency: int = 4,
+    ):
         """Initialize the blob storage engine. The cache directory can be
         provided as an argument or through the environment variable BLOB_CACHE_DIR.
         If no cache directory is provided, the default cache directory ~/.cache/mttl is used.
         You can provide a SAS Token as an argument when login or set the environment variable BLOB_SAS_TOKEN.
 
+        Transfers of a batch operation share one client per storage account, at most
+        `max_concurrency` of them run at the same time (environment variable BLOB_MAX_CONCURRENCY,
+        16 by default). Blobs larger than `block_size` are transferred in blocks, up to
+        `max_block_concurrency` blocks of a blob in parallel. Interrupted transfers of large
+        blobs are resumed, and blob contents are verified against their MD5.
+
         IMPORTANT: Some special characters such as underscore "_" are not allowed in the repo_id.
         Please use dashes "-" instead. For more information on the naming recommendation, see:
         https://learn.microsoft.com/en-us/rest/api/storageservices/naming-and-referencing-containers--blobs--and-metadata
@@ -120,6 +193,13 @@ class BlobStorageEngine(BackendEngine):
         super().__init__()
         self._token: str = token
         self.cache_dir = cache_dir
+        self.max_concurrency = max_concurrency or int(
+            os.environ.get("BLOB_MAX_CONCURRENCY", 16)
+        )
+        self.block_size = block_size
+        self.max_block_concurrency = max_block_concurrency
+        self._service_clients = {}
+        self._service_clients_lock = threading.Lock()
         # Quiet down the azure logging
         logging.getLogger("azure").setLevel(logging.WARNING)
 
@@ -133,8 +213,8 @@ class BlobStorageEngine(BackendEngine):
         Use the default cache directory ~/.cache/mttl if not provided."""
         if _cache_dir is not None:
             self._cache_dir = Path(_cache_dir)
-        if "BLOB_CACHE_DIR" in os.environ:
-            self._cache_dir = os.environ["BLOB_CACHE_DIR"]
+        elif "BLOB_CACHE_DIR" in os.environ:
+            self._cache_dir = Path(os.environ["BLOB_CACHE_DIR"])
         else:
             self._cache_dir = Path.home() / ".cache" / "mttl"
 
@@ -159,7 +239,7 @@ class BlobStorageEngine(BackendEngine):
         """Get the last modified date of a repository."""
         try:
             connection_string, container = self._parse_repo_id_to_storage_info(repo_id)
-            container_client = BlobServiceClient(
+            container_client = self._get_service_client(
                 connection_string
             ).get_container_client(container)
             return container_client.get_container_properties().last_modified
@@ -179,6 +259,46 @@ class BlobStorageEngine(BackendEngine):
         repo_cache_dir = self.get_repository_cache_dir(repo_id)
         return repo_cache_dir / filename
 
+    def _get_service_client(self, connection_string) -> BlobServiceClient:
+        """Synchronous client of the storage account, reused by all the calls."""
+        with self._service_clients_lock:
+            if connection_string not in self._service_clients:
+                self._service_clients[connection_string] = BlobServiceClient(
+                    connection_string
+                )
+            return self._service_clients[connection_string]
+
+    @asynccontextmanager
+    async def _client_pool(self):
+        """Shares one async client per storage account and a concurrency limit between the
+        transfers started in this context, i.e. the blobs of a batch operation."""
+        if _blob_client_pool.get() is not None:
+            # nested in a running batch operation
+            yield _blob_client_pool.get()
+            return
+
+        pool = {"clients": {}, "semaphore": asyncio.Semaphore(self.max_concurrency)}
+        token = _blob_client_pool.set(pool)
+        try:
+            yield pool
+        finally:
+            _blob_client_pool.reset(token)
+            for client in pool["clients"].values():
+                await client.close()
+
+    @asynccontextmanager
+    async def _async_service_client(self, repo_id):
+        """Yields the pooled async client of the storage account of `repo_id` and its
+        container, while holding one of the `max_concurrency` transfer slots."""
+        connection_string, container = self._parse_repo_id_to_storage_info(repo_id)
+        async with self._client_pool() as pool:
+            if connection_string not in pool["clients"]:
+                pool["clients"][connection_string] = AsyncBlobServiceClient(
+                    connection_string
+                )
+            async with pool["semaphore"]:
+                yield pool["clients"][connection_string], container
+
     def _parse_repo_id_to_storage_info(self, repo_id: str) -> Tuple[str, str]:
         """Extracts storage account and container from repo_id.
         Returns the container and its connection string (with SAS token)."""
@@ -221,7 +341,7 @@ class BlobStorageEngine(BackendEngine):
         """Creates a new repository. repo_type and private are ignored for blob storage."""
         try:
             connection_string, container = self._parse_repo_id_to_storage_info(repo_id)
-            BlobServiceClient(connection_string).create_container(name=container)
+            self._get_service_client(connection_string).create_container(name=container)
         except ResourceExistsError as error:
             error_message = "A container with this name already exists"
             if exist_ok:
@@ -232,9 +352,9 @@ class BlobStorageEngine(BackendEngine):
     def delete_repo(self, repo_id, repo_type=None):
         """Deletes a repository."""
         connection_string, container = self._parse_repo_id_to_storage_info(repo_id)
-        container_client = BlobServiceClient(connection_string).get_container_client(
-            container=container
-        )
+        container_client = self._get_service_client(
+            connection_string
+        ).get_container_client(container=container)
         try:
             container_client.delete_container()
         except ResourceNotFoundError:
@@ -246,6 +366,10 @@ class BlobStorageEngine(BackendEngine):
         )
 
     async def async_create_commit(self, repo_id, operations, async_mode=False):
+        async with self._client_pool():
+            await self._async_create_commit(repo_id, operations, async_mode=async_mode)
+
+    async def _async_create_commit(self, repo_id, operations, async_mode=False):
         tasks = []
         for op in operations:
             if isinstance(op, CommitOperationAdd):
@@ -288,6 +412,68 @@ class BlobStorageEngine(BackendEngine):
         local_filename = asyncio.run(self.async_download_blobs(repo_id, filename))
         return str(local_filename)
 
+    def download_files(
+        self,
+        repo_id,
+        filenames: List[str],
+        max_concurrency: int = 8,
+        max_bytes_in_flight: Optional[int] = None,
+        sizes: Optional[Dict[str, int]] = None,
+        return_exceptions: bool = False,
+    ) -> Iterator[Tuple[str, Union[str, Exception]]]:
+        """Downloads files concurrently through a single client, yields `(filename, local_path)`
+        in completion order. The event loop runs in a separate thread so that the caller can
+        process the files while the other downloads are running.
+        """
+        sizes = sizes or {}
+        completed = queue.Queue()
+
+        async def _download_all():
+            semaphore = asyncio.Semaphore(max_concurrency)
+            budget = asyncio.Condition()
+            in_flight = 0
+
+            async def _download(filename):
+                nonlocal in_flight
+
+                size = sizes.get(filename, 0)
+                async with semaphore:
+                    async with budget:
+                        await budget.wait_for(
+                            lambda: in_flight == 0
+                            or max_bytes_in_flight is None
+                            or in_flight + size <= max_bytes_in_flight
+                        )
+                        in_flight += size
+                    try:
+                        local_filename = await self._async_download_blob(
+                            repo_id, filename
+                        )
+                        completed.put((filename, str(local_filename), None))
+                    except Exception as error:
+                        completed.put((filename, None, error))
+                    finally:
+                        async with budget:
+                            in_flight -= size
+                            budget.notify_all()
+
+            async with self._client_pool():
+                await asyncio.gather(*[_download(f) for f in filenames])
+
+        thread = threading.Thread(target=asyncio.run, args=(_download_all(),))
+        thread.start()
+        try:
+            for _ in range(len(filenames)):
+                filename, local_filename, error = completed.get()
+                if error is not None:
+                    if not return_exceptions:
+                        raise error
+                    yield filename, error
+                else:
+                    yield filename, local_filename
+        finally:
+            thread.join()
+
     def repo_info(self, repo_id):
         class RepoInfo:
             pass
@@ -302,7 +488,7 @@ class BlobStorageEngine(BackendEngine):
         """List all files in a repository. The files might not be downloaded locally."""
         try:
             connection_string, container = self._parse_repo_id_to_storage_info(repo_id)
-            container_client = BlobServiceClient(
+            container_client = self._get_service_client(
                 connection_string
             ).get_container_client(container)
             return [b.name for b in container_client.list_blobs()]
@@ -333,9 +519,7 @@ class BlobStorageEngine(BackendEngine):
                 with open(content, "rb") as f:
                     buffers.append(f.read())
 
-        await asyncio.gather(
-            self.async_upload_blobs(repo_id, relative_file_paths, buffers)
-        )
+        await self.async_upload_blobs(repo_id, relative_file_paths, buffers)
         return folder
 
     async def async_upload_blobs(
@@ -353,25 +537,95 @@ class BlobStorageEngine(BackendEngine):
         else:
             if len(buffers) != len(filenames):
                 raise ValueError("Filenames and buffers must have the same length.")
-        tasks = [
-            self._async_upload_blob(repo_id, filename, buffer, overwrite)
-            for filename, buffer in zip(filenames, buffers)
-        ]
-        await asyncio.gather(*tasks)
+        async with self._client_pool():
+            tasks = [
+                self._async_upload_blob(repo_id, filename, buffer, overwrite)
+                for filename, buffer in zip(filenames, buffers)
+            ]
+            await asyncio.gather(*tasks)
         return filenames[0] if is_str else filenames
 
+    def _read_buffer(self, repo_id, filename, buffer=None) -> bytes:
+        """Content to upload, `buffer` is either the data or a path to a local file."""
+        if buffer is None:
+            buffer = self._get_local_filepath(repo_id, filename)
+        if isinstance(buffer, (str, Path)):
+            with open(file=buffer, mode="rb") as blob_file:
+                return blob_file.read()
+        if isinstance(buffer, (bytes, bytearray, memoryview)):
+            return bytes(buffer)
+        return buffer.read()
+
     async def _async_upload_blob(self, repo_id, filename, buffer=None, overwrite=False):
-        connection_string, container = self._parse_repo_id_to_storage_info(repo_id)
-        async with AsyncBlobServiceClient(connection_string) as blob_service_client:
+        data = self._read_buffer(repo_id, filename, buffer)
+        content_settings = ContentSettings(
+            content_md5=bytearray(hashlib.md5(data).digest())
+        )
+
+        async with self._async_service_client(repo_id) as (
+            blob_service_client,
+            container,
+        ):
             blob_client = blob_service_client.get_blob_client(
                 container=container, blob=filename
             )
-            if buffer is not None:
-                await blob_client.upload_blob(buffer, overwrite=overwrite)
+            if len(data) <= self.block_size:
+                await blob_client.upload_blob(
+                    data,
+                    overwrite=overwrite,
+                    content_settings=content_settings,
+                    validate_content=True,
+                )
             else:
-                local_cache = self._get_local_filepath(repo_id, filename)
-                with open(file=local_cache, mode="rb") as blob_file:
-                    await blob_client.upload_blob(blob_file, overwrite=overwrite)
+                await self._async_upload_blocks(
+                    blob_client, data, content_settings, overwrite=overwrite
+                )
+
+    async def _async_upload_blocks(
+        self, blob_client, data: bytes, content_settings, overwrite=False
+    ):
+        """Uploads the data in blocks, in parallel. Blocks are identified by their content,
+        so that the blocks staged by an interrupted upload of the same data are not uploaded again.
+        """
+        blocks = {}
+        for index, offset in enumerate(range(0, len(data), self.block_size)):
+            chunk = data[offset : offset + self.block_size]
+            block_id = f"{index:06d}-{hashlib.md5(chunk).hexdigest()}"
+            blocks[base64.b64encode(block_id.encode()).decode()] = chunk
+
+        try:
+            _, uncommitted = await blob_client.get_block_list("uncommitted")
+            staged = {block.id for block in uncommitted}
+        except ResourceNotFoundError:
+            staged = set()
+        if staged:
+            logger.info(
+                f"Resuming upload of {blob_client.blob_name}, "
+                f"{len(staged & set(blocks))}/{len(blocks)} blocks already uploaded."
+            )
+
+        semaphore = asyncio.Semaphore(self.max_block_concurrency)
+
+        async def _stage_block(block_id, chunk):
+            async with semaphore:
+                await blob_client.stage_block(block_id, chunk, validate_content=True)
+
+        await asyncio.gather(
+            *[
+                _stage_block(block_id, chunk)
+                for block_id, chunk in blocks.items()
+                if block_id not in staged
+            ]
+        )
+
+        conditions = (
+            {}
+            if overwrite
+            else {"etag": "*", "match_condition": MatchConditions.IfMissing}
+        )
+        await blob_client.commit_block_list(
+            list(blocks), content_settings=content_settings, **conditions
+        )
 
     async def async_download_blobs(
         self, repo_id: str, filesnames: Union[List[str], str]
@@ -379,25 +633,63 @@ class BlobStorageEngine(BackendEngine):
         is_str = isinstance(filesnames, str)
         if is_str:
             filesnames = [filesnames]
-        tasks = [
-            self._async_download_blob(repo_id, filename) for filename in filesnames
-        ]
-        local_filenames = await asyncio.gather(*tasks)
+        async with self._client_pool():
+            tasks = [
+                self._async_download_blob(repo_id, filename) for filename in filesnames
+            ]
+            local_filenames = await asyncio.gather(*tasks)
         return local_filenames[0] if is_str else local_filenames
 
     async def _async_download_blob(self, repo_id, filename):
-        connection_string, container = self._parse_repo_id_to_storage_info(repo_id)
-        async with AsyncBlobServiceClient(connection_string) as blob_service_client:
+        """Downloads the blob to the local cache. The data is written to a `.part` file first,
+        an interrupted download is resumed from it if the blob was not modified in the meantime.
+        """
+        local_filename = self._get_local_filepath(repo_id, filename)
+        partial_filename = f"{local_filename}.part"
+        os.makedirs(os.path.dirname(local_filename), exist_ok=True)
+
+        async with self._async_service_client(repo_id) as (
+            blob_service_client,
+            container,
+        ):
             blob_client = blob_service_client.get_blob_client(
                 container=container, blob=filename
             )
-            local_filename = self._get_local_filepath(repo_id, filename)
-            os.makedirs(os.path.dirname(local_filename), exist_ok=True)
-            with open(file=local_filename, mode="wb") as blob_file:
-                download_stream = await blob_client.download_blob()
-                data = await download_stream.readall()
-                blob_file.write(data)
-            return local_filename
+            properties = await blob_client.get_blob_properties()
+
+            offset = 0
+            if os.path.exists(partial_filename):
+                offset = os.path.getsize(partial_filename)
+                if offset > properties.size:
+                    offset = 0
+                elif offset > 0:
+                    logger.info(
+                        f"Resuming download of {filename} from byte {offset}/{properties.size}."
+                    )
+
+            with open(partial_filename, mode="ab" if offset else "wb") as blob_file:
+                if offset < properties.size:
+                    download_stream = await blob_client.download_blob(
+                        offset=offset,
+                        length=properties.size - offset,
+                        max_concurrency=self.max_block_concurrency,
+                        etag=properties.etag,
+                        match_condition=MatchConditions.IfNotModified,
+                    )
+                    await download_stream.readinto(blob_file)
+
+        content_md5 = properties.content_settings.content_md5
+        if content_md5:
+            md5 = hashlib.md5()
+            with open(partial_filename, mode="rb") as blob_file:
+                for chunk in iter(lambda: blob_file.read(self.block_size), b""):
+                    md5.update(chunk)
+            if md5.digest() != bytes(content_md5):
+                os.remove(partial_filename)
+                raise ValueError(f"MD5 mismatch for blob {filename} of {repo_id}.")
+
+        os.replace(partial_filename, local_filename)
+        return local_filename
 
     async def async_copy_blobs(
         self,
@@ -420,19 +712,20 @@ class BlobStorageEngine(BackendEngine):
         if not all(len(i) == len(inputs[0]) for i in inputs):
             raise ValueError("All lists must have the same length.")
 
-        tasks = [
-            self._async_copy_blob(
-                source_repo_id,
-                source_filename,
-                destination_repo_id,
-                destination_filename,
-                overwrite=overwrite,
-            )
-            for source_repo_id, source_filename, destination_repo_id, destination_filename in zip(
-                inputs[0], inputs[1], inputs[2], inputs[3]
-            )
-        ]
-        await asyncio.gather(*tasks)
+        async with self._client_pool():
+            tasks = [
+                self._async_copy_blob(
+                    source_repo_id,
+                    source_filename,
+                    destination_repo_id,
+                    destination_filename,
+                    overwrite=overwrite,
+                )
+                for source_repo_id, source_filename, destination_repo_id, destination_filename in zip(
+                    inputs[0], inputs[1], inputs[2], inputs[3]
+                )
+            ]
+            await asyncio.gather(*tasks)
 
     async def _async_copy_blob(
         self,
@@ -442,13 +735,10 @@ class BlobStorageEngine(BackendEngine):
         destination_filename,
         overwrite=True,
     ):
-        (
-            source_connection_string,
+        async with self._async_service_client(source_repo_id) as (
+            blob_service_client,
             source_container,
-        ) = self._parse_repo_id_to_storage_info(source_repo_id)
-        async with AsyncBlobServiceClient(
-            source_connection_string
-        ) as blob_service_client:
+        ):
             source_blob_client = blob_service_client.get_blob_client(
                 container=source_container, blob=source_filename
             )
@@ -465,12 +755,17 @@ class BlobStorageEngine(BackendEngine):
     async def async_delete_blobs(self, repo_id: str, filesnames: Union[List[str], str]):
         if isinstance(filesnames, str):
             filesnames = [filesnames]
-        tasks = [self._async_delete_blob(repo_id, filename) for filename in filesnames]
-        await asyncio.gather(*tasks)
+        async with self._client_pool():
+            tasks = [
+                self._async_delete_blob(repo_id, filename) for filename in filesnames
+            ]
+            await asyncio.gather(*tasks)
 
     async def _async_delete_blob(self, repo_id, filename):
-        connection_string, container = self._parse_repo_id_to_storage_info(repo_id)
-        async with AsyncBlobServiceClient(connection_string) as blob_service_client:
+        async with self._async_service_client(repo_id) as (
+            blob_service_client,
+            container,
+        ):
             blob_client = blob_service_client.get_blob_client(
                 container=container, blob=filename
             )
@@ -492,15 +787,18 @@ class LocalFSEngine(BackendEngine):
     def create_commit(self, repo_id, operations, commit_message):
         for op in operations:
             if type(op) == CommitOperationAdd:
-                with open(os.path.join(repo_id, op.path_in_repo), "wb") as f:
+                # write to a temporary file first, readers never see partial files
+                path = os.path.join(repo_id, op.path_in_repo)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + ".tmp", "wb") as f:
                     f.write(op.path_or_fileobj.read())
+                os.replace(path + ".tmp", path)
             elif type(op) == CommitOperationCopy:
                 import shutil
 
-                shutil.copyfile(
-                    os.path.join(repo_id, op.src_path_in_repo),
-                    os.path.join(repo_id, op.path_in_repo),
-                )
+                path = os.path.join(repo_id, op.path_in_repo)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                shutil.copyfile(os.path.join(repo_id, op.src_path_in_repo), path)
             elif type(op) == CommitOperationDelete:
                 os.remove(os.path.join(repo_id, op.path_in_repo))
 
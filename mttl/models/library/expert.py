@@ -92,6 +92,15 @@ class Expert:
     def expert_weights(self, weights):
         self._expert_weights = weights
 
+    def with_weights(self, expert_weights: Dict[str, torch.Tensor]) -> "Expert":
+        """Returns an expert sharing the info of this one, holding `expert_weights`,
+        e.g. the subset of its weights that goes to a given layer."""
+        expert = Expert(expert_info=self.expert_info, expert_weights=expert_weights)
+        if self._tied_expert_weights is not None:
+            # a subset of tied weights, no need to tie them again
+            expert._tied_expert_weights = expert_weights
+        return expert
+
     def clone(self):
         import copy
 
@@ -0,0 +1,133 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional
+
+import torch
+
+from mttl.logging import logger
+
+
+def _weights_nbytes(expert_weights: Dict[str, torch.Tensor]) -> int:
+    """Bytes held by the tensors of the expert, tied tensors are counted once."""
+    storages, nbytes = set(), 0
+    for weight in expert_weights.values():
+        if not isinstance(weight, torch.Tensor):
+            continue
+        storage = weight.untyped_storage()
+        if storage.data_ptr() in storages:
+            continue
+        storages.add(storage.data_ptr())
+        nbytes += storage.nbytes()
+    return nbytes
+
+
+class ExpertCache:
+    """LRU cache of decoded expert weights, bounded by the number of bytes of the cached tensors.
+
+    Entries are keyed by (repository, expert name, content hash). Lookups return a new dict
+    with the cached tensors, which must not be modified in place.
+    """
+
+    def __init__(self, max_bytes: int = 0, pin_memory: bool = False):
+        self.max_bytes = max_bytes
+        self.pin_memory = pin_memory
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def configure(self, max_bytes: int = None, pin_memory: bool = None):
+        with self._lock:
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            if pin_memory is not None:
+                self.pin_memory = pin_memory
+            self._evict()
+
+    def get(self, key: Hashable) -> Optional[Dict[str, torch.Tensor]]:
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(entry[0])
+
+    def put(self, key: Hashable, expert_weights: Dict[str, torch.Tensor]):
+        if not self.enabled:
+            return
+
+        nbytes = _weights_nbytes(expert_weights)
+        if nbytes > self.max_bytes:
+            logger.debug(f"Expert {key} is larger than the cache, not caching it.")
+            return
+
+        expert_weights = dict(expert_weights)
+        if self.pin_memory and torch.cuda.is_available():
+            expert_weights = {
+                name: (
+                    weight.pin_memory()
+                    if isinstance(weight, torch.Tensor) and weight.device.type == "cpu"
+                    else weight
+                )
+                for name, weight in expert_weights.items()
+            }
+
+        with self._lock:
+            if key in self._entries:
+                self._nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (expert_weights, nbytes)
+            self._nbytes += nbytes
+            self._evict()
+
+    def _evict(self):
+        while self._entries and self._nbytes > self.max_bytes:
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self._nbytes -= nbytes
+            self.evictions += 1
+
+    def invalidate(self, repo: Hashable, expert_name: str = None):
+        """Drops the cached experts of a repository, or only those named `expert_name`."""
+        with self._lock:
+            for key in list(self._entries):
+                if key[0] == repo and (expert_name is None or key[1] == expert_name):
+                    self._nbytes -= self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self._nbytes,
+        }
+
+
+# process-wide cache shared by all the libraries, set EXPERT_CACHE_MAX_BYTES=0 to disable it
+expert_cache = ExpertCache(
+    max_bytes=int(os.environ.get("EXPERT_CACHE_MAX_BYTES", 2**30)),
+    pin_memory=os.environ.get("EXPERT_CACHE_PIN_MEMORY", "0") == "1",
+)
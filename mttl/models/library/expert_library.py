@@ -1,11 +1,25 @@
 import glob
+import hashlib
 import io
+import json
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from contextlib import contextmanager
 from dataclasses import dataclass, replace
 from functools import total_ordering
-from typing import Any, Dict, List, Optional, Tuple, Type, Union
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    Union,
+)
 
 import numpy as np
 import torch
@@ -15,6 +29,9 @@ from huggingface_hub import (
     CommitOperationDelete,
 )
 from huggingface_hub.utils._errors import RepositoryNotFoundError
+from safetensors import safe_open
+from safetensors.torch import load_file as load_safetensors
+from safetensors.torch import save as save_safetensors
 
 from mttl.logging import logger
 from mttl.models.library.backend_engine import (
@@ -23,6 +40,7 @@ from mttl.models.library.backend_engine import (
     LocalFSEngine,
 )
 from mttl.models.library.expert import Expert, ExpertInfo, load_expert
+from mttl.models.library.expert_cache import expert_cache
 
 
 @total_ordering
@@ -60,9 +78,95 @@ class Score:
         return self.value == other.value
 
 
+# on-disk formats for the expert weights, also used as file extensions
+CKPT_FORMAT = "ckpt"
+SAFETENSORS_FORMAT = "safetensors"
+WEIGHTS_FORMATS = (CKPT_FORMAT, SAFETENSORS_FORMAT)
+
+# single file indexing the metadata of all the experts in the library, so that
+# the library can be loaded without downloading every `.meta` file
+LIBRARY_INDEX_FILE = "library.index"
+LIBRARY_INDEX_VERSION = 1
+
+# directory of the content-addressed weights files, named after their hash
+OBJECTS_DIR = "objects"
+# safetensors metadata key listing the tensors stored once and shared by several names
+SAFETENSORS_ALIASES_KEY = "mttl_aliases"
+
+
 @dataclass
 class MetadataEntry(ExpertInfo):
     expert_deleted: bool = False
+    # format of the weights file, None for legacy libraries storing `.ckpt` files
+    weights_format: str = None
+    # sha256 and size in bytes of the weights file, None for experts uploaded by older versions
+    weights_hash: str = None
+    weights_size: int = None
+    # path of the weights file in the repository for content-addressed experts,
+    # None if the weights are stored under the name of the expert
+    weights_file: str = None
+
+
+def metadata_weights_file(metadata: MetadataEntry) -> str:
+    """Path of the file storing the weights of an expert, relative to the repository."""
+    if metadata.weights_file is not None:
+        return metadata.weights_file
+    return f"{metadata.expert_name}.{metadata.weights_format or CKPT_FORMAT}"
+
+
+def serialize_expert_weights(expert_weights, weights_format=CKPT_FORMAT) -> io.BytesIO:
+    """Serializes the expert weights in the given format into a buffer."""
+    buffer = io.BytesIO()
+
+    if weights_format == SAFETENSORS_FORMAT:
+        # safetensors refuses tensors sharing memory, e.g. tied lora weights: these are
+        # stored once, and the other names are recorded as aliases in the header
+        tensors, aliases, seen, storages = {}, {}, {}, set()
+        for name, tensor in expert_weights.items():
+            view = (
+                tensor.device,
+                tensor.data_ptr(),
+                tensor.dtype,
+                tuple(tensor.shape),
+                tensor.stride(),
+            )
+            if view in seen:
+                aliases[name] = seen[view]
+                continue
+            seen[view] = name
+
+            tensor = tensor.detach().cpu().contiguous()
+            if tensor.untyped_storage().data_ptr() in storages:
+                # overlaps with another tensor without being the same view
+                tensor = tensor.clone()
+            storages.add(tensor.untyped_storage().data_ptr())
+            tensors[name] = tensor
+        metadata = {SAFETENSORS_ALIASES_KEY: json.dumps(aliases)} if aliases else None
+        buffer.write(save_safetensors(tensors, metadata=metadata))
+    elif weights_format == CKPT_FORMAT:
+        torch.save(expert_weights, buffer)
+    else:
+        raise ValueError(f"Unknown weights format {weights_format}.")
+
+    buffer.flush()
+    buffer.seek(0)
+    return buffer
+
+
+def load_expert_weights(path: str) -> Dict[str, torch.Tensor]:
+    """Loads the expert weights from a local file.
+
+    Safetensors files are memory-mapped: tensors are not copied and pages are
+    only read from disk when the tensors are accessed.
+    """
+    if str(path).endswith(f".{SAFETENSORS_FORMAT}"):
+        expert_weights = load_safetensors(path, device="cpu")
+        with safe_open(path, framework="pt") as f:
+            aliases = (f.metadata() or {}).get(SAFETENSORS_ALIASES_KEY)
+        for name, source in json.loads(aliases or "{}").items():
+            expert_weights[name] = expert_weights[source]
+        return expert_weights
+    return torch.load(path, map_location="cpu", weights_only=True)
 
 
 class ExpertLibrary:
@@ -75,19 +179,35 @@ class ExpertLibrary:
         exclude_selection: Optional[List[str]] = None,
         create: bool = False,
         ignore_sliced: bool = False,
+        weights_format: str = CKPT_FORMAT,
+        content_addressed: bool = False,
     ):
         super().__init__()
 
+        if weights_format not in WEIGHTS_FORMATS:
+            raise ValueError(
+                f"Unknown weights format {weights_format}, expected one of {WEIGHTS_FORMATS}."
+            )
+
         self.protocol, self.repo_id = self._remove_protocol(repo_id)
         self._uri = repo_id
         self._sliced = False
         self.selection = selection
         self.exclude_selection = exclude_selection
         self.model_name = model_name
+        # format used when uploading new experts, reading supports all formats
+        self.weights_format = weights_format
+        # store new weights under their hash, so that identical weights are stored once and
+        # experts can be renamed or copied by writing their metadata only
+        self.content_addressed = content_addressed
         self._in_transaction = False
         self._pending_operations = []
         self._pending_pre_uploads = []
         self.data = {}
+        # metadata of all the experts in the repository, also deleted ones or
+        # those trained on other models, keyed by expert name
+        self._index_entries = {}
+        self._index_revision = 0
 
         self.ignore_sliced = ignore_sliced
 
@@ -125,10 +245,56 @@ class ExpertLibrary:
     def sliced(self):
         return self._sliced and not self.ignore_sliced
 
-    def _build_lib(self):
-        self._sliced = False
-        self.data = {}
+    def _list_metadata_files(self):
+        """Paths of the `.meta` files in the repository, relative to its root."""
+        if isinstance(self, LocalFSEngine):
+            files = glob.glob(f"{self.repo_id}/**/*.meta", recursive=True)
+            return {os.path.relpath(file, self.repo_id) for file in files}
+        return {
+            file
+            for file in self.list_repo_files(self.repo_id)
+            if file.endswith(".meta")
+        }
+
+    def _load_index(self) -> Optional[Dict[str, MetadataEntry]]:
+        """Reads the metadata of the experts from the library index.
+
+        Returns None if the index is missing, corrupted, or out of date w.r.t. the `.meta` files,
+        e.g. because they were written by an older version of the library.
+        """
+        try:
+            index = torch.load(
+                self.hf_hub_download(self.repo_id, filename=LIBRARY_INDEX_FILE),
+                map_location="cpu",
+                weights_only=False,
+            )
+        except Exception:
+            logger.info("No library index found in %s.", self.repo_id)
+            return None
 
+        if index.get("version") != LIBRARY_INDEX_VERSION:
+            logger.warning(
+                "Unsupported library index version %s, ignoring it.",
+                index.get("version"),
+            )
+            return None
+
+        entries = {
+            name: MetadataEntry.fromdict(metadatum)
+            for name, metadatum in index["entries"].items()
+        }
+        if {f"{name}.meta" for name in entries} != self._list_metadata_files():
+            logger.warning(
+                "Library index of %s is out of date, reading metadata files.",
+                self.repo_id,
+            )
+            return None
+
+        self._index_revision = index["revision"]
+        return entries
+
+    def _load_metadata_files(self) -> Dict[str, MetadataEntry]:
+        """Downloads and reads the `.meta` file of every expert in the repository."""
         try:
             metadata_dir = self.snapshot_download(
                 self.repo_id, allow_patterns=["**/*.meta", "*.meta"]
@@ -138,14 +304,25 @@ class ExpertLibrary:
                 logger.error("Repository not found: %s", self.repo_id)
             raise e
 
-        metadata = [
-            MetadataEntry.fromdict(
+        return {
+            os.path.relpath(file, metadata_dir)[
+                : -len(".meta")
+            ]: MetadataEntry.fromdict(
                 torch.load(file, map_location="cpu", weights_only=False)
             )
             for file in glob.glob(f"{metadata_dir}/**/*.meta", recursive=True)
-        ]
+        }
+
+    def _build_lib(self, use_index: bool = True):
+        self._sliced = False
+        self.data = {}
 
-        for metadatum in metadata:
+        entries = self._load_index() if use_index else None
+        if entries is None:
+            entries = self._load_metadata_files()
+        self._index_entries = entries
+
+        for metadatum in entries.values():
             if self.model_name is not None and metadatum.model != self.model_name:
                 self._sliced = True
                 continue
@@ -171,23 +348,85 @@ class ExpertLibrary:
             }
 
     def refresh_from_remote(self):
+        expert_cache.invalidate(self._cache_repo)
         self._build_lib()
 
+    def rebuild_index(self):
+        """Rebuilds the library index from the `.meta` files of the experts,
+        e.g. if the index got corrupted or was not updated by an older writer."""
+        self._build_lib(use_index=False)
+        self._update_index()
+
+    def _weights_file(self, expert_name, weights_format=None):
+        """Name of the file storing the weights of the expert in the repository."""
+        if weights_format is None:
+            return metadata_weights_file(self.data[expert_name])
+        return f"{expert_name}.{weights_format}"
+
+    def _is_weights_file_referenced(self, weights_file):
+        """Whether any expert of the repository, including deleted ones, uses the weights file."""
+        return any(
+            metadata_weights_file(metadata) == weights_file
+            for metadata in self._index_entries.values()
+        )
+
+    def _release_weights_file(self, weights_file):
+        """Deletes a weights file once no expert of the repository references it anymore."""
+        if self._is_weights_file_referenced(weights_file):
+            return
+
+        deletion = CommitOperationDelete(path_in_repo=weights_file)
+        if self._in_transaction:
+            self._pending_operations.append(deletion)
+        else:
+            self.create_commit(
+                self.repo_id,
+                operations=[deletion],
+                commit_message=f"Delete unreferenced weights {weights_file}.",
+            )
+
     def _download_model(self, model_name):
         if model_name not in self.data:
             raise ValueError(f"Model {model_name} not found in repository.")
 
-        model_file = f"{model_name}.ckpt"
+        model_file = self._weights_file(model_name)
         return self.hf_hub_download(self.repo_id, filename=model_file)
 
-    def _upload_weights(self, expert_name, expert_dump):
-        buffer = io.BytesIO()
-        torch.save(expert_dump.expert_weights, buffer)
-        buffer.flush()
+    @property
+    def _cache_repo(self):
+        return (self.protocol, self.repo_id)
+
+    def _upload_weights(self, metadata: MetadataEntry, expert_dump: Expert):
+        """Uploads the weights of the expert, and records in its metadata the format,
+        the hash, the size and the path of the uploaded file."""
+        expert_name = metadata.expert_name
+        weights_format = self.weights_format
+        if weights_format == SAFETENSORS_FORMAT and not all(
+            isinstance(v, torch.Tensor) for v in expert_dump.expert_weights.values()
+        ):
+            logger.warning(
+                f"Expert {expert_name} has non-tensor weights, storing it as {CKPT_FORMAT}."
+            )
+            weights_format = CKPT_FORMAT
+
+        buffer = serialize_expert_weights(expert_dump.expert_weights, weights_format)
+        weights_hash = hashlib.sha256(buffer.getbuffer()).hexdigest()
+        weights_size = buffer.getbuffer().nbytes
+
+        metadata.weights_format = weights_format
+        metadata.weights_hash = weights_hash
+        metadata.weights_size = weights_size
+        metadata.weights_file = None
+        if self.content_addressed:
+            metadata.weights_file = f"{OBJECTS_DIR}/{weights_hash}.{weights_format}"
+            if self._is_weights_file_referenced(metadata.weights_file):
+                logger.info(f"Weights of {expert_name} already in {self.repo_id}.")
+                return
 
         logger.info(f"Uploading expert to {self.repo_id}...")
         addition = CommitOperationAdd(
-            path_in_repo=f"{expert_name}.ckpt", path_or_fileobj=buffer
+            path_in_repo=metadata_weights_file(metadata),
+            path_or_fileobj=buffer,
         )
         if self._in_transaction:
             self._pending_pre_uploads.append(addition)
@@ -202,6 +441,8 @@ class ExpertLibrary:
             logger.info(f"Expert {expert_name} uploaded successfully.")
 
     def _upload_metadata(self, metadata):
+        self._index_entries[metadata.expert_name] = metadata
+
         buffer = io.BytesIO()
         torch.save(metadata.asdict(), buffer)
         buffer.flush()
@@ -246,15 +487,125 @@ class ExpertLibrary:
         if expert_name not in self.data:
             raise ValueError(f"Expert {expert_name} not found in repository.")
 
-        model = self._download_model(expert_name)
-        # Load the model from the downloaded file
-        model = torch.load(model, map_location="cpu", weights_only=True)
+        cache_key = self._cache_key(expert_name)
+        model = expert_cache.get(cache_key)
+        if model is None:
+            model = self._download_model(expert_name)
+            # Load the model from the downloaded file
+            model = load_expert_weights(model)
+            expert_cache.put(cache_key, model)
 
         return Expert(
             expert_info=self.data[expert_name],
             expert_weights=model,
         )
 
+    def _cache_key(self, expert_name):
+        return (self._cache_repo, expert_name, self.data[expert_name].weights_hash)
+
+    def prefetch(
+        self,
+        expert_names: Optional[Iterable[str]] = None,
+        max_concurrency: int = 8,
+        max_bytes_in_flight: Optional[int] = None,
+        on_error: Optional[Callable[[str, Exception], None]] = None,
+    ) -> Iterator[Expert]:
+        """Downloads the experts concurrently and decodes them on a pool of workers.
+
+        Experts are yielded in completion order, so that callers can process them while the
+        other experts are being downloaded. `max_bytes_in_flight` bounds the size of the running
+        downloads, it is ignored for experts uploaded without their size. If `on_error` is
+        provided, it is called with the name of each expert that fails to download or decode
+        and the exception, and the other experts are still yielded.
+        """
+        if self._in_transaction:
+            raise ValueError(
+                "Cannot access library while in transaction. Finish current commit!"
+            )
+
+        if expert_names is None:
+            expert_names = list(self.keys())
+        expert_names = list(dict.fromkeys(expert_names))
+        for expert_name in expert_names:
+            if expert_name not in self.data:
+                raise ValueError(f"Expert {expert_name} not found in repository.")
+
+        # several experts can share a weights file in a content-addressed library
+        weights_files = {}
+        for expert_name in expert_names:
+            model = expert_cache.get(self._cache_key(expert_name))
+            if model is not None:
+                yield Expert(expert_info=self.data[expert_name], expert_weights=model)
+            else:
+                weights_files.setdefault(self._weights_file(expert_name), []).append(
+                    expert_name
+                )
+
+        if not weights_files:
+            return
+
+        sizes = {
+            weights_file: self.data[names[0]].weights_size
+            for weights_file, names in weights_files.items()
+            if self.data[names[0]].weights_size is not None
+        }
+
+        def _load_experts(weights_file, local_path):
+            model = load_expert_weights(local_path)
+            experts = []
+            for expert_name in weights_files[weights_file]:
+                expert_cache.put(self._cache_key(expert_name), model)
+                experts.append(
+                    Expert(expert_info=self.data[expert_name], expert_weights=model)
+                )
+            return experts
+
+        def _results(weights_file, future):
+            try:
+                yield from future.result()
+            except Exception as error:
+                if on_error is None:
+                    raise
+                for expert_name in weights_files[weights_file]:
+                    on_error(expert_name, error)
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            loading = {}
+            for weights_file, local_path in self.download_files(
+                self.repo_id,
+                list(weights_files),
+                max_concurrency=max_concurrency,
+                max_bytes_in_flight=max_bytes_in_flight,
+                sizes=sizes,
+                return_exceptions=on_error is not None,
+            ):
+                if isinstance(local_path, Exception):
+                    for expert_name in weights_files[weights_file]:
+                        on_error(expert_name, local_path)
+                    continue
+
+                future = executor.submit(_load_experts, weights_file, local_path)
+                loading[future] = weights_file
+
+                # yield the experts decoded in the meantime
+                for future in [future for future in loading if future.done()]:
+                    yield from _results(loading.pop(future), future)
+
+            for future in as_completed(loading):
+                yield from _results(loading[future], future)
+
+    def get_many(
+        self, expert_names: Optional[Iterable[str]] = None, **prefetch_kwargs
+    ) -> Dict[str, Expert]:
+        """Loads several experts concurrently, see `prefetch`."""
+        if expert_names is None:
+            expert_names = list(self.keys())
+        experts = {
+            expert.name: expert
+            for expert in self.prefetch(expert_names, **prefetch_kwargs)
+        }
+        return {expert_name: experts[expert_name] for expert_name in expert_names}
+
     def __len__(self):
         return len(self.data)
 
@@ -280,10 +631,55 @@ class ExpertLibrary:
 
         # convert to metadata entry
         metadata = MetadataEntry.fromdict(expert_dump.expert_info.asdict())
+        previous = self._index_entries.get(metadata.expert_name)
 
-        self._upload_weights(metadata.expert_name, expert_dump)
+        self._upload_weights(metadata, expert_dump)
+        expert_cache.invalidate(self._cache_repo, metadata.expert_name)
         self._upload_metadata(metadata)
         self.data[metadata.expert_name] = metadata
+        if previous is not None:
+            # the overwritten expert might have been the last one using its weights
+            self._release_weights_file(metadata_weights_file(previous))
+        self._update_index()
+        self._update_readme()
+
+    def copy_expert(self, expert_name: str, new_name: str):
+        """Adds a copy of an expert under a new name, e.g. to fork it before training it further.
+
+        In content-addressed libraries the copy shares the weights file of the expert,
+        only its metadata is written.
+        """
+        if self.sliced:
+            raise ValueError("Cannot copy expert in sliced library.")
+
+        if expert_name not in self.data:
+            raise ValueError(f"Expert {expert_name} not found in repository.")
+
+        if new_name in self.data:
+            raise ValueError(f"Expert {new_name} already exists.")
+
+        if "." in new_name:
+            raise ValueError("Expert name cannot contain dots.")
+
+        metadata = replace(self.data[expert_name], expert_name=new_name)
+        if metadata.weights_file is None:
+            copy = CommitOperationCopy(
+                src_path_in_repo=self._weights_file(expert_name),
+                path_in_repo=metadata_weights_file(metadata),
+            )
+            if self._in_transaction:
+                self._pending_operations.append(copy)
+            else:
+                self.create_commit(
+                    self.repo_id,
+                    operations=[copy],
+                    commit_message=f"Copying expert {expert_name} to {new_name}.",
+                )
+
+        expert_cache.invalidate(self._cache_repo, new_name)
+        self._upload_metadata(metadata)
+        self.data[new_name] = metadata
+        self._update_index()
         self._update_readme()
 
     def list_auxiliary_data(self) -> Dict[str, Tuple[int, str]]:
@@ -423,6 +819,7 @@ class ExpertLibrary:
 
         self._upload_metadata(metadata)
         self.data[expert_name] = metadata
+        self._update_index()
 
     def remove_expert(self, expert_name: str, soft_delete: bool = True):
         """Remove an expert from the library.
@@ -436,16 +833,21 @@ class ExpertLibrary:
             raise ValueError(f"Expert {expert_name} not found in repository.")
 
         if not soft_delete:
-            deletion_a = CommitOperationDelete(path_in_repo=f"{expert_name}.ckpt")
-            deletion_b = CommitOperationDelete(path_in_repo=f"{expert_name}.meta")
+            weights_file = self._weights_file(expert_name)
+            self._index_entries.pop(expert_name, None)
+
+            deletions = [CommitOperationDelete(path_in_repo=f"{expert_name}.meta")]
+            # content-addressed weights might be shared with other experts
+            if not self._is_weights_file_referenced(weights_file):
+                deletions.insert(0, CommitOperationDelete(path_in_repo=weights_file))
 
             if self._in_transaction:
                 # watch out, if other operations (adding files) are pending, this might be dangerous
-                self._pending_operations.extend([deletion_a, deletion_b])
+                self._pending_operations.extend(deletions)
             else:
                 self.create_commit(
                     self.repo_id,
-                    operations=[deletion_a, deletion_b],
+                    operations=deletions,
                     commit_message=f"Update library with {expert_name}.",
                 )
                 logger.info(f"Deletion of {expert_name} successful.")
@@ -455,6 +857,8 @@ class ExpertLibrary:
             self._upload_metadata(metadata)
 
         metadata = self.data.pop(expert_name)
+        expert_cache.invalidate(self._cache_repo, expert_name)
+        self._update_index()
         self._update_readme()
 
     def get_score(self, expert_name: str, hash: str):
@@ -611,6 +1015,48 @@ class ExpertLibrary:
                 commit_message="Update readme.",
             )
 
+    def _update_index(self):
+        """Writes the metadata of all the experts to the library index, in the same
+        commit as the pending operations if in a transaction."""
+        # one revision per commit of the index
+        if not self._in_transaction or all(
+            operation.path_in_repo != LIBRARY_INDEX_FILE
+            for operation in self._pending_operations
+        ):
+            self._index_revision += 1
+
+        buffer = io.BytesIO()
+        torch.save(
+            {
+                "version": LIBRARY_INDEX_VERSION,
+                "revision": self._index_revision,
+                "entries": {
+                    name: metadata.asdict()
+                    for name, metadata in self._index_entries.items()
+                },
+            },
+            buffer,
+        )
+        buffer.flush()
+
+        addition = CommitOperationAdd(
+            path_in_repo=LIBRARY_INDEX_FILE, path_or_fileobj=buffer
+        )
+        if self._in_transaction:
+            # keep only the latest index, it is committed after the metadata files
+            self._pending_operations[:] = [
+                operation
+                for operation in self._pending_operations
+                if operation.path_in_repo != LIBRARY_INDEX_FILE
+            ]
+            self._pending_operations.append(addition)
+        else:
+            self.create_commit(
+                self.repo_id,
+                operations=[addition],
+                commit_message="Update library index.",
+            )
+
     @contextmanager
     def batched_commit(self):
         """Context manager batching operations into a single commit."""
@@ -657,17 +1103,25 @@ class ExpertLibrary:
             raise ValueError(f"Expert {new_name} already exists.")
 
         metadata = self.data[old_name]
+        old_weights_file = self._weights_file(old_name)
         metadata.expert_name = new_name
 
         self.data[new_name] = metadata
         self.data.pop(old_name)
-
-        meta_delete = CommitOperationDelete(path_in_repo=f"{old_name}.meta")
-        ckpt_copy = CommitOperationCopy(
-            src_path_in_repo=f"{old_name}.ckpt", path_in_repo=f"{new_name}.ckpt"
-        )
-        ckpt_delete = CommitOperationDelete(path_in_repo=f"{old_name}.ckpt")
-        ops = [meta_delete, ckpt_copy, ckpt_delete]
+        self._index_entries.pop(old_name, None)
+        expert_cache.invalidate(self._cache_repo, old_name)
+        expert_cache.invalidate(self._cache_repo, new_name)
+
+        ops = [CommitOperationDelete(path_in_repo=f"{old_name}.meta")]
+        if metadata.weights_file is None:
+            # the weights are stored under the name of the expert, content-addressed
+            # weights do not need to be moved
+            ckpt_copy = CommitOperationCopy(
+                src_path_in_repo=old_weights_file,
+                path_in_repo=self._weights_file(new_name),
+            )
+            ckpt_delete = CommitOperationDelete(path_in_repo=old_weights_file)
+            ops += [ckpt_copy, ckpt_delete]
 
         if self._in_transaction:
             self._pending_operations.extend(ops)
@@ -680,8 +1134,46 @@ class ExpertLibrary:
             logger.info(f"Expert {new_name} uploaded successfully.")
 
         self._upload_metadata(metadata)
+        self._update_index()
         self._update_readme()
 
+    def convert_weights_format(self, weights_format: str = SAFETENSORS_FORMAT):
+        """Rewrites the weights of all the experts in `weights_format`, e.g. to migrate
+        a library of legacy `.ckpt` files to memory-mappable safetensors files.
+
+        Each expert is converted in its own commit, so an interrupted conversion can be resumed.
+        """
+        if self.sliced:
+            raise ValueError("Cannot convert experts in sliced library.")
+
+        if weights_format not in WEIGHTS_FORMATS:
+            raise ValueError(f"Unknown weights format {weights_format}.")
+
+        self.weights_format = weights_format
+
+        converted = 0
+        for expert_name in list(self.keys()):
+            metadata = self.data[expert_name]
+            if (metadata.weights_format or CKPT_FORMAT) == weights_format:
+                continue
+
+            old_weights_file = self._weights_file(expert_name)
+            expert_dump = self[expert_name]
+
+            with self.batched_commit():
+                self._upload_weights(metadata, expert_dump)
+                expert_cache.invalidate(self._cache_repo, expert_name)
+                self._upload_metadata(metadata)
+                self._update_index()
+
+                # non-tensor weights might have been kept in the legacy format
+                if self._weights_file(expert_name) != old_weights_file:
+                    self._release_weights_file(old_weights_file)
+                    converted += 1
+
+        logger.info(f"Converted {converted} experts to {weights_format}.")
+        return converted
+
     @property
     def tasks(self):
         """
@@ -719,14 +1211,37 @@ class ExpertLibrary:
         force=False,
         upload_aux_data=False,
         only_tasks=None,
+        content_addressed=None,
     ):
-        new_lib = cls(repo_id=repo_id, create=True)
+        if content_addressed is None:
+            content_addressed = expert_lib.content_addressed
+        new_lib = cls(
+            repo_id=repo_id,
+            create=True,
+            weights_format=expert_lib.weights_format,
+            content_addressed=content_addressed,
+        )
 
         only_tasks = only_tasks or expert_lib.tasks
         with new_lib.batched_commit():
-            for name, expert in expert_lib.items():
-                if expert.name not in new_lib:
-                    new_lib.add_expert(expert, name, force=force)
+            for name in list(expert_lib.keys()):
+                if name in new_lib:
+                    continue
+
+                metadata = expert_lib.data[name]
+                if (
+                    new_lib.content_addressed
+                    and metadata.weights_file is not None
+                    and new_lib._is_weights_file_referenced(metadata.weights_file)
+                ):
+                    # the weights are already in the destination, only copy the metadata
+                    metadata = replace(metadata)
+                    new_lib._upload_metadata(metadata)
+                    new_lib.data[name] = metadata
+                    new_lib._update_index()
+                    new_lib._update_readme()
+                else:
+                    new_lib.add_expert(expert_lib[name], name, force=force)
 
         # if the new_lib already exists, delete experts that
         # are in this lib but were deleted from the expert_lib
@@ -849,6 +1364,8 @@ class ExpertLibrary:
         ignore_sliced: bool = False,
         expert_library_type: Union[Type["ExpertLibrary"], str] = None,
         destination_id: Optional[str] = None,
+        weights_format: str = CKPT_FORMAT,
+        content_addressed: bool = False,
     ) -> "ExpertLibrary":
         """Instantiate an ExpertLibrary from one of the available expert library types:
             - "local": LocalExpertLibrary,
@@ -862,6 +1379,8 @@ class ExpertLibrary:
             3. Otherwise, uses LocalExpertLibrary.
 
         If a destination_id is provided, the expert library will be copied to the new destination.
+        New experts are stored in `weights_format`, either "ckpt" or "safetensors", under the
+        hash of their weights if `content_addressed` is set.
         """
         expert_lib_class = cls._get_expert_lib_class(repo_id, expert_library_type)
         expert_lib = expert_lib_class(
@@ -872,6 +1391,8 @@ class ExpertLibrary:
             exclude_selection=exclude_selection,
             create=create,
             ignore_sliced=ignore_sliced,
+            weights_format=weights_format,
+            content_addressed=content_addressed,
         )
         if destination_id is not None:
             expert_lib_class_copy = cls._get_expert_lib_class(
@@ -925,7 +1446,10 @@ class VirtualLocalLibrary(ExpertLibrary, LocalFSEngine):
     def _upload_metadata(self, metadata):
         pass
 
-    def _upload_weights(self, expert_name, expert_dump):
+    def _upload_weights(self, metadata, expert_dump):
+        pass
+
+    def _update_index(self):
         pass
 
     def _update_readme(self):
@@ -1,11 +1,13 @@
 import abc
 import copy
 import dataclasses
+import hashlib
 import re
+import time
 from abc import abstractmethod
 from collections import defaultdict
 from dataclasses import dataclass
-from typing import Dict, List, Union
+from typing import Dict, List, Tuple, Union
 
 import numpy as np
 import sklearn.decomposition
@@ -154,17 +156,42 @@ class LibraryTransformConfig(Serializable):
 class SVDEmbeddingTransformConfig(LibraryTransformConfig):
     n_components: int = 64
     sparsity_threshold: float = 0.8
+    # decomposes the gram matrix of the experts, computed by streaming them in blocks,
+    # instead of holding all the experts in memory for sklearn's TruncatedSVD
+    streaming: bool = True
+    block_size: int = 64
+    max_concurrency: int = 4
+
+    def param_hash(self):
+        # the embeddings don't depend on how they are computed, up to the sign of each
+        # component, so that they are reused whatever the execution options
+        return param_hash(
+            self, exclude_fields=["streaming", "block_size", "max_concurrency"]
+        )
 
 
 @LibraryTransform.register("svd_embedding", SVDEmbeddingTransformConfig)
 class SVDEmbeddingTransform(LibraryTransform):
     """Creates adapter embeddings by low-rank decomposition of a sparsified version
     of the adapter experts.
+
+    When `streaming`, the experts are never stacked: the gram matrix of the sparsified
+    experts, N x N for N experts, is computed block by block, with `block_size` experts
+    held in memory while the others are streamed one at a time. The embeddings are then
+    the top eigenvectors of the gram matrix scaled by the singular values, i.e. the left
+    singular vectors computed by the SVD. The rows of the gram matrix are persisted with
+    the embeddings, so that only the inner products of the new experts with the library
+    are computed when experts are added.
     """
 
     def __init__(self, config, random_state=None):
         super().__init__(config)
         self.random_state = random_state
+        self.fit_stats = None
+
+    @property
+    def gram_data_type(self):
+        return f"{self.config.save_name}-gram"
 
     @torch.no_grad()
     def fetch(self, library: Union[str, ExpertLibrary]):
@@ -198,6 +225,38 @@ class SVDEmbeddingTransform(LibraryTransform):
         logger.info("Computing SVD Embeddings for %s experts", len(library))
         logger.info("Saving to: %s", self.config.save_name)
 
+        gram_rows = None
+        if self.config.streaming:
+            names, experts_embeddings, gram_rows = self._streaming_embeddings(
+                library, recompute=recompute
+            )
+        else:
+            names, experts_embeddings = self._in_memory_embeddings(library)
+
+        if persist:
+            logger.info("Uploading SVD embeddings to the library.")
+
+            # add embeddings to the library
+            with library.batched_commit():
+                for i, name in enumerate(names):
+                    library.add_auxiliary_data(
+                        data_type=self.config.save_name,
+                        expert_name=name,
+                        config=self.config.__dict__,
+                        data=experts_embeddings[i],
+                        force=True,  # make sure we overwrite
+                    )
+                    if gram_rows is not None:
+                        library.add_auxiliary_data(
+                            data_type=self.gram_data_type,
+                            expert_name=name,
+                            config=self.config.__dict__,
+                            data=gram_rows[name],
+                            force=True,
+                        )
+        return dict(zip(names, experts_embeddings))
+
+    def _in_memory_embeddings(self, library):
         svd = sklearn.decomposition.TruncatedSVD(
             n_components=self.config.n_components,
             algorithm="randomized",
@@ -236,21 +295,127 @@ class SVDEmbeddingTransform(LibraryTransform):
         experts_embeddings = (
             experts_embeddings / np.linalg.norm(experts_embeddings, 2, axis=1)[:, None]
         )
+        return names, experts_embeddings
+
+    def _sparsified_vector(self, expert) -> torch.Tensor:
+        vector = torch.nn.utils.parameters_to_vector(
+            [p.float() for p in expert.expert_weights.values()]
+        ).cpu()
+        # same threshold as the in-memory version
+        threshold = np.quantile(np.abs(vector.numpy()), self.config.sparsity_threshold)
+        vector[vector.abs() <= float(threshold)] = 0.0
+        return vector
+
+    def _gram_rows(self, library, names, new_names, rows):
+        """Fills `rows` with the inner products of the sparsified `new_names` experts with
+        all the `names` experts.
+
+        Blocks of `block_size` new experts are held in memory, the experts not paired with
+        them yet are streamed once per block. Returns the number of experts loaded and the
+        size of the largest block.
+        """
+        # new experts of the previous blocks, already paired with all the experts
+        n_loads, peak_bytes, paired = 0, 0, set()
+
+        for start in range(0, len(new_names), self.config.block_size):
+            # `prefetch` yields the experts in completion order
+            block_names, block = [], []
+            for expert in library.prefetch(
+                new_names[start : start + self.config.block_size],
+                max_concurrency=self.config.max_concurrency,
+            ):
+                block_names.append(expert.name)
+                block.append(self._sparsified_vector(expert))
+            block = torch.stack(block)
+            n_loads += len(block_names)
+            peak_bytes = max(peak_bytes, block.numel() * block.element_size())
+
+            def _add(name, products):
+                for block_name, product in zip(block_names, products.tolist()):
+                    rows[block_name][name] = product
+                    rows[name][block_name] = product
+
+            for i, name in enumerate(block_names):
+                _add(name, block @ block[i])
+
+            others = [
+                name for name in names if name not in paired and name not in block_names
+            ]
+            for expert in tqdm(
+                library.prefetch(others, max_concurrency=self.config.max_concurrency),
+                total=len(others),
+                desc=f"Gram matrix, block {start // self.config.block_size + 1}",
+            ):
+                _add(expert.name, block @ self._sparsified_vector(expert))
+                n_loads += 1
+
+            paired.update(block_names)
+            del block
+
+        return n_loads, peak_bytes
+
+    def _streaming_embeddings(self, library, recompute=False):
+        start_time = time.perf_counter()
+        names = list(library.keys())
+
+        rows = {}
+        if not recompute:
+            # rows of the gram matrix of a previous fit, restricted to the current experts
+            for name, row in library.get_auxiliary_data(
+                data_type=self.gram_data_type
+            ).items():
+                if name in names:
+                    rows[name] = {other: row[other] for other in row if other in names}
+        known = set(rows)
+        rows = {
+            name: rows[name]
+            for name in names
+            if name in known and known.issubset(rows[name])
+        }
+        new_names = [name for name in names if name not in rows]
+        for name in names:
+            rows.setdefault(name, {})
 
-        if persist:
-            logger.info("Uploading SVD embeddings to the library.")
+        logger.info(
+            "Computing the inner products of {} new experts with {} experts".format(
+                len(new_names), len(names)
+            )
+        )
+        n_loads, peak_bytes = self._gram_rows(library, names, new_names, rows)
 
-            # add embeddings to the library
-            with library.batched_commit():
-                for i, name in enumerate(names):
-                    library.add_auxiliary_data(
-                        data_type=self.config.save_name,
-                        expert_name=name,
-                        config=self.config.__dict__,
-                        data=experts_embeddings[i],
-                        force=True,  # make sure we overwrite
-                    )
-        return dict(zip(names, experts_embeddings))
+        gram = np.array(
+            [[rows[name][other] for other in names] for name in names],
+            dtype=np.float64,
+        )
+        eigenvalues, eigenvectors = np.linalg.eigh(gram)
+        # top components first
+        n_components = min(self.config.n_components, len(names))
+        eigenvalues = eigenvalues[::-1][:n_components].clip(min=0.0)
+        eigenvectors = eigenvectors[:, ::-1][:, :n_components]
+        # deterministic signs, the largest coordinate of each component is positive
+        signs = np.sign(
+            eigenvectors[np.abs(eigenvectors).argmax(0), np.arange(n_components)]
+        )
+        experts_embeddings = eigenvectors * signs * np.sqrt(eigenvalues)
+
+        if n_components < self.config.n_components:
+            experts_embeddings = np.pad(
+                experts_embeddings,
+                ((0, 0), (0, self.config.n_components - n_components)),
+            )
+        experts_embeddings = (
+            experts_embeddings / np.linalg.norm(experts_embeddings, 2, axis=1)[:, None]
+        ).astype(np.float32)
+
+        self.fit_stats = {
+            "fit_time": time.perf_counter() - start_time,
+            "new_experts": len(new_names),
+            "expert_loads": n_loads,
+            "peak_block_bytes": peak_bytes,
+            "gram_bytes": gram.nbytes,
+        }
+        logger.info("SVD embeddings fit: {}".format(self.fit_stats))
+        return names, experts_embeddings, rows
 
 
 @dataclass
@@ -320,16 +485,39 @@ class WeightedLinearMerge(LibraryTransform):
         return base_expert
 
 
+def abs_quantile(vector: torch.Tensor, q: float) -> torch.Tensor:
+    """`vector.abs().quantile(q)`, with the same linear interpolation, for vectors of any
+    size: `torch.quantile` is limited to 2**24 elements."""
+    vector = vector.abs().float()
+    # as torch.quantile, q is rounded to the dtype of the input and the rank is a double
+    rank = torch.tensor(q, dtype=vector.dtype).double() * (vector.numel() - 1)
+    below = int(rank)
+    above = min(below + 1, vector.numel() - 1)
+    value_below = vector.kthvalue(below + 1).values
+    value_above = vector.kthvalue(above + 1).values if above != below else value_below
+    return torch.lerp(value_below, value_above, (rank - below).float())
+
+
 @dataclass
 class TiesMergeConfig(LibraryTransformConfig):
     top_k: float = 0.2
     only_sparsify: bool = False
+    # visits the experts one at a time, instead of stacking all of them in memory
+    streaming: bool = True
+    max_concurrency: int = 4
 
 
 @LibraryTransform.register("ties_merge", TiesMergeConfig)
 class TiesMerge(LibraryTransform):
     """
     Computes a uniform weight mixture across experts of a given library
+
+    When `streaming`, the experts are visited twice, one at a time: first to compute the
+    trimming threshold of each expert, then to accumulate, per parameter, the sums and
+    counts of the positive and negative trimmed weights. The elected sign is the sign of
+    the total sum, and the disjoint mean is the sum over the count on the elected side,
+    so the memory is bounded by 4 accumulators per parameter whatever the number of
+    experts. At most `max_concurrency` experts are loaded at once.
     """
 
     def __init__(self, config: TiesMergeConfig = None):
@@ -342,6 +530,105 @@ class TiesMerge(LibraryTransform):
         if type(library) == str:
             library = ExpertLibrary.get_expert_library(library)
 
+        if self.config.streaming:
+            return self._streaming_transform(library)
+        return self._in_memory_transform(library)
+
+    def _finalize(self, base_expert, kept, used, total):
+        logger.info(
+            "Params not reset to 0 in TIES merge: {:.10f}%".format(100.0 * kept / total)
+        )
+        logger.info(
+            "Params used to compute TIES mean: {:.10f}%".format(100.0 * used / total)
+        )
+
+        # manually change the config of the expert to remove the tie_params
+        base_expert.expert_config.tie_params = None
+
+        return base_expert
+
+    def _streaming_transform(self, library) -> Expert:
+        expert_names = list(library.keys())
+        logger.info("Averaging {} experts".format(len(expert_names)))
+
+        base_expert, state_dict_keys, thresholds = None, None, {}
+        for expert in tqdm(
+            library.prefetch(expert_names, max_concurrency=self.config.max_concurrency),
+            total=len(expert_names),
+            desc="TIES thresholds",
+        ):
+            if state_dict_keys is None:
+                state_dict_keys = list(expert.expert_weights.keys())
+            if expert.name == expert_names[0]:
+                base_expert = copy.deepcopy(expert)
+                base_expert.name = "ties_weighted_expert"
+
+            vector = torch.nn.utils.parameters_to_vector(
+                list(expert.expert_weights[k] for k in state_dict_keys)
+            )
+            thresholds[expert.name] = abs_quantile(vector, 1.0 - self.config.top_k)
+            del vector
+
+        positive_sum, negative_sum, positive_count, negative_count = {}, {}, {}, {}
+        for name in state_dict_keys:
+            shape = base_expert.expert_weights[name].shape
+            device = base_expert.expert_weights[name].device
+            positive_sum[name] = torch.zeros(shape, dtype=torch.float32, device=device)
+            negative_sum[name] = torch.zeros(shape, dtype=torch.float32, device=device)
+            positive_count[name] = torch.zeros(shape, dtype=torch.int32, device=device)
+            negative_count[name] = torch.zeros(shape, dtype=torch.int32, device=device)
+
+        kept, total = 0, 0
+        for expert in tqdm(
+            library.prefetch(expert_names, max_concurrency=self.config.max_concurrency),
+            total=len(expert_names),
+            desc="TIES merge",
+        ):
+            threshold = thresholds[expert.name]
+            for name in state_dict_keys:
+                weight = expert.expert_weights[name].float()
+                # keep weights over the threshold
+                weight = weight * (weight.abs() >= threshold)
+
+                positive, negative = weight > 0, weight < 0
+                positive_sum[name] += weight * positive
+                negative_sum[name] += weight * negative
+                positive_count[name] += positive
+                negative_count[name] += negative
+
+                kept += (weight.abs() > threshold).sum().item()
+                total += weight.numel()
+
+        used = 0
+        for name in state_dict_keys:
+            if self.config.only_sparsify:
+                final_param = (positive_sum[name] + negative_sum[name]) / len(
+                    expert_names
+                )
+                used += (positive_count[name] + negative_count[name]).sum().item()
+            else:
+                # sign majority vote, the weights whose sign agree with it are averaged
+                sign = (positive_sum[name] + negative_sum[name]).sign()
+                sum_param = torch.where(
+                    sign > 0,
+                    positive_sum[name],
+                    torch.where(sign < 0, negative_sum[name], 0.0),
+                )
+                count = torch.where(
+                    sign > 0,
+                    positive_count[name],
+                    torch.where(sign < 0, negative_count[name], 0),
+                )
+                final_param = sum_param / count.clamp(min=1)
+                used += count.sum().item()
+
+            base_expert.expert_weights[name].data.copy_(final_param)
+            del positive_sum[name], negative_sum[name]
+            del positive_count[name], negative_count[name]
+
+        return self._finalize(base_expert, kept, used, total)
+
+    def _in_memory_transform(self, library) -> Expert:
         expert_names = list(library.keys())
         experts = [library[name] for name in expert_names]
 
@@ -403,17 +690,7 @@ class TiesMerge(LibraryTransform):
 
             base_expert.expert_weights[param_name].data.copy_(final_param)
 
-        logger.info(
-            "Params not reset to 0 in TIES merge: {:.10f}%".format(100.0 * kept / total)
-        )
-        logger.info(
-            "Params used to compute TIES mean: {:.10f}%".format(100.0 * used / total)
-        )
-
-        # manually change the config of the expert to remove the tie_params
-        base_expert.expert_config.tie_params = None
-
-        return base_expert
+        return self._finalize(base_expert, kept, used, total)
 
 
 @dataclass
@@ -475,6 +752,8 @@ class HiddenStateComputer(LibraryTransform):
         return model
 
     def _track_hidden_states(self, model, keys=None, device="cpu"):
+        """Registers hooks storing the hidden states in `model.container`, returns the
+        handles of the hooks."""
         model.container = {}
 
         if model.model is None:
@@ -485,7 +764,9 @@ class HiddenStateComputer(LibraryTransform):
             def fetch_input(module, input, output):
                 model.container["last_layer"] = input[0].detach().to(device)
 
-            model.model.get_output_embeddings().register_forward_hook(fetch_input)
+            return [
+                model.model.get_output_embeddings().register_forward_hook(fetch_input)
+            ]
         elif self.config.track == "each_layer":
             # add a hook for all the layers that an expert modifies
             def build_hook(name):
@@ -494,9 +775,11 @@ class HiddenStateComputer(LibraryTransform):
 
                 return retrieve_input
 
+            handles = []
             for key in keys:
                 module = self._get_parent_from_name(model.model, key)
-                module.register_forward_hook(build_hook(key))
+                handles.append(module.register_forward_hook(build_hook(key)))
+            return handles
         else:
             raise NotImplementedError()
 
@@ -524,6 +807,71 @@ class HiddenStateComputer(LibraryTransform):
             "Hidden states are missing or corrupted, please recompute them."
         )
 
+    def _expert_args(self, expert_info, default_args=None):
+        """Config to compute the hidden states of an expert, from its training config."""
+        # copied, the metadata of the library is left untouched
+        training_config = copy.deepcopy(expert_info.training_config)
+
+        if default_args is not None:
+            self._update_args(training_config, default_args)
+
+        if self.config.use_base_model_only and self.config.model is not None:
+            training_config.model = self.config.model
+
+        training_config.subsample_train = self.config.max_samples_per_task
+        if expert_info.expert_task_name:
+            train_tasks = expert_info.expert_task_name.split(",")
+            training_config.finetune_task_name = ",".join(train_tasks)
+            training_config.subsample_train *= len(train_tasks)
+
+        training_config.train_batch_size = (
+            default_args.predict_batch_size if default_args is not None else 4
+        )
+        # tokenized once, and shared by the experts trained on the same data
+        training_config.pretokenize = True
+        return training_config
+
+    def _compute_centroids(self, model, dataloader, device="cpu"):
+        centroid, count = defaultdict(lambda: 0.0), 0
+
+        pbar = tqdm(enumerate(dataloader), total=len(dataloader))
+        device_model = next(model.parameters()).device
+
+        for _, batch in pbar:
+            batch = transfer_batch_to_device(batch, device_model)
+            model.forward(**batch)
+
+            bs = batch["input_ids"].size(0)
+            last_token_idx = batch["attention_mask"].sum(1).to(device) - 1
+            hidden_states = self._retrieve_hidden_states(model)
+            bs_idx = torch.arange(
+                bs, device=hidden_states[list(hidden_states.keys())[0]].device
+            )
+
+            for layer, hidden_state in hidden_states.items():
+                assert hidden_state.ndim == 3
+
+                if self.config.pool == "last":
+                    centroid[layer] += hidden_state[bs_idx, last_token_idx].sum(0)
+                elif self.config.pool == "mean":
+                    deno = batch["attention_mask"].sum(1, keepdim=True)
+                    centroid[layer] += (
+                        (hidden_state * batch["attention_mask"].unsqueeze(-1)).sum(1)
+                        / deno
+                    ).sum(0)
+                else:
+                    raise NotImplementedError()
+
+            count += bs
+
+        # average over all batches
+        for layer in centroid.keys():
+            centroid[layer] /= count
+            centroid[layer] = F.normalize(centroid[layer], p=2, dim=-1).cpu()
+
+        # convert to regular dict
+        return {k: v for k, v in centroid.items()}
+
     @torch.no_grad()
     def transform(
         self,
@@ -533,119 +881,75 @@ class HiddenStateComputer(LibraryTransform):
         default_args=None,
         device="cpu",
     ) -> Expert:
-        from mttl.models.lightning.expert_module import ExpertModule, MultiExpertModule
-
         if isinstance(library, str):
             library = ExpertLibrary.get_expert_library(library)
 
-        try:
-            protos = self.fetch(library)
-
-            if not recompute:
-                logger.info("Found {} precomputed centroids".format(len(protos)))
-                return protos
-        except ValueError:
-            pass
-
-        logger.info("Computing centroids for {} experts".format(len(library)))
+        # centroids of a previous, possibly interrupted, run
         output = {}
+        if not recompute:
+            output = library.get_auxiliary_data(data_type=self.config.save_name)
 
-        for _, (expert_name, expert) in enumerate(library.items()):
-            training_config = expert.training_config
+        to_compute = [name for name in library.keys() if name not in output]
+        if not to_compute:
+            logger.info("Found {} precomputed centroids".format(len(output)))
+            return output
 
-            if default_args is not None:
-                self._update_args(training_config, default_args)
+        logger.info(
+            "Computing centroids for {} experts, found {} precomputed".format(
+                len(to_compute), len(output)
+            )
+        )
 
-            if self.config.use_base_model_only and self.config.model is not None:
-                training_config.model = self.config.model
+        # each base model is loaded once, and its experts are swapped in and out of it
+        args, by_base_model = {}, defaultdict(list)
+        for expert_name in to_compute:
+            args[expert_name] = self._expert_args(
+                library.data[expert_name], default_args
+            )
+            by_base_model[
+                (str(args[expert_name].model), str(args[expert_name].device_map))
+            ].append(expert_name)
 
+        for expert_names in by_base_model.values():
+            training_config = args[expert_names[0]]
             model = MultiExpertModel(
                 MultiExpertModelConfig(
                     base_model=training_config.model,
                 ),
                 device_map=training_config.device_map,
             )
-            if not self.config.use_base_model_only:
-                model.add_expert_instance(expert, is_default=True)
-
-            self._track_hidden_states(
-                model, keys=expert.expert_weights.keys(), device=device
-            )
-
-            training_config.dataset = expert.expert_info.dataset
-            training_config.subsample_train = self.config.max_samples_per_task
-            if expert.expert_info.expert_task_name:
-                train_tasks = expert.expert_info.expert_task_name.split(",")
-                training_config.finetune_task_name = ",".join(train_tasks)
-                training_config.subsample_train *= len(train_tasks)
-            else:
-                train_tasks = None
-
-            training_config.train_batch_size = (
-                default_args.predict_batch_size if default_args is not None else 4
-            )
-
-            # get datamodule
-            dm = get_datamodule(training_config)
-            dataloader = dm.train_dataloader()
 
-            centroid, count = defaultdict(lambda: 0.0), 0
+            for expert in library.prefetch(expert_names):
+                training_config = args[expert.name]
+                if not self.config.use_base_model_only:
+                    model.add_expert_instance(expert, is_default=True)
 
-            pbar = tqdm(enumerate(dataloader), total=len(dataloader))
-            device_model = next(model.parameters()).device
-
-            for _, batch in pbar:
-                batch = transfer_batch_to_device(batch, device_model)
-                model.forward(**batch)
-
-                bs = batch["input_ids"].size(0)
-                last_token_idx = batch["attention_mask"].sum(1).to(device) - 1
-                hidden_states = self._retrieve_hidden_states(model)
-                bs_idx = torch.arange(
-                    bs, device=hidden_states[list(hidden_states.keys())[0]].device
+                handles = self._track_hidden_states(
+                    model, keys=expert.expert_weights.keys(), device=device
                 )
+                try:
+                    dm = get_datamodule(training_config)
+                    output[expert.name] = self._compute_centroids(
+                        model, dm.train_dataloader(), device=device
+                    )
+                finally:
+                    for handle in handles:
+                        handle.remove()
+                    model.clear_experts()
 
-                for layer, hidden_state in hidden_states.items():
-                    assert hidden_state.ndim == 3
-
-                    if self.config.pool == "last":
-                        centroid[layer] += hidden_state[bs_idx, last_token_idx].sum(0)
-                    elif self.config.pool == "mean":
-                        deno = batch["attention_mask"].sum(1, keepdim=True)
-                        centroid[layer] += (
-                            (hidden_state * batch["attention_mask"].unsqueeze(-1)).sum(
-                                1
-                            )
-                            / deno
-                        ).sum(0)
-                    else:
-                        raise NotImplementedError()
-
-                count += bs
-
-            # average over all batches
-            for layer in centroid.keys():
-                centroid[layer] /= count
-                centroid[layer] = F.normalize(centroid[layer], p=2, dim=-1).cpu()
-
-            # convert to regular dict
-            centroids = {k: v for k, v in centroid.items()}
-            output[expert_name] = centroids
-
-            del model
-
-        if persist:
-            # add embeddings to the library
-            with library.batched_commit():
-                for expert_name, data in output.items():
+                if persist:
+                    # saved right away, so that an interrupted run can be resumed
                     library.add_auxiliary_data(
                         data_type=self.config.save_name,
-                        expert_name=expert_name,
+                        expert_name=expert.name,
                         config=self.config.__dict__,
-                        data=data,
+                        data=output[expert.name],
                         force=True,  # make sure we overwrite
                     )
-        return output
+
+            del model
+
+        return {name: output[name] for name in library.keys() if name in output}
 
 
 @dataclass
@@ -655,10 +959,18 @@ class PhatgooseConfig(LibraryTransformConfig):
     warmup_ratio: float = 0.1  # 0.9999999 # 0.1
     micro_batch_size: int = 1
     batch_size: int = 1
+    # trains the gates of up to `max_experts_per_batch` experts at once, on one frozen base
+    # model, instead of one training run per expert
+    batched: bool = True
+    max_experts_per_batch: int = 8
 
     def __post_init__(self):
         self.gradient_accumulation_steps = self.batch_size // self.micro_batch_size
 
+    def param_hash(self):
+        # the gates do not depend on whether they are trained one expert at a time
+        return param_hash(self, exclude_fields=["batched", "max_experts_per_batch"])
+
 
 @LibraryTransform.register("phatgoose", PhatgooseConfig)
 class PhatgooseTransform(HiddenStateComputer):
@@ -682,6 +994,249 @@ class PhatgooseTransform(HiddenStateComputer):
 
         return output
 
+    def _gate_training_args(self, expert_name, expert_info, default_args=None):
+        """Config to train the gate of an expert, from its training config."""
+        # copied, the metadata of the library is left untouched
+        training_config = copy.deepcopy(expert_info.training_config)
+
+        if default_args is not None:
+            self._update_args(training_config, default_args)
+
+        training_config.router_selector = "phatgoose_trainer_selector"
+        training_config.trainable_param_names = ".*selector.*"
+        training_config.logging_prefix = expert_name + "/"
+        training_config.weight_decay = 0.0
+        # for training, we set this to true even if there is just a single expert.
+        # This ensures that we do (gate * AB * x) instead of ((gate * A) * (gate * B) * x)
+        training_config.lora_merge_after = True
+        training_config.eval_every = -1
+        training_config.total_steps = self.config.n_steps
+        training_config.learning_rate = self.config.learning_rate
+        training_config.warmup_proportion = self.config.warmup_ratio
+        training_config.train_batch_size = self.config.batch_size
+        training_config.micro_batch_size = self.config.micro_batch_size
+        training_config.gradient_accumulation_steps = (
+            self.config.gradient_accumulation_steps
+        )
+        training_config.dataset = expert_info.dataset
+
+        if expert_info.expert_task_name:
+            train_tasks = expert_info.expert_task_name.split(",")
+            training_config.finetune_task_name = ",".join(train_tasks)
+        return training_config
+
+    def _extract_prototypes(self, model):
+        """Gates of the experts of `model`, by expert."""
+        prototypes = defaultdict(dict)
+        for name, module in model.named_modules():
+            if isinstance(module, ExpertContainer) and hasattr(
+                module.selector, "get_prototypes"
+            ):
+                for k, v in module.selector.get_prototypes().items():
+                    # format is dict[layer_name] = embedding, layer_name ends with selector.{task_name}.v
+                    prototypes[k][f"{name}.selector.{k}.v"] = v
+        return prototypes
+
+    def _train_gates(self, expert, training_config):
+        """Trains the gate of `expert` on its own, with a Lightning training run."""
+        from mttl.models.lightning.expert_module import MultiExpertModule
+
+        dm = get_datamodule(training_config)
+
+        logger.info("Training config: {}".format(vars(training_config)))
+
+        model = MultiExpertModule(**vars(training_config))
+        model.add_expert_instance(expert, is_default=True)
+
+        # for checksum
+        frozen_sum, unfrozen_sum = 0, 0
+        for key, value in model.state_dict().items():
+            if re.match(".*selector.gates.*.v", key):
+                assert torch.allclose(
+                    value, torch.zeros_like(value)
+                ), "gate should be 0 init"
+                unfrozen_sum += value.sum()
+            else:
+                frozen_sum += value.sum()
+                value.requires_grad = False
+
+        checkpoint = train_module(training_config, model, dm)
+
+        if (
+            training_config.compute_strategy
+            and training_config.compute_strategy != "deepspeed"
+        ):
+            model_after = MultiExpertModule(**vars(training_config))
+            model_after.add_expert_instance(expert, is_default=True)
+            model_after.load_state_dict(
+                torch.load(checkpoint, weights_only=False)["state_dict"]
+            )
+
+            # for checksum
+            frozen_sum_after, unfrozen_sum_after = 0, 0
+            for key, value in model_after.state_dict().items():
+                if re.match(".*selector.gates.*.v", key):
+                    unfrozen_sum_after += value.sum()
+                else:
+                    frozen_sum_after += value.sum()
+
+            assert (
+                frozen_sum == frozen_sum_after
+            ), "Frozen params changed during training"
+            assert (
+                unfrozen_sum != unfrozen_sum_after
+            ), "Unfrozen params did not change during training"
+
+        prototypes = self._extract_prototypes(model.model)[expert.name]
+        del model
+        return prototypes
+
+    def _optimizer_steps(self, dataloader, training_config):
+        """Micro-batches of each optimizer step of an expert, until `total_steps` steps or
+        `num_train_epochs` epochs, as in a Lightning training run."""
+        n_steps, epoch = 0, 0
+        while training_config.num_train_epochs < 0 or (
+            epoch < training_config.num_train_epochs
+        ):
+            micro_batches = []
+            for i, batch in enumerate(dataloader):
+                micro_batches.append(batch)
+                # the last micro-batches of an epoch make a step of their own
+                if (
+                    len(micro_batches) == training_config.gradient_accumulation_steps
+                    or i == len(dataloader) - 1
+                ):
+                    yield micro_batches
+                    micro_batches = []
+                    n_steps += 1
+                    if n_steps == training_config.total_steps:
+                        return
+            epoch += 1
+
+    def _routed_batch(self, batches, pad_token_id, padding_side="right"):
+        """Concatenates the batches of several experts. The examples are routed to the gate
+        of their expert, which is set as their task name."""
+        width = max(batch["input_ids"].size(1) for _, batch in batches)
+        routed = defaultdict(list)
+        for _, batch in batches:
+            for key, pad_value in [
+                ("input_ids", pad_token_id),
+                ("attention_mask", 0),
+                ("labels", -100),
+            ]:
+                padding = width - batch[key].size(1)
+                padding = (padding, 0) if padding_side == "left" else (0, padding)
+                routed[key].append(F.pad(batch[key], padding, value=pad_value))
+        routed = {key: torch.cat(values) for key, values in routed.items()}
+        routed["task_names"] = [
+            expert_name
+            for expert_name, batch in batches
+            for _ in range(batch["input_ids"].size(0))
+        ]
+        return routed
+
+    def _train_gates_batched(self, module, experts, training_configs, datamodules):
+        """Trains the gates of `experts` at once, on the frozen base model of `module`.
+
+        The gates are independent parameters: each example only goes through the gate of its
+        expert, the loss is the sum of the mean loss of each expert, and the gradients are
+        clipped per expert. The optimizer and the scheduler are the ones of a training run
+        of a single expert, so that each gate is trained as on its own.
+        """
+        from mttl.models.get_optimizer import get_optimizer_and_scheduler
+
+        model = module.model
+        # reset when the experts of the previous batch were removed
+        model.selector_config = model.config.selector_config
+        for expert in experts:
+            model.add_expert_instance(expert, is_default=True)
+
+        training_config = training_configs[experts[0].name]
+        (optimizer, scheduler), _ = get_optimizer_and_scheduler(
+            model,
+            training_config,
+            num_train_examples=len(datamodules[experts[0].name].train_dataset),
+        )
+        selectors = [
+            selector for selectors in model.selectors.values() for selector in selectors
+        ]
+        gates = {
+            expert.name: [selector.gates[expert.name].v for selector in selectors]
+            for expert in experts
+        }
+
+        steps = {
+            expert.name: self._optimizer_steps(
+                datamodules[expert.name].train_dataloader(),
+                training_configs[expert.name],
+            )
+            for expert in experts
+        }
+        tokenizer = datamodules[experts[0].name].tokenizer
+        device = next(model.parameters()).device
+
+        pbar = tqdm(total=training_config.total_steps, desc="Training gates")
+        while steps:
+            micro_batches = {}
+            for expert_name in list(steps):
+                micro_batches[expert_name] = next(steps[expert_name], None)
+                if micro_batches[expert_name] is None:
+                    del steps[expert_name], micro_batches[expert_name]
+            if not micro_batches:
+                break
+
+            for i in range(max(len(batches) for batches in micro_batches.values())):
+                batches = [
+                    (expert_name, batches[i])
+                    for expert_name, batches in micro_batches.items()
+                    if i < len(batches)
+                ]
+                batch = transfer_batch_to_device(
+                    self._routed_batch(
+                        batches, tokenizer.pad_token_id, tokenizer.padding_side
+                    ),
+                    device,
+                )
+                logits = model.forward(
+                    input_ids=batch["input_ids"],
+                    attention_mask=batch["attention_mask"],
+                    task_names=batch["task_names"],
+                ).logits
+                for selector in selectors:
+                    selector.routing_gates.clear()
+
+                # mean loss of the tokens of each expert, as in a run of its own
+                labels = batch["labels"][:, 1:]
+                token_loss = F.cross_entropy(
+                    logits[:, :-1].flatten(0, 1).float(),
+                    labels.flatten(),
+                    ignore_index=-100,
+                    reduction="none",
+                ).view_as(labels)
+                loss, start = 0.0, 0
+                for expert_name, expert_batch in batches:
+                    end = start + expert_batch["input_ids"].size(0)
+                    loss = loss + token_loss[start:end].sum() / (
+                        labels[start:end] != -100
+                    ).sum().clamp(min=1)
+                    start = end
+                (loss / training_config.gradient_accumulation_steps).backward()
+
+            if training_config.max_grad_norm:
+                for expert_name in micro_batches:
+                    torch.nn.utils.clip_grad_norm_(
+                        gates[expert_name], training_config.max_grad_norm
+                    )
+            optimizer.step()
+            scheduler.step()
+            optimizer.zero_grad()
+            pbar.update(1)
+        pbar.close()
+
+        prototypes = self._extract_prototypes(model)
+        model.clear_experts()
+        return prototypes
+
     def transform(
         self,
         library,
@@ -690,131 +1245,109 @@ class PhatgooseTransform(HiddenStateComputer):
         expert_names: list = None,
         default_args=None,
     ):
-        from mttl.arguments import ExpertConfig
         from mttl.models.lightning.expert_module import MultiExpertModule
 
         if type(library) == str:
             library = ExpertLibrary.get_expert_library(library)
 
+        logger.info("Phatgoose save name : {}".format(self.config.save_name))
         outputs = {}
         expert_names = expert_names or list(library.keys())
         loaded_output = library.get_auxiliary_data(data_type=self.config.save_name)
 
+        to_train = {}
         for expert_name in expert_names:
-            logger.info(f"Computing PHATGOOSE gates for expert {expert_name}")
-            expert: Expert = library[expert_name]
-            logger.info("Phatgoose save name : {}".format(self.config.save_name))
-
             if not recompute and expert_name in loaded_output:
                 logger.info("Loading precomputed gates for {}".format(expert_name))
-
-                # format is dict[layer_name] = embedding, layer_name ends with selector.{task_name}.v
                 outputs[expert_name] = loaded_output[expert_name]
-                continue
-
-            training_config: ExpertConfig = expert.training_config
-
-            if default_args is not None:
-                self._update_args(training_config, default_args)
-
-            training_config.router_selector = "phatgoose_trainer_selector"
-            training_config.trainable_param_names = ".*selector.*"
-            training_config.logging_prefix = expert_name + "/"
-            training_config.weight_decay = 0.0
-            # for training, we set this to true even if there is just a single expert.
-            # This ensures that we do (gate * AB * x) instead of ((gate * A) * (gate * B) * x)
-            training_config.lora_merge_after = True
-            training_config.eval_every = -1
-            training_config.total_steps = self.config.n_steps
-            training_config.learning_rate = self.config.learning_rate
-            training_config.warmup_proportion = self.config.warmup_ratio
-            training_config.train_batch_size = self.config.batch_size
-            training_config.micro_batch_size = self.config.micro_batch_size
-            training_config.gradient_accumulation_steps = (
-                self.config.gradient_accumulation_steps
-            )
-            training_config.dataset = expert.expert_info.dataset
-
-            if expert.expert_info.expert_task_name:
-                train_tasks = expert.expert_info.expert_task_name.split(",")
-                training_config.finetune_task_name = ",".join(train_tasks)
             else:
-                train_tasks = None
-
-            dm = get_datamodule(training_config)
-
-            logger.info("Training config: {}".format(vars(training_config)))
-
-            model = MultiExpertModule(**vars(training_config))
-            model.add_expert_instance(expert, is_default=True)
-
-            # for checksum
-            frozen_sum, unfrozen_sum = 0, 0
-            for key, value in model.state_dict().items():
-                if re.match(".*selector.gates.*.v", key):
-                    assert torch.allclose(
-                        value, torch.zeros_like(value)
-                    ), "gate should be 0 init"
-                    unfrozen_sum += value.sum()
-                else:
-                    frozen_sum += value.sum()
-                    value.requires_grad = False
-
-            checkpoint = train_module(training_config, model, dm)
+                to_train[expert_name] = self._gate_training_args(
+                    expert_name, library.data[expert_name], default_args
+                )
 
-            if (
-                training_config.compute_strategy
-                and training_config.compute_strategy != "deepspeed"
-            ):
-                from mttl.models.lightning.expert_module import MultiExpertModule
+        failed = {}
 
-                model_after = MultiExpertModule(**vars(training_config))
-                model_after.add_expert_instance(expert, is_default=True)
-                model_after.load_state_dict(
-                    torch.load(checkpoint, weights_only=False)["state_dict"]
+        def _save(expert_name, prototypes):
+            outputs[expert_name] = prototypes
+            if persist:
+                # saved right away, the experts which failed can be retried on their own
+                library.add_auxiliary_data(
+                    data_type=self.config.save_name,
+                    expert_name=expert_name,
+                    config=self.config.__dict__,
+                    data=prototypes,
+                    force=True,  # make sure we overwrite
                 )
 
-                # for checksum
-                frozen_sum_after, unfrozen_sum_after = 0, 0
-                for key, value in model_after.state_dict().items():
-                    if re.match(".*selector.gates.*.v", key):
-                        unfrozen_sum_after += value.sum()
-                    else:
-                        frozen_sum_after += value.sum()
-
-                assert (
-                    frozen_sum == frozen_sum_after
-                ), "Frozen params changed during training"
-                assert (
-                    unfrozen_sum != unfrozen_sum_after
-                ), "Unfrozen params did not change during training"
-
-            # extract prototypes
-            prototypes = {}
-            for name, module in model.model.named_modules():
-                if isinstance(module, ExpertContainer) and hasattr(
-                    module.selector, "get_prototypes"
-                ):
-                    # expand dict
-                    prototypes_module = {}
-                    for k, v in module.selector.get_prototypes().items():
-                        prototypes_module[f"{name}.selector.{k}.v"] = v
-                    prototypes = {**prototypes, **prototypes_module}
+        def _train_one_by_one(experts):
+            for expert in experts:
+                logger.info(f"Computing PHATGOOSE gates for expert {expert.name}")
+                try:
+                    _save(expert.name, self._train_gates(expert, to_train[expert.name]))
+                except Exception as error:
+                    logger.error(
+                        f"Failed to train the gates of {expert.name}: {error!r}"
+                    )
+                    failed[expert.name] = error
+
+        # the batched loss assumes the labels of causal language models
+        batched = [
+            name
+            for name, args in to_train.items()
+            if self.config.batched and args.model_family == "gpt"
+        ]
+        _train_one_by_one(library[name] for name in to_train if name not in batched)
+
+        # experts trained together share the base model and the optimization settings
+        groups = defaultdict(list)
+        for expert_name in batched:
+            args = to_train[expert_name]
+            groups[
+                tuple(
+                    str(getattr(args, key, None))
+                    for key in [
+                        "model",
+                        "device_map",
+                        "precision",
+                        "optimizer",
+                        "scheduler",
+                        "max_grad_norm",
+                        "adam_epsilon",
+                        "num_train_epochs",
+                    ]
+                )
+            ].append(expert_name)
+
+        for group in groups.values():
+            module = MultiExpertModule(**vars(to_train[group[0]]))
+            for start in range(0, len(group), self.config.max_experts_per_batch):
+                names = group[start : start + self.config.max_experts_per_batch]
+                logger.info(f"Computing PHATGOOSE gates for experts {names}")
+                experts = [library[name] for name in names]
+                try:
+                    prototypes = self._train_gates_batched(
+                        module,
+                        experts,
+                        {name: to_train[name] for name in names},
+                        {name: get_datamodule(to_train[name]) for name in names},
+                    )
+                except Exception as error:
+                    logger.error(
+                        f"Failed to train the gates of {names} at once, training them one by one: {error!r}"
+                    )
+                    module.model.clear_experts()
+                    _train_one_by_one(experts)
+                    continue
 
-            outputs[expert_name] = prototypes
+                for name in names:
+                    _save(name, prototypes[name])
+            del module
 
-            if persist:
-                with library.batched_commit():
-                    for expert_name, data in outputs.items():
-                        library.add_auxiliary_data(
-                            data_type=self.config.save_name,
-                            expert_name=expert_name,
-                            config=self.config.__dict__,
-                            data=data,
-                            force=True,  # make sure we overwrite
-                        )
-            del model
-        return outputs
+        if failed:
+            raise ValueError(
+                f"Failed to train the gates of {len(failed)} experts: {', '.join(sorted(failed))}"
+            )
+        return {name: outputs[name] for name in expert_names}
 
 
 @dataclass
@@ -826,10 +1359,13 @@ class ArrowConfig(LibraryTransformConfig):
     )
     tie_op: str = "concat"  # or "sum"
     add_base_proto: bool = False
+    # number of experts downloaded concurrently when computing the missing prototypes
+    max_concurrency: int = 4
 
     def param_hash(self):
-        # for convenience, we exclude the add_base_proto field as it was added later
-        return param_hash(self, exclude_fields=["add_base_proto"])
+        # for convenience, we exclude the add_base_proto field as it was added later,
+        # and max_concurrency which does not change the prototypes
+        return param_hash(self, exclude_fields=["add_base_proto", "max_concurrency"])
 
 
 @LibraryTransform.register("arrow", ArrowConfig)
@@ -838,6 +1374,9 @@ class ArrowTransform(LibraryTransform):
     Given a library of experts, extract the input direction most affected by the linear transforms
     """
 
+    # prototypes of the base models, by auxiliary data type, shared by all the transforms
+    _base_protos: Dict[str, Tuple[Dict, Dict]] = {}
+
     def __init__(self, config: ArrowConfig = None):
         super().__init__(config or ArrowConfig())
 
@@ -856,40 +1395,78 @@ class ArrowTransform(LibraryTransform):
         return output
 
     def _low_rank_svd(self, A, B):
-        """Faster SVD computation for low rank matrices"""
+        """Faster SVD computation for low rank matrices, batched over the leading dimensions
+        of A (..., in_features, rank) and B (..., rank, out_features)"""
 
         # Compute SVD of A
         U_A, Sigma_A, V_A = torch.svd(A)
 
         # Compute SVD of B.T (transpose of B)
-        U_B, Sigma_B, V_B = torch.svd(B.T)
+        U_B, Sigma_B, V_B = torch.svd(B.mT)
 
         # Compute product matrix C = Sigma_A * (V_A.T @ V_B) * Sigma_B
         # Since V_A and V_B are orthogonal, their product is also an orthogonal matrix
-        C = Sigma_A.diag_embed() @ V_A.t() @ V_B @ Sigma_B.diag_embed()
+        C = Sigma_A.diag_embed() @ V_A.mT @ V_B @ Sigma_B.diag_embed()
 
         # Compute SVD of the product matrix C
         U_C, Sigma_C, V_C = torch.svd(C)
 
         # Construct the final SVD components of W
         U_W = U_A @ U_C
-        V_W_T = V_C.t() @ U_B.t()
+        V_W_T = V_C.mT @ U_B.mT
 
-        diff_AB = (U_W.T @ U_A).abs().diag()
-        if diff_AB[0] < 0.9:
+        diff_AB = (U_W.mT @ U_A).abs().diagonal(dim1=-2, dim2=-1)
+        if (diff_AB[..., 0] < 0.9).any():
             logger.warning("The first singular vector of U_A and U_AB are not aligned")
 
         return U_W, Sigma_C, V_W_T
 
+    def _low_rank_top_eigenvectors(self, A, B):
+        """Top eigenvectors and eigenvalues of W.T @ W, with W = (A @ B).T, for a batch of
+        A (n, in_features, rank) and B (n, rank, out_features)."""
+        U_W, Sigma_W, _ = self._low_rank_svd(A, B)
+        top_vectors, bottom_vectors = U_W[..., 0], U_W[..., -1]
+
+        def WTW(vectors):
+            # W.T @ W @ v, without forming W
+            vectors = vectors.unsqueeze(-1)
+            return (A @ (B @ (B.mT @ (A.mT @ vectors)))).squeeze(-1)
+
+        # Check that top vector is indeed the top eigenvector
+        assert (
+            WTW(top_vectors).pow(2).sum(-1) > WTW(bottom_vectors).pow(2).sum(-1)
+        ).all()
+
+        return top_vectors, Sigma_W[..., 0] ** 2
+
+    def _load_base_model(self, library):
+        from mttl.models.lightning.expert_module import MultiExpertModule
+
+        # the training config is in the metadata, no expert needs to be downloaded
+        metadata = library.data[next(iter(library.keys()))]
+        training_config = copy.deepcopy(metadata.training_config)
+        training_config.model_modifier = None
+        return MultiExpertModule(**vars(training_config))
+
+    def _base_proto_data_type(self, library):
+        """The base model prototypes do not depend on the config of the transform, they are
+        stored under a hash of the name of the base model."""
+        model = library.data[next(iter(library.keys()))].model
+        return "base_proto-" + hashlib.md5(str(model).encode()).hexdigest()
+
+    @torch.no_grad()
     def _compute_base_proto(self, library, base_model=None, persist=True):
         """Compute Arrow prototypes for base model weights"""
+        data_type = self._base_proto_data_type(library)
+        if data_type in self._base_protos:
+            return self._base_protos[data_type]
 
         try:
             base_vector = library.get_auxiliary_data(
-                data_type="vectors", expert_name="base_model"
+                data_type=data_type + "_vectors", expert_name="base_model"
             )
             base_eigval = library.get_auxiliary_data(
-                data_type="eigvals", expert_name="base_model"
+                data_type=data_type + "_eigvals", expert_name="base_model"
             )
         except ValueError:
             # `get_auxiliary_data` will throw a ValueError if the object is not found.
@@ -897,15 +1474,11 @@ class ArrowTransform(LibraryTransform):
 
         if len(base_vector) == len(base_eigval) > 0:
             # TODO: should we perform some checks to see if the keys lineup
+            self._base_protos[data_type] = base_vector, base_eigval
             return base_vector, base_eigval
 
         if base_model is None:
-            from mttl.models.lightning.expert_module import MultiExpertModule
-
-            an_expert = library[next(iter(library.keys()))]
-            training_config = an_expert.training_config
-            training_config.model_modifier = None
-            base_model = MultiExpertModule(**vars(training_config))
+            base_model = self._load_base_model(library)
 
         vectors, eigvals = {}, {}
         for key, base_W in base_model.named_parameters():
@@ -914,8 +1487,8 @@ class ArrowTransform(LibraryTransform):
 
             logger.info(f"\tComputing SVD for base model parameter {key}")
 
-            base_W = base_W.float()
-            U, E, Vt = torch.linalg.svd(base_W)
+            # only the top singular vector is kept, no need for the full U and V
+            _, E, Vt = torch.linalg.svd(base_W.float(), full_matrices=False)
             vectors[key] = Vt[0].cpu().numpy()
             eigvals[key] = E[0].item()
 
@@ -923,13 +1496,14 @@ class ArrowTransform(LibraryTransform):
         if persist:
             for data_name, data in [("vectors", vectors), ("eigvals", eigvals)]:
                 library.add_auxiliary_data(
-                    data_type=data_name,
+                    data_type=data_type + "_" + data_name,
                     expert_name="base_model",
                     data=data,
                     config=None,
                     force=True,  # make sure we overwrite
                 )
 
+        self._base_protos[data_type] = vectors, eigvals
         return vectors, eigvals
 
     def _get_unique_parent_names(self, alist):
@@ -962,6 +1536,150 @@ class ArrowTransform(LibraryTransform):
             return self._maybe_scale(vectors, eigvals)
         return vectors, eigvals
 
+    def _expert_prototypes(self, expert, base_model=None):
+        """Arrow prototypes of each layer of `expert`, the layers of a same shape are
+        decomposed in a single batch."""
+        # get parameters tied during training
+        param_map = get_target_2_source_param_mapping(
+            expert.expert_weights.items(),
+            expert.expert_info.expert_config.tie_params,
+        )
+        if self.config.tie_params != "default":
+            # get parameters we wish to tie for Arrow
+            _tied_params = get_target_2_source_param_mapping(
+                expert.expert_weights.items(), self.config.tie_params
+            )
+            # Make sure that params tied during training are also tied for Arrow
+            if any(key not in _tied_params for key in param_map):
+                logger.warning(
+                    "Some parameters that are tied during training are not tied during Arrow computation."
+                )
+            param_map = _tied_params
+
+        tied_params = list(param_map.keys()) + list(param_map.values())
+        assert all(
+            "lora_b" not in param_name for param_name in tied_params
+        ), "Support for tied B not available"
+        assert all(
+            "lora_a" in param_name for param_name in tied_params
+        ), "Only support tied As for now"
+
+        # Now that we know only A's are tied, we can proceed using only the parent names
+        # e.g. 'model.layers.30.self_attn.q_proj' instead of 'model.layers.30.self_attn.q_proj.lora_a'
+        tied_parents = self._get_unique_parent_names(tied_params)
+
+        untied_parents = [
+            parent
+            for parent in self._get_unique_parent_names(expert.expert_weights.keys())
+            if parent not in tied_parents
+        ]
+
+        # Build a mapping from source to target parameters
+        # e.g. <name_of_parent_of_param> : [<list of all other params tied to it>]
+        # NOTE: list will be empty if the param is not tied to anything
+        tied_param_bins = defaultdict(list)
+
+        for tgt_name, src_name in param_map.items():
+            parent_src = ".".join(src_name.split(".")[:-1])
+            parent_tgt = ".".join(tgt_name.split(".")[:-1])
+            tied_param_bins[parent_src].append(parent_tgt)
+        for parent in untied_parents:
+            tied_param_bins[parent] = []
+
+        # (parent names, A, B, base weights) of each group of tied parameters
+        layers = []
+        for parent_name, dependents in tied_param_bins.items():
+            parent_names = [parent_name]
+            A_name, B_name = f"{parent_name}.lora_a", f"{parent_name}.lora_b"
+            As = [expert.expert_weights[A_name]]
+            Bs = [expert.expert_weights[B_name]]
+            base_W = []
+
+            for tied_module in dependents:
+                logger.info(f"\t\t\tTying Arrow with {tied_module}")
+                As += [expert.expert_weights[f"{tied_module}.lora_a"]]
+                Bs += [expert.expert_weights[f"{tied_module}.lora_b"]]
+                parent_names += [tied_module]
+
+                if not self.config.ab_only:
+                    base_W += [base_model.model.state_dict()[f"{tied_module}.weight"]]
+
+            if len(As) > 1:
+                if self.config.tie_op == "concat":
+                    # Mimicking phi-2 behavior
+                    assert self.config.ab_only
+                    assert all(
+                        torch.allclose(A, As[0]) for A in As
+                    ), "A should be the same for all tied parameters"
+                    A = As[0]
+                    B = torch.cat(Bs, dim=1)
+                elif self.config.tie_op == "sum":
+                    # A1B1 + A2B2 == [A1 A2] [B1; B2].
+                    # We do it this way to leverage the low-rank SVD
+                    A = torch.cat(As, dim=1)
+                    B = torch.cat(Bs, dim=0)
+                else:
+                    raise NotImplementedError()
+            else:
+                A, B = As[0], Bs[0]
+
+            # Reshape As and Bs (needed for Poly / MHR weights)
+            rank = expert.expert_config.lora_rank
+            A = A.reshape(-1, rank).float()
+            B = B.reshape(rank, -1).float()
+            layers.append((parent_names, A, B, base_W))
+
+        prototypes = []
+        if self.config.ab_only:
+            by_shape = defaultdict(list)
+            for layer in layers:
+                by_shape[(layer[1].shape, layer[2].shape)].append(layer)
+
+            for group in by_shape.values():
+                logger.info(
+                    f"\tComputing SVD for {len(group)} parameters of shape {group[0][1].shape}"
+                )
+                top_vectors, top_values = self._low_rank_top_eigenvectors(
+                    torch.stack([A for _, A, _, _ in group]),
+                    torch.stack([B for _, _, B, _ in group]),
+                )
+                prototypes += [
+                    (parent_names, top_vector, top_value)
+                    for (parent_names, _, _, _), top_vector, top_value in zip(
+                        group, top_vectors, top_values
+                    )
+                ]
+        else:
+            for parent_names, A, B, base_W in layers:
+                logger.info(f"\tComputing SVD for parameter {parent_names[0]}")
+
+                W = (A @ B).T  # out_features, in_features
+                base_W += [
+                    base_model.model.state_dict()[f"{parent_names[0]}.weight"]
+                ].float()
+                base_W = torch.stack(base_W).sum(0)
+                W += base_W
+                U, E, Vt = torch.linalg.svd(W)
+                top_vector = Vt[0]
+                bottom_vector = Vt[-1]
+                top_value = E[0]
+
+                # Check that top vector is indeed the top eigenvector
+                WTW = W.T @ W
+                assert (WTW @ top_vector).pow(2).sum() > (WTW @ bottom_vector).pow(
+                    2
+                ).sum()
+                prototypes.append((parent_names, top_vector, top_value))
+
+        # Save eigenvector and eigvenvalue
+        vectors, eigvals = {}, {}
+        for parent_names, top_vector, top_value in prototypes:
+            for parent in parent_names:
+                assert parent not in vectors
+                vectors[parent] = top_vector.real.cpu().numpy()
+                eigvals[parent] = top_value.item()
+        return vectors, eigvals
+
     @torch.no_grad()
     def transform(
         self,
@@ -978,160 +1696,35 @@ class ArrowTransform(LibraryTransform):
         base_model = None
 
         vectors, eigvals = self.fetch(library, scale=False)
-        already_computed = []
-        for expert_name, expert in library.items():
-            if expert_name in vectors and not recompute:
+
+        # the experts missing prototypes are found from the metadata of the library,
+        # only their weights are downloaded
+        to_compute = []
+        for expert_name in library.keys():
+            if expert_name in vectors and expert_name in eigvals and not recompute:
                 logger.info(
                     "Found precomputed Arrow prototypes for expert {}".format(
                         expert_name
                     )
                 )
-                already_computed.append(expert_name)
-                continue
-
-            logger.info(f"Computing SVD for expert {expert_name}")
-            vectors[expert_name] = {}
-            eigvals[expert_name] = {}
-
-            if base_model is None and not self.config.ab_only:
-                training_config = expert.training_config
-                training_config.model_modifier = None
-                from mttl.models.lightning.expert_module import MultiExpertModule
+            else:
+                to_compute.append(expert_name)
 
-                base_model = MultiExpertModule(**vars(training_config))
+        if to_compute and not self.config.ab_only:
+            base_model = self._load_base_model(library)
 
-            # get parameters tied during training
-            param_map = get_target_2_source_param_mapping(
-                expert.expert_weights.items(),
-                expert.expert_info.expert_config.tie_params,
+        for expert in library.prefetch(
+            to_compute, max_concurrency=self.config.max_concurrency
+        ):
+            logger.info(f"Computing SVD for expert {expert.name}")
+            vectors[expert.name], eigvals[expert.name] = self._expert_prototypes(
+                expert, base_model
             )
-            if self.config.tie_params != "default":
-                # get parameters we wish to tie for Arrow
-                _tied_params = get_target_2_source_param_mapping(
-                    expert.expert_weights.items(), self.config.tie_params
-                )
-                # Make sure that params tied during training are also tied for Arrow
-                if any(key not in _tied_params for key in param_map):
-                    logger.warning(
-                        "Some parameters that are tied during training are not tied during Arrow computation."
-                    )
-                param_map = _tied_params
-
-            tied_params = list(param_map.keys()) + list(param_map.values())
-            assert all(
-                "lora_b" not in param_name for param_name in tied_params
-            ), "Support for tied B not available"
-            assert all(
-                "lora_a" in param_name for param_name in tied_params
-            ), "Only support tied As for now"
-
-            # Now that we know only A's are tied, we can proceed using only the parent names
-            # e.g. 'model.layers.30.self_attn.q_proj' instead of 'model.layers.30.self_attn.q_proj.lora_a'
-            tied_parents = self._get_unique_parent_names(tied_params)
-
-            untied_parents = [
-                parent
-                for parent in self._get_unique_parent_names(
-                    expert.expert_weights.keys()
-                )
-                if parent not in tied_parents
-            ]
-
-            # Build a mapping from source to target parameters
-            # e.g. <name_of_parent_of_param> : [<list of all other params tied to it>]
-            # NOTE: list will be empty if the param is not tied to anything
-            tied_param_bins = defaultdict(list)
-
-            for tgt_name, src_name in param_map.items():
-                parent_src = ".".join(src_name.split(".")[:-1])
-                parent_tgt = ".".join(tgt_name.split(".")[:-1])
-                tied_param_bins[parent_src].append(parent_tgt)
-            for parent in untied_parents:
-                tied_param_bins[parent] = []
-
-            for parent_name, dependents in tied_param_bins.items():
-                logger.info(f"\tComputing SVD for parameter {parent_name}")
-
-                parent_names = [parent_name]
-                A_name, B_name = f"{parent_name}.lora_a", f"{parent_name}.lora_b"
-                As = [expert.expert_weights[A_name]]
-                Bs = [expert.expert_weights[B_name]]
-                base_W = []
-
-                for tied_module in dependents:
-                    logger.info(f"\t\t\tTying Arrow with {tied_module}")
-                    As += [expert.expert_weights[f"{tied_module}.lora_a"]]
-                    Bs += [expert.expert_weights[f"{tied_module}.lora_b"]]
-                    parent_names += [tied_module]
-
-                    if not self.config.ab_only:
-                        base_W += [
-                            base_model.model.state_dict()[f"{tied_module}.weight"]
-                        ]
-
-                if len(As) > 1:
-                    if self.config.tie_op == "concat":
-                        # Mimicking phi-2 behavior
-                        assert self.config.ab_only
-                        assert all(
-                            torch.allclose(A, As[0]) for A in As
-                        ), "A should be the same for all tied parameters"
-                        A = As[0]
-                        B = torch.cat(Bs, dim=1)
-                    elif self.config.tie_op == "sum":
-                        # A1B1 + A2B2 == [A1 A2] [B1; B2].
-                        # We do it this way to leverage the low-rank SVD
-                        A = torch.cat(As, dim=1)
-                        B = torch.cat(Bs, dim=0)
-                    else:
-                        raise NotImplementedError()
-                else:
-                    A, B = As[0], Bs[0]
-
-                # Reshape As and Bs (needed for Poly / MHR weights)
-                rank = expert.expert_config.lora_rank
-                A = A.reshape(-1, rank).float()
-                B = B.reshape(rank, -1).float()
-
-                W = (A @ B).T  # out_features, in_features
-
-                if self.config.ab_only:
-                    U_W, Sigma_W, _ = self._low_rank_svd(A, B)
-                    top_value = Sigma_W[0] ** 2
-                    bottom_vector = U_W[:, -1]
-                    top_vector = U_W[:, 0]
-                else:
-                    base_W += [
-                        base_model.model.state_dict()[f"{parent_name}.weight"]
-                    ].float()
-                    base_W = torch.stack(base_W).sum(0)
-                    W += base_W
-                    U, E, Vt = torch.linalg.svd(W)
-                    top_vector = Vt[0]
-                    bottom_vector = Vt[-1]
-                    top_value = E[0]
-
-                # Check that top vector is indeed an eigenvector
-                WTW = W.T @ W
-                ratio = WTW @ top_vector / (top_vector * top_value)
-                torch.allclose(ratio, torch.ones_like(ratio), atol=1e-3)
-
-                # Check that top vector is indeed the top eigenvector
-                assert (WTW @ top_vector).pow(2).sum() > (WTW @ bottom_vector).pow(
-                    2
-                ).sum()
-
-                # Save eigenvector and eigvenvalue
-                for parent in parent_names:
-                    assert parent not in vectors[expert_name]
-                    vectors[expert_name][parent] = top_vector.real.cpu().numpy()
-                    eigvals[expert_name][parent] = top_value.item()
 
-        to_upload = [x for x in library.keys() if x not in already_computed]
-        if persist and len(to_upload) > 0:
+        if persist and len(to_compute) > 0:
             # add embeddings to the library
             with library.batched_commit():
-                for expert_name in to_upload:
+                for expert_name in to_compute:
                     logger.info(
                         f"Uploading centroids to the library for expert {expert_name}"
                     )
@@ -0,0 +1,202 @@
+from typing import Callable, List, Optional, Sequence, Union
+
+import torch
+
+# top-k routing is executed sparsely when the experts selected per token are at most
+# this fraction of all the experts, otherwise mixing the dense weights is cheaper
+SPARSE_TOPK_MAX_RATIO = 0.5
+
+
+def use_sparse_topk(top_k: int, n_experts: int) -> bool:
+    """Whether top-k routing over `n_experts` experts should be run with `sparse_topk_lora_forward`."""
+    return top_k <= SPARSE_TOPK_MAX_RATIO * n_experts
+
+
+def group_by_expert(indices: torch.Tensor, n_experts: int):
+    """Sorts the tokens by expert.
+
+    Returns the permutation putting the tokens of each expert in a contiguous block,
+    and the number of tokens routed to each expert.
+    """
+    order = torch.argsort(indices, stable=True)
+    counts = torch.bincount(indices, minlength=n_experts)
+    return order, counts
+
+
+def _grouped_apply(
+    input: torch.Tensor,
+    indices: torch.Tensor,
+    n_experts: int,
+    out_features: int,
+    block_fn: Callable,
+    weights: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """Calls `block_fn(expert_index, block, block_weights)` once per expert, on the contiguous
+    block of the tokens routed to it, and sums the outputs of the experts of each token.
+
+    `indices` and `weights` have shape (n_tokens,) or (n_tokens, k) if each token is routed
+    to k experts.
+    """
+    n_tokens = input.size(0)
+    top_k = 1 if indices.ndim == 1 else indices.size(-1)
+    if n_tokens == 0:
+        return input.new_zeros(0, out_features)
+
+    indices = indices.reshape(-1)
+    if weights is not None:
+        weights = weights.reshape(-1)
+
+    order, counts = group_by_expert(indices, n_experts)
+    # tokens are often already grouped, e.g. consecutive examples routed to the same expert
+    is_sorted = top_k == 1 and bool((indices[1:] >= indices[:-1]).all())
+    if not is_sorted:
+        input = input.index_select(0, order // top_k)
+        if weights is not None:
+            weights = weights.index_select(0, order)
+
+    blocks, start = [], 0
+    # the sizes of the blocks are copied to the host once, they drive the loop
+    for expert_index, count in enumerate(counts.tolist()):
+        if count == 0:
+            continue
+        blocks.append(
+            block_fn(
+                expert_index,
+                input[start : start + count],
+                None if weights is None else weights[start : start + count],
+            )
+        )
+        start += count
+
+    output = blocks[0] if len(blocks) == 1 else torch.cat(blocks, dim=0)
+    if not is_sorted:
+        # scatter back to the original order, gathering with the inverse permutation is much
+        # faster than index_copy on cpu
+        inverse_order = torch.empty_like(order)
+        inverse_order[order] = torch.arange(order.numel(), device=order.device)
+        output = output.index_select(0, inverse_order)
+
+    if top_k > 1:
+        output = output.view(n_tokens, top_k, -1).sum(dim=1)
+    return output
+
+
+def grouped_matmul(
+    input: torch.Tensor,
+    matrices: Union[Sequence[torch.Tensor], torch.Tensor],
+    indices: torch.Tensor,
+    weights: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """Computes `sum_j weights[i, j] * input[i] @ matrices[indices[i, j]]` for every token i,
+    with one matmul per expert."""
+
+    def _block_fn(expert_index, block, block_weights):
+        block = block.matmul(matrices[expert_index])
+        if block_weights is not None:
+            block = block * block_weights.unsqueeze(-1)
+        return block
+
+    return _grouped_apply(
+        input, indices, len(matrices), matrices[0].size(-1), _block_fn, weights
+    )
+
+
+def grouped_lora_forward(
+    input: torch.Tensor,
+    lora_a: Union[Sequence[torch.Tensor], torch.Tensor],
+    lora_b: Union[Sequence[torch.Tensor], torch.Tensor],
+    indices: torch.Tensor,
+    scaling: Sequence[float],
+    weights: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """Applies a different low-rank adapter to each token, without copying the adapters.
+
+    Tokens are gathered into one contiguous block per expert, each block goes through a single
+    low-rank matmul with the weights of its expert, and the results are scattered back in the
+    original order. The cost is independent of how many tokens share an expert.
+
+    Args:
+        input: (n_tokens, in_features) input of the adapters.
+        lora_a: A matrices of the experts, each of shape (in_features, rank).
+        lora_b: B matrices of the experts, each of shape (rank, out_features).
+        indices: (n_tokens,) index of the expert applied to each token, or (n_tokens, k)
+            indices of k experts whose outputs are summed.
+        scaling: scaling factor of each expert.
+        weights: optional weights multiplying the output of each expert, same shape as `indices`.
+
+    Returns:
+        (n_tokens, out_features) output of the adapters.
+    """
+
+    def _block_fn(expert_index, block, block_weights):
+        # scale in the low-rank space, the cheapest place to do it
+        hidden = block.matmul(lora_a[expert_index]) * scaling[expert_index]
+        if block_weights is not None:
+            hidden = hidden * block_weights.unsqueeze(-1)
+        return hidden.matmul(lora_b[expert_index])
+
+    return _grouped_apply(
+        input, indices, len(lora_a), lora_b[0].size(-1), _block_fn, weights
+    )
+
+
+def sparse_topk_lora_forward(
+    input: torch.Tensor,
+    lora_a: Union[Sequence[torch.Tensor], torch.Tensor],
+    lora_b: Union[Sequence[torch.Tensor], torch.Tensor],
+    indices: torch.Tensor,
+    weights: torch.Tensor,
+    scaling: float,
+    merge_after: bool = False,
+) -> torch.Tensor:
+    """Top-k routing of each token to a weighted combination of experts, computing only
+    the low-rank products of the k selected experts.
+
+    Equivalent to mixing the weights of the experts per token, as
+    `SkilledLoRA.parallel_linear_weighted_forward` does with dense routing weights:
+        - merge_after=False: `x @ (sum_j w_j A_j) @ (sum_j w_j B_j)`
+        - merge_after=True: `sum_j w_j x @ A_j @ B_j`
+
+    Args:
+        input: (n_tokens, in_features) input of the adapters.
+        indices: (n_tokens, k) indices of the experts selected for each token.
+        weights: (n_tokens, k) routing weights of the selected experts.
+    """
+    if merge_after:
+        return grouped_lora_forward(
+            input, lora_a, lora_b, indices, [scaling] * len(lora_a), weights
+        )
+
+    # the mixture of the A matrices only needs the k projections of each token
+    hidden = grouped_matmul(input, lora_a, indices, weights)
+    return grouped_matmul(hidden, lora_b, indices, weights) * scaling
+
+
+def grouped_lora_forward_reference(
+    input: torch.Tensor,
+    lora_a: Union[Sequence[torch.Tensor], torch.Tensor],
+    lora_b: Union[Sequence[torch.Tensor], torch.Tensor],
+    indices: torch.Tensor,
+    scaling: Sequence[float],
+    weights: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """Token by token reference implementation of `grouped_lora_forward`, computed on cpu."""
+    if indices.ndim == 1:
+        indices = indices.unsqueeze(-1)
+        weights = None if weights is None else weights.unsqueeze(-1)
+
+    outputs: List[torch.Tensor] = []
+    for token, token_indices in enumerate(indices.tolist()):
+        output = 0.0
+        for j, expert_index in enumerate(token_indices):
+            expert_output = (
+                input[token].cpu()
+                @ lora_a[expert_index].cpu()
+                @ lora_b[expert_index].cpu()
+                * scaling[expert_index]
+            )
+            if weights is not None:
+                expert_output = expert_output * weights[token, j].cpu()
+            output = output + expert_output
+        outputs.append(output)
+    return torch.stack(outputs, dim=0)
@@ -14,6 +14,8 @@ from mttl.models.modifiers.base import (
     ModifierConfig,
     ModifyMixin,
 )
+from mttl.models.modifiers.grouped_lora import grouped_lora_forward
+from mttl.models.utils import append_rows, reserve_rows
 
 
 @dataclass
@@ -157,6 +159,11 @@ class LoRA(Modifier, MergeableModifierMixin, ModifyMixin):
 
     @classmethod
     def parallel_linear_forward(cls, input, loras):
+        """Applies `loras[i]` to the i-th example of the batch, or a single lora to all of them.
+
+        Examples are grouped by lora, and each distinct lora runs once over the tokens of its
+        examples, so the weights are never copied per example.
+        """
         if any([lora.merged_with_layer for lora in loras]):
             raise ValueError("Cannot parallelize merged loras.")
         if len(set([lora.layer for lora in loras])) > 1:
@@ -165,34 +172,40 @@ class LoRA(Modifier, MergeableModifierMixin, ModifyMixin):
         if len(loras) not in [1, input.shape[0]]:
             raise ValueError("Needed either 1 lora or as many batch examples.")
 
-        # (batch, in_features, rank)
-        lora_a = torch.stack([lora.lora_a for lora in loras], dim=0)
-        # (batch, rank, out_features)
-        lora_b = torch.stack([lora.lora_b for lora in loras], dim=0)
-
-        # (batch,)
-        scaling = torch.cat(
-            [torch.FloatTensor([lora.scaling]) for lora in loras], dim=0
-        ).to(device=lora_a.device, dtype=lora_a.dtype)
-
         # (n_examples, seq_len, out_features)
         layer_out = loras[0].layer(input)
         input_lora = input.to(loras[0].lora_a.dtype)
         input_lora = loras[0].dropout_layer(input_lora)
 
-        if lora_a.size(0) == 1:
-            lora_a, lora_b = lora_a.squeeze(0), lora_b.squeeze(0)
-            adapter_out = torch.einsum("bsi,ir->bsr", (input_lora, lora_a))
-            adapter_out = (
-                torch.einsum("bsr,ro->bso", (adapter_out, lora_b))
-                * scaling[:, None, None]
-            )
-        else:
+        if len(loras) == 1:
+            lora = loras[0]
             adapter_out = (
-                torch.bmm(torch.bmm(input_lora, lora_a), lora_b)
-                * scaling[:, None, None]
+                torch.matmul(torch.matmul(input_lora, lora.lora_a), lora.lora_b)
+                * lora.scaling
             )
-
+            return layer_out + adapter_out.to(dtype=input.dtype)
+
+        # distinct loras, and index of the lora of each example
+        unique_loras = {}
+        example_indices = [
+            unique_loras.setdefault(lora, len(unique_loras)) for lora in loras
+        ]
+        unique_loras = list(unique_loras)
+
+        # one row per token, tokens of an example share its lora
+        n_tokens_per_example = input_lora[0].numel() // input_lora.shape[-1]
+        token_indices = torch.tensor(
+            example_indices, device=input_lora.device
+        ).repeat_interleave(n_tokens_per_example)
+
+        adapter_out = grouped_lora_forward(
+            input_lora.reshape(-1, input_lora.shape[-1]),
+            [lora.lora_a for lora in unique_loras],
+            [lora.lora_b for lora in unique_loras],
+            token_indices,
+            [lora.scaling for lora in unique_loras],
+        )
+        adapter_out = adapter_out.view(*input_lora.shape[:-1], -1)
         return layer_out + adapter_out.to(dtype=input.dtype)
 
     def reset_parameters(self):
@@ -256,24 +269,17 @@ class SkilledLoRA(LoRA):
             1, self.rank, self.n_splits, self.out_features // self.n_splits
         ).to(device=self.lora_a.device, dtype=self.lora_a.dtype)
 
+    def reserve(self, n_skills: int) -> None:
+        """Preallocates room for `n_skills` skills, so that adding skills up to that
+        number does not copy the weights."""
+        self.lora_a.data = reserve_rows(self.lora_a.data, n_skills)
+        self.lora_b.data = reserve_rows(self.lora_b.data, n_skills)
+
     def add_skill(self, lora: Union[LoRA, "SkilledLoRA"]) -> None:
         """Adds a skill to the skilled lora by copying the weights of the given lora."""
-        self.lora_a.data = torch.cat(
-            [
-                self.lora_a.data,
-                torch.zeros(1, *self.lora_a.data.shape[1:]).to(
-                    device=self.lora_a.device, dtype=self.lora_a.dtype
-                ),
-            ]
-        )
-        self.lora_b.data = torch.cat(
-            [
-                self.lora_b.data,
-                torch.zeros(1, *self.lora_b.data.shape[1:]).to(
-                    device=self.lora_b.device, dtype=self.lora_b.dtype
-                ),
-            ]
-        )
+        # the storage grows geometrically, see `reserve` to allocate it once
+        self.lora_a.data = append_rows(self.lora_a.data)
+        self.lora_b.data = append_rows(self.lora_b.data)
 
         self.set_skill(lora, self.n_skills)
         self.n_skills += 1
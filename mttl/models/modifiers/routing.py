@@ -1,5 +1,5 @@
 from dataclasses import dataclass, field, fields
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 import torch
 
@@ -20,6 +20,29 @@ class RoutingInfo:
     packed_seq_lens: List[int] = None
     seq_lens: List[int] = None
     packed_attn_mask: torch.Tensor = None
+    _packed_segments: List = field(default=None, repr=False)
+
+    def packed_segments(self) -> List[List[Tuple[int, int]]]:
+        """(start, end) offsets of the sequences packed in each row of the batch.
+
+        Computed once per batch from `seq_lens`, so that the attention layers don't copy the
+        lengths to the host at every call.
+        """
+        if self._packed_segments is None:
+            seq_lens = self.seq_lens
+            if isinstance(seq_lens, torch.Tensor):
+                seq_lens = seq_lens.tolist()
+
+            self._packed_segments = []
+            for row_lens in seq_lens:
+                segments, start = [], 0
+                for seq_len in row_lens:
+                    # rows are padded with zero lengths
+                    if seq_len > 0:
+                        segments.append((start, start + seq_len))
+                        start += seq_len
+                self._packed_segments.append(segments)
+        return self._packed_segments
 
     @classmethod
     def pop_elements(cls, batch, keep=None):
@@ -118,6 +118,15 @@ class SelectorLog(Callback):
         # get routing attributes of all layers
         if current_step % self.plot_every != 0:
             return
+
+        # the selectors push tensors, they are only aggregated here
+        metric_logger = Selector.metric_logger
+        if metric_logger.enabled:
+            for name, meter in metric_logger.meters.items():
+                # per-task and per-layer statistics are kept for the evaluation tables
+                if "/" not in name and len(meter.deque):
+                    pl_module.log(f"{split}/selectors/{name}", meter.avg)
+
         all_routing_gates = []
         for name, module in pl_module.named_modules():
             if isinstance(module, Selector) and hasattr(module, "routing_gates"):
@@ -11,16 +11,114 @@ from mttl.models.expert_context import InfoContainer
 """ Pytorch SDPA Patching """
 
 
+def packed_attention_mask(seq_lens: torch.Tensor, seq_len: int) -> torch.Tensor:
+    """Dense (bs, 1, seq_len, seq_len) block lower-triangular mask of packed sequences.
+
+    Only used as a reference for `packed_scaled_dot_product_attention`, which never
+    materializes it.
+    """
+    seq_lens = torch.as_tensor(seq_lens)
+    bs = seq_lens.size(0)
+    # id of the sequence each position belongs to, padding gets the id of the row length
+    ends = seq_lens.cumsum(-1)
+    positions = torch.arange(seq_len).expand(bs, seq_len)
+    sequence_ids = torch.searchsorted(ends, positions.contiguous(), right=True)
+    is_padding = positions >= ends[:, -1:]
+
+    mask = sequence_ids[:, :, None] == sequence_ids[:, None, :]
+    # padding tokens attend the previous context, otherwise SDPA has nans
+    mask = mask & ~is_padding[:, None, :]
+    mask = mask | (is_padding[:, :, None] & ~is_padding[:, None, :])
+    return mask.tril().unsqueeze(1)
+
+
+def packed_scaled_dot_product_attention(
+    query,
+    key,
+    value,
+    segments,
+    dropout_p=0.0,
+    scale=None,
+    enable_gqa=False,
+) -> torch.Tensor:
+    """Causal attention restricted to each of the sequences packed in the rows of the batch.
+
+    Attention is computed block by block, one causal block per packed sequence, so no
+    (seq_len, seq_len) mask is ever built. Matches attending with `packed_attention_mask`.
+
+    Args:
+        query, key, value: (bs, heads, seq_len, head_dim) inputs of the attention.
+        segments: (start, end) offsets of the sequences packed in each row, see
+            `RoutingInfo.packed_segments`.
+    """
+    if query.size(-2) != key.size(-2):
+        raise ValueError(
+            "Packed attention expects queries and keys of the same length."
+        )
+
+    kwargs = {"dropout_p": dropout_p, "scale": scale}
+    if enable_gqa:
+        kwargs["enable_gqa"] = enable_gqa
+
+    seq_len = query.size(-2)
+    rows = []
+    for i, row_segments in enumerate(segments):
+        blocks = [
+            torch.nn.functional._default_scaled_dot_product_attention(
+                query[i : i + 1, :, start:end],
+                key[i : i + 1, :, start:end],
+                value[i : i + 1, :, start:end],
+                is_causal=True,
+                **kwargs,
+            )
+            for start, end in row_segments
+        ]
+
+        end = row_segments[-1][1] if row_segments else 0
+        if end < seq_len:
+            # padding tokens attend the whole packed context
+            blocks.append(
+                torch.nn.functional._default_scaled_dot_product_attention(
+                    query[i : i + 1, :, end:],
+                    key[i : i + 1, :, : max(end, 1)],
+                    value[i : i + 1, :, : max(end, 1)],
+                    **kwargs,
+                )
+            )
+        rows.append(torch.cat(blocks, dim=-2) if len(blocks) > 1 else blocks[0])
+    return torch.cat(rows, dim=0)
+
+
 def scaled_dot_product_attention(
-    query, key, value, attn_mask=None, dropout_p=0.0, is_causal=False, scale=None
+    query,
+    key,
+    value,
+    attn_mask=None,
+    dropout_p=0.0,
+    is_causal=False,
+    scale=None,
+    enable_gqa=False,
 ) -> torch.Tensor:
     from mttl.models.expert_context import InfoContainer
 
     context = InfoContainer.get()
-    if context is not None and context._routing_infos.packed_seq_lens is not None:
-        attn_mask = context._routing_infos.packed_attn_mask
+    routing_infos = context.routing_infos if context is not None else None
+    if routing_infos is not None and routing_infos.packed_seq_lens is not None:
+        if routing_infos.packed_attn_mask is None:
+            return packed_scaled_dot_product_attention(
+                query,
+                key,
+                value,
+                routing_infos.packed_segments(),
+                dropout_p=dropout_p,
+                scale=scale,
+                enable_gqa=enable_gqa,
+            )
+        # a dense mask was provided with the batch
+        attn_mask = routing_infos.packed_attn_mask
         is_causal = False
 
+    kwargs = {"enable_gqa": enable_gqa} if enable_gqa else {}
     return torch.nn.functional._default_scaled_dot_product_attention(
         query,
         key,
@@ -29,6 +127,7 @@ def scaled_dot_product_attention(
         dropout_p=dropout_p,
         is_causal=is_causal,
         scale=scale,
+        **kwargs,
     )
 
 
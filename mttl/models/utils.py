@@ -1,6 +1,8 @@
+import math
 import os
 import re
 from collections import defaultdict, deque
+from functools import partial
 
 import prettytable
 import torch
@@ -50,6 +52,47 @@ def get_global_batch_size(batch_size, accumulation_steps):
     return global_bs
 
 
+def rows_capacity(tensor: torch.Tensor) -> int:
+    """Number of rows that fit in the storage of `tensor`, which can exceed its first dimension
+    if it was preallocated with `reserve_rows`."""
+    if tensor.ndim == 0 or not tensor.is_contiguous() or tensor.storage_offset() != 0:
+        return tensor.shape[0] if tensor.ndim else 0
+
+    row_bytes = math.prod(tensor.shape[1:]) * tensor.element_size()
+    if row_bytes == 0:
+        return tensor.shape[0]
+    return tensor.untyped_storage().nbytes() // row_bytes
+
+
+def reserve_rows(tensor: torch.Tensor, capacity: int) -> torch.Tensor:
+    """Returns `tensor`, moved to a storage with room for at least `capacity` rows if needed.
+
+    The previous tensor must not be used afterwards, rows appended with `append_rows` are
+    written in the spare room of the shared storage.
+    """
+    if rows_capacity(tensor) >= capacity:
+        return tensor
+
+    buffer = tensor.new_empty((capacity,) + tuple(tensor.shape[1:]))
+    buffer[: tensor.shape[0]] = tensor
+    return buffer[: tensor.shape[0]]
+
+
+def append_rows(tensor: torch.Tensor, n_rows: int = 1) -> torch.Tensor:
+    """Returns `tensor` with `n_rows` zero rows appended along its first dimension.
+
+    The storage grows geometrically, so appending rows one at a time costs an amortized
+    constant number of copies per row instead of copying the whole tensor each time.
+    """
+    n, size = tensor.shape[0], tensor.shape[0] + n_rows
+    if rows_capacity(tensor) < size:
+        tensor = reserve_rows(tensor, max(size, 2 * n))
+
+    tensor = tensor.as_strided((size,) + tuple(tensor.shape[1:]), tensor.stride())
+    tensor[n:].zero_()
+    return tensor
+
+
 def prepare_model_for_kbit_training(model, use_gradient_checkpointing=True):
     r"""
     This method wraps the entire protocol for preparing a model before running a training. This includes:
@@ -168,6 +211,9 @@ def model_loader_helper(
 class SmoothedValue(object):
     """Track a series of values and provide access to smoothed values over a
     window or the global series average.
+
+    Values can be (detached) tensors on any device, they are only copied to the host
+    when a statistic is read, so that updating does not synchronize with the device.
     """
 
     def __init__(self, window_size=20, fmt=None):
@@ -177,41 +223,95 @@ class SmoothedValue(object):
         self.total = 0.0
         self.count = 0
         self.fmt = fmt
+        self._window = None
 
     def update(self, value, n=1):
+        if isinstance(value, torch.Tensor):
+            value = value.detach()
         self.deque.append(value)
         self.count += n
         self.total += value * n
+        self._window = None
+
+    @property
+    def window(self) -> torch.Tensor:
+        """The values of the window as a float32 cpu tensor, computed once per update."""
+        if self._window is None:
+            values = [
+                (
+                    value.float().reshape(())
+                    if isinstance(value, torch.Tensor)
+                    else torch.tensor(value, dtype=torch.float32)
+                )
+                for value in self.deque
+            ]
+            self._window = torch.stack(values).cpu() if values else torch.zeros(0)
+        return self._window
 
     @property
     def median(self):
-        d = torch.tensor(list(self.deque))
-        return d.median().item()
+        return self.window.median().item()
 
     @property
     def avg(self):
-        d = torch.tensor(list(self.deque), dtype=torch.float32)
-        return d.mean().item()
+        return self.window.mean().item()
+
+    @property
+    def global_avg(self):
+        return float(self.total) / self.count
 
     @property
     def max(self):
-        return max(self.deque)
+        return self.window.max().item()
 
     @property
     def value(self):
-        return self.deque[-1]
+        return self.window[-1].item()
+
+    def percentile(self, q):
+        """The q-th percentile of the window, q in [0, 100]."""
+        return torch.quantile(self.window, q / 100.0).item()
+
+    def histogram(self, bins=10):
+        """Histogram of the window, returns the counts and the bin edges."""
+        window = self.window
+        counts = torch.histc(
+            window, bins=bins, min=window.min().item(), max=window.max().item()
+        )
+        edges = torch.linspace(window.min().item(), window.max().item(), bins + 1)
+        return counts, edges
 
 
 class MetricLogger(object):
-    def __init__(self):
-        self.meters = defaultdict(SmoothedValue)
+    """Collects named metrics, see `SmoothedValue`.
+
+    `sample_rate` is the fraction of the steps that are logged, see `should_log`, and
+    disabled loggers should not be fed at all.
+    """
+
+    def __init__(self, window_size=20, enabled=True, sample_rate=1.0):
+        self.meters = defaultdict(partial(SmoothedValue, window_size=window_size))
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+
+    def configure(self, enabled=None, sample_rate=None):
+        if enabled is not None:
+            self.enabled = enabled
+        if sample_rate is not None:
+            if not 0.0 < sample_rate <= 1.0:
+                raise ValueError(f"sample_rate must be in (0, 1], got {sample_rate}.")
+            self.sample_rate = sample_rate
+
+    def should_log(self, step: int) -> bool:
+        """Whether the metrics of the given step are logged, one every 1 / sample_rate steps."""
+        if not self.enabled:
+            return False
+        return step % max(1, round(1.0 / self.sample_rate)) == 0
 
     def update(self, prefix=None, value_dict={}):
         prefix = "" if prefix is None else f"{prefix}/"
         for k, v in value_dict.items():
-            if isinstance(v, torch.Tensor):
-                v = v.item()
-            assert isinstance(v, (float, int))
+            assert isinstance(v, (float, int, torch.Tensor))
             self.meters[f"{prefix}{k}"].update(v)
 
     def __getattr__(self, attr):
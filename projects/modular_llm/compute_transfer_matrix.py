@@ -1,10 +1,13 @@
 import copy
 import os
+from contextlib import contextmanager
 from functools import partial
 from tempfile import TemporaryDirectory
-from typing import Callable, Union
 
+import pandas as pd
 import seaborn as sns
+import torch
+import tqdm
 import wandb
 from matplotlib import pyplot as plt
 from pytorch_lightning import seed_everything
@@ -17,9 +20,12 @@ from mttl.evaluators.evaluators import (
     ExtendedRougeEvaluator,
 )
 from mttl.logging import TableLogger, init_wandb_logger, logger
+from mttl.models.containers.selectors.base import TaskNameSelectorConfig
+from mttl.models.expert_model import MultiExpertModel
 from mttl.models.library.expert import Expert, load_expert
 from mttl.models.library.expert_library import ExpertLibrary, LocalExpertLibrary
-from mttl.models.lightning.expert_module import ExpertModule
+from mttl.models.lightning.expert_module import MultiExpertModule
+from mttl.models.utils import compute_loglike_loss, transfer_batch_to_device
 from mttl.utils import remote_login
 from mttl.vllm_engines.engines import free_memory
 
@@ -28,80 +34,113 @@ class TransferMatrixConfig(EvaluationConfig):
     only_diagonal = False
     eval_base = True
     transfer_matrix_split = "test"
+    # experts evaluated in the same forward, when the metric is the loss
+    experts_per_forward = 4
+
+
+PARTIAL_MATRIX_FILE = "transfer_matrix_partial.csv"
+
+
+@contextmanager
+def task_routing(model: MultiExpertModel, task_to_expert_name, default_expert_name):
+    """Overrides the routing of the task selectors: examples are routed by task name with
+    `task_to_expert_name`, or else to `default_expert_name`. Swaps the experts without
+    reloading the model."""
+    selectors = {
+        id(selector): selector
+        for selectors in model.selectors.values()
+        for selector in selectors
+    }.values()
+    states = [
+        (selector._task_to_expert_name, selector.default_expert_name)
+        for selector in selectors
+    ]
+    for selector in selectors:
+        selector._task_to_expert_name = dict(task_to_expert_name)
+        selector.default_expert_name = default_expert_name
+    try:
+        yield
+    finally:
+        for selector, (mapping, default) in zip(selectors, states):
+            selector._task_to_expert_name = mapping
+            selector.default_expert_name = default
 
 
-def eval_expert_on_task(
-    task,
-    module_constructor: Union[Callable, ExpertModule],
-    expert: Expert,
-    evaluator_train=None,
-    evaluator_valid=None,
-    evaluator_test=None,
-    debug=False,
-):
-    module = None
-    logger.info(f"Evaluating perf for {task}")
-
-    if expert is not None:
-        model_copy: ExpertModule = (
-            module_constructor
-            if isinstance(module_constructor, ExpertModule)
-            else module_constructor()
-        )
-        assert all(
-            [
-                key in model_copy.model.state_dict()
-                for key in expert.expert_weights.keys()
-            ]
-        )
-        model_copy.model.load_state_dict(expert.expert_weights, strict=False)
-        module = model_copy
+def route_to_expert(model: MultiExpertModel, expert_name):
+    """Routes every example to `expert_name`, whatever its task."""
+    return task_routing(model, {}, expert_name)
+
+
+def route_by_expert_name(model: MultiExpertModel):
+    """Routes each example to the expert named by its task name."""
+    return task_routing(model, {name: name for name in model.experts_names}, None)
 
-    if module is None:
-        module = (
-            module_constructor
-            if isinstance(module_constructor, ExpertModule)
-            else module_constructor()
-        )
 
-    result = {}
-    if debug:
-        result["test"] = 0.5
-        return result
-    if evaluator_train is not None:
-        scores_base_train = evaluator_train.evaluate(module)
-        result["train"] = scores_base_train[task]["mean"]
-    if evaluator_valid is not None:
-        score_base_valid = evaluator_valid.evaluate(module)
-        result["valid"] = score_base_valid[task]["mean"]
-    if evaluator_test is not None:
-        score_base_test = evaluator_test.evaluate(module)
-        result["test"] = score_base_test[task]["mean"]
-    del module
-    free_memory()
-    return result
-
-
-def eval_all_experts_on_task(
-    task_eval_on,
-    module_constructor: Union[Callable, ExpertModule],
-    expert_lib,
-    evaluator: Evaluator = None,
-    only_diagonal=False,
+@torch.no_grad()
+def batched_experts_loss(
+    module: MultiExpertModule, dataloader, expert_names, experts_per_forward=4
 ):
-    log_row = {}
-    for expert_name, expert in expert_lib.items():
-        if only_diagonal and expert.expert_info.expert_task_name != task_eval_on:
-            continue
+    """Test loss of each expert on the examples of `dataloader`.
+
+    Each batch is repeated for `experts_per_forward` experts and each copy is routed to its
+    expert by task name, so that the experts are evaluated in a single forward. Returns the
+    negated mean loss per expert, as `TestLossEvaluator`.
+    """
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    module.to(device)
+    module.eval()
+
+    losses = {expert_name: [] for expert_name in expert_names}
+    with route_by_expert_name(module.model):
+        for batch in tqdm.tqdm(dataloader, desc="Test loss"):
+            batch = transfer_batch_to_device(batch, device)
+            batch_size = batch["input_ids"].size(0)
+
+            for start in range(0, len(expert_names), experts_per_forward):
+                group = expert_names[start : start + experts_per_forward]
+                labels = batch["labels"].repeat(len(group), 1)
+                logits = module.forward(
+                    input_ids=batch["input_ids"].repeat(len(group), 1),
+                    attention_mask=batch["attention_mask"].repeat(len(group), 1),
+                    task_names=[name for name in group for _ in range(batch_size)],
+                ).logits
+                loss = compute_loglike_loss(logits, labels, reduction="none")
+                del logits
+
+                for expert_name, expert_loss in zip(group, loss.split(batch_size)):
+                    losses[expert_name].append(expert_loss.cpu())
+
+    return {
+        expert_name: -torch.cat(expert_losses).mean().item()
+        for expert_name, expert_losses in losses.items()
+    }
+
+
+def eval_experts_on_task(
+    task,
+    module: MultiExpertModule,
+    expert_names,
+    evaluator: Evaluator,
+    eval_metric="loss",
+    experts_per_forward=4,
+):
+    """Evaluates the experts of `module` on `task`, reusing the same model and evaluator for
+    all of them."""
+    logger.info(f"Evaluating {len(expert_names)} experts on {task}")
 
-        score = eval_expert_on_task(
-            task_eval_on,
-            module_constructor,
-            expert,
-            evaluator_test=evaluator,
+    if eval_metric == "loss":
+        return batched_experts_loss(
+            module,
+            evaluator.dataloader,
+            expert_names,
+            experts_per_forward=experts_per_forward,
         )
-        log_row[expert_name] = score["test"]
-    return log_row
+
+    scores = {}
+    for expert_name in expert_names:
+        with route_to_expert(module.model, expert_name):
+            scores[expert_name] = evaluator.evaluate(module)[task]["mean"]
+    return scores
 
 
 def prepare_evaluator(
@@ -131,6 +170,8 @@ def prepare_evaluator(
     args_copy.dataset = dataset
     args_copy.finetune_task_name = tasks
     args_copy.validation_portion = 0.0
+    if not for_generation:
+        args_copy.pretokenize = True
     dm = get_datamodule(args_copy, for_generation=for_generation)
 
     if split is not None:
@@ -184,6 +225,19 @@ def create_transfer_matrix(args, checkpoint):
     temp_dir.cleanup()
 
 
+def load_partial_matrix(path):
+    """Cells of a partially computed transfer matrix, by evaluated task and expert."""
+    if not os.path.exists(path):
+        return {}
+
+    partial_matrix = pd.read_csv(path, index_col="eval_task")
+    logger.info(f"Resuming from {path}")
+    return {
+        task: {name: score for name, score in row.items() if not pd.isna(score)}
+        for task, row in partial_matrix.to_dict(orient="index").items()
+    }
+
+
 def produce_transfer_matrix(
     args: TransferMatrixConfig,
     expert_lib: ExpertLibrary,
@@ -192,43 +246,86 @@ def produce_transfer_matrix(
 ):
     """
     Eval each module in expert_lib on each subject in subjects.
+
+    The base model is loaded once, and all the experts are added to it and routed by task
+    name. The matrix computed so far is saved after each task, the tasks and experts already
+    evaluated are skipped when the run is restarted.
     """
     # sort tasks to first include tasks for which modules are available
     tasks = [t for t in expert_lib.tasks if t in tasks] + [
         t for t in tasks if t not in expert_lib.tasks
     ]
 
-    transfer_table = TableLogger()
-    args.device_map = "cpu"
+    partial_path = os.path.join(args.output_dir, PARTIAL_MATRIX_FILE)
+    rows = load_partial_matrix(partial_path)
+    for task in tasks:
+        rows.setdefault(task, {})
 
-    for task_eval_on in tasks:
-        log_row = {}
-        log_row["eval_task"] = task_eval_on
+    def save_rows():
+        pd.DataFrame([{"eval_task": task, **rows[task]} for task in tasks]).set_index(
+            "eval_task"
+        ).to_csv(partial_path)
+
+    # tokenized once per task, and cached on disk for a resumed run
+    evaluators = {}
+
+    def get_evaluator(task):
+        if task not in evaluators:
+            evaluators[task] = prepare_evaluator(
+                args, args.dataset, tasks=task, split=args.transfer_matrix_split
+            )
+        return evaluators[task]
 
-        evaluator: Evaluator = prepare_evaluator(
-            args, args.dataset, tasks=task_eval_on, split=args.transfer_matrix_split
+    args.device_map = "cpu"
+    if module is None:
+        module = MultiExpertModule(
+            **vars(args), selector_config=TaskNameSelectorConfig()
         )
-        module = ExpertModule(**vars(args))
 
-        log_row_task = eval_all_experts_on_task(
-            task_eval_on,
-            module,
-            expert_lib,
-            evaluator=evaluator,
-            only_diagonal=args.only_diagonal,
+    if args.eval_base:
+        # before the experts are added, the model is the base model
+        for task in tasks:
+            if "base" in rows[task]:
+                continue
+            evaluator = get_evaluator(task)
+            if args.eval_metric == "loss":
+                score = batched_experts_loss(module, evaluator.dataloader, [None])[None]
+            else:
+                score = evaluator.evaluate(module)[task]["mean"]
+            rows[task]["base"] = score
+            save_rows()
+
+    module.model.add_experts_from_library(expert_lib)
+
+    for task_eval_on in tasks:
+        expert_names = [
+            expert_name
+            for expert_name in expert_lib.keys()
+            if expert_name not in rows[task_eval_on]
+            and (
+                not args.only_diagonal
+                or expert_lib.data[expert_name].expert_task_name == task_eval_on
+            )
+        ]
+        if not expert_names:
+            continue
+
+        rows[task_eval_on].update(
+            eval_experts_on_task(
+                task_eval_on,
+                module,
+                expert_names,
+                get_evaluator(task_eval_on),
+                eval_metric=args.eval_metric,
+                experts_per_forward=args.experts_per_forward,
+            )
         )
-        log_row.update(log_row_task)
-        if args.eval_base:
-            # eval on base model
-            log_row["base"] = eval_expert_on_task(
-                task_eval_on, module, expert=None, evaluator_test=evaluator
-            )["test"]
-
-        print(transfer_table.df)
-        transfer_table.log(log_row)
-        transfer_table.log_final_table()
-        transfer_table.df.to_csv(os.path.join(args.output_dir, "transfer_matrix.csv"))
+        save_rows()
+        free_memory()
 
+    transfer_table = TableLogger()
+    for task in tasks:
+        transfer_table.log({"eval_task": task, **rows[task]})
     transfer_table.means()
     return transfer_table
 
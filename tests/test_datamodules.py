@@ -393,3 +393,63 @@ def test_dst_subsample(tiny_flan_id, subsample, subsample_per_task, train_size):
     config = FlatMultiTaskConfig(**common_kwargs)
     dm = FlatMultiTaskModule(config)
     assert len(dm.train_dataset) == train_size
+
+
+@pytest.mark.parametrize("truncation_side", ["left", "right"])
+@pytest.mark.parametrize("train_on_inputs", [False, True])
+def test_pretokenized_dataset(tmp_path, truncation_side, train_on_inputs):
+    from datasets import Dataset
+
+    from mttl.datamodule.base import DataModule
+    from mttl.datamodule.tokenized_cache import TokenizedDataset
+
+    rng = np.random.RandomState(0)
+    words = ["hello", "world", "this", "is", "a", "test", "of", "tokens"]
+    examples = {
+        "source": [" ".join(rng.choice(words, rng.randint(1, 30))) for _ in range(20)],
+        "target": [" ".join(rng.choice(words, rng.randint(1, 8))) for _ in range(20)],
+        "task_name": [f"task_{i % 3}" for i in range(20)],
+    }
+
+    class _DataModule(DataModule):
+        def setup_dataset(self):
+            self.train_dataset = Dataset.from_dict(examples)
+            self.dev_dataset = Dataset.from_dict(examples).select(range(10))
+            self.test_dataset = None
+            self._task_names = ["task_0", "task_1", "task_2"]
+            self._task_to_id = {t: i for i, t in enumerate(self._task_names)}
+
+    def config(pretokenize):
+        return DatasetConfig(
+            model="EleutherAI/gpt-neo-125m",
+            max_input_length=24,
+            truncation_side=truncation_side,
+            train_on_inputs=train_on_inputs,
+            pretokenize=pretokenize,
+            tokenized_cache_dir=str(tmp_path),
+            num_proc=1,
+        )
+
+    raw = _DataModule(config(False))
+    pretokenized = _DataModule(config(True))
+    assert isinstance(pretokenized.train_dataset, TokenizedDataset)
+    assert isinstance(pretokenized.dev_dataset, TokenizedDataset)
+    assert len(pretokenized.train_dataset) == 20
+
+    for indices in [range(4), range(4, 12), [19]]:
+        expected = raw.collate_fn([raw.train_dataset[i] for i in indices])
+        batch = pretokenized.collate_fn(
+            [pretokenized.train_dataset[i] for i in indices]
+        )
+        for key in ["input_ids", "attention_mask", "labels", "task_ids"]:
+            assert (batch[key] == expected[key]).all(), key
+        assert batch["task_names"] == expected["task_names"]
+
+    # the cache is reused, and keyed by the options of the collator
+    assert len(list(tmp_path.iterdir())) == 2
+    _DataModule(config(True))
+    assert len(list(tmp_path.iterdir())) == 2
+    other = config(True)
+    other.max_input_length = 32
+    _DataModule(other)
+    assert len(list(tmp_path.iterdir())) == 4
@@ -207,3 +207,145 @@ def test_runner(mocker, gpt_neo):
     assert obj_mmlu.call_count == 2
     assert "shuffle" not in obj_mmlu._mock_call_args_list[0][1]
     assert obj_mmlu._mock_call_args_list[1][1]["shuffle"]
+
+
+@pytest.mark.parametrize("multisource", [False, True])
+def test_shared_prefix_loglike(multisource):
+    import time
+    from types import SimpleNamespace
+
+    import torch
+    from transformers import GPTNeoConfig, GPTNeoForCausalLM
+
+    from mttl.datamodule.base import MultipleChoiceCollator
+    from mttl.datamodule.utils import get_tokenizer_with_args
+    from mttl.evaluators.loglike_evaluator import (
+        LogLikeEvaluator,
+        shared_prefix_loglike_loss,
+    )
+    from mttl.models.utils import compute_loglike_loss
+
+    torch.manual_seed(0)
+    model = GPTNeoForCausalLM(
+        GPTNeoConfig(
+            hidden_size=64,
+            num_layers=2,
+            num_heads=4,
+            attention_types=[[["global", "local"], 1]],
+        )
+    ).eval()
+    tokenizer = get_tokenizer_with_args(
+        "EleutherAI/gpt-neo-125m", "gpt", "right", "left", False
+    )
+    collator = MultipleChoiceCollator(
+        tokenizer=tokenizer,
+        max_input_length=1024,
+        model_family="gpt",
+        multisource=multisource,
+    )
+
+    rng = np.random.RandomState(0)
+    words = ["the", "question", "is", "about", "which", "answer", "cat", "dog", "x"]
+    examples = []
+    for i in range(2):
+        context = " ".join(rng.choice(words, 100))
+        options = [" ".join(rng.choice(words, rng.randint(1, 6))) for _ in range(4)]
+        if multisource:
+            examples.append(
+                {
+                    "source": [context + " " + option for option in options],
+                    "target": "answer",
+                    "label_index": i % 4,
+                }
+            )
+        else:
+            examples.append(
+                {"source": context, "target": options, "label_index": i % 4}
+            )
+    batch = collator(examples)
+
+    with torch.no_grad():
+        start = time.perf_counter()
+        logits = model(
+            input_ids=batch["input_ids"], attention_mask=batch["attention_mask"]
+        ).logits
+        expected = compute_loglike_loss(logits, batch["labels"], reduction="none")
+        del logits
+        full_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        losses = shared_prefix_loglike_loss(model, batch, batch["num_options"])
+        shared_time = time.perf_counter() - start
+
+    assert torch.allclose(losses, expected, atol=1e-5)
+    print(f"shared prefix speedup: {full_time / shared_time:.1f}x")
+
+    # the evaluator gives the same results with and without sharing the prefix
+    datamodule = SimpleNamespace(
+        config=SimpleNamespace(),
+        val_dataloader=lambda subsample, shuffle: [collator(examples)],
+    )
+    metrics = []
+    for share_prefix in [False, True]:
+        evaluator = LogLikeEvaluator(datamodule, share_prefix=share_prefix)
+        evaluator.evaluate(model, verbose=False)
+        metrics.append(evaluator.last_metrics)
+    assert metrics[0]["predictions"] == metrics[1]["predictions"]
+    assert metrics[0]["loss"] == pytest.approx(metrics[1]["loss"], abs=1e-5)
+
+
+def test_stop_sequence_matcher():
+    import torch
+    from transformers import AutoTokenizer
+
+    from mttl.evaluators.base import StoppingCriteriaSub
+    from mttl.evaluators.stop_sequences import AhoCorasick
+
+    automaton = AhoCorasick([[1, 2, 3], [2, 3], [3, 4], [1, 1]])
+    state, found = 0, []
+    for i, symbol in enumerate([1, 1, 2, 3, 4, 2, 1, 1, 1]):
+        state, matches = automaton.step(state, symbol)
+        found.extend((i, match) for match in matches)
+    assert found == [(1, 3), (3, 0), (3, 1), (4, 2), (7, 3), (8, 3)]
+
+    tokenizer = AutoTokenizer.from_pretrained("EleutherAI/gpt-neo-125m")
+    stop_tokens = ["\n\n", "answer", "é", tokenizer.eos_token]
+    texts = [
+        "The answer is 4.\n\nQ:",
+        "Yes.\n\nNo",
+        "no stop here",
+        "caf" + "é" + " au lait",
+        "Hello!\n\n\nBye",
+        "done" + tokenizer.eos_token + "more",
+    ]
+    prompt = tokenizer("Question:", return_tensors="pt")["input_ids"]
+    generations = [tokenizer(text)["input_ids"] for text in texts]
+    # the é of café is generated byte by byte
+    generations[3] = (
+        tokenizer("caf")["input_ids"]
+        + tokenizer.convert_tokens_to_ids(["Ã", "©"])
+        + tokenizer(" au lait")["input_ids"]
+    )
+    length = max(len(ids) for ids in generations)
+    generations = torch.tensor(
+        [ids + [tokenizer.eos_token_id] * (length - len(ids)) for ids in generations]
+    )
+
+    criteria = StoppingCriteriaSub(stop_tokens, tokenizer=tokenizer)
+    expected = [None] * len(texts)
+    for step in range(1, length + 1):
+        input_ids = torch.cat(
+            [prompt.expand(len(texts), -1), generations[:, :step]], dim=1
+        )
+        finished = criteria(input_ids, None)
+
+        for j, text in enumerate(tokenizer.batch_decode(generations[:, :step])):
+            stop = next((stop for stop in stop_tokens if stop in text), None)
+            if expected[j] is None and stop is not None:
+                expected[j] = (stop, input_ids.shape[1])
+        assert finished.tolist() == [e is not None for e in expected]
+
+    assert criteria.finished == expected
+    assert [stop for stop, _ in expected[:2]] == ["answer", "\n\n"]
+    assert expected[2][0] == tokenizer.eos_token
+    assert expected[3][0] == "é"
@@ -15,12 +15,15 @@ from huggingface_hub import (
 
 from mttl.models.library.backend_engine import BlobStorageEngine, LocalFSEngine
 from mttl.models.library.dataset_library import DatasetLibrary
+from mttl.models.library.expert_cache import ExpertCache, expert_cache
 from mttl.models.library.expert_library import (
+    LIBRARY_INDEX_FILE,
     BlobExpertLibrary,
     ExpertLibrary,
     HFExpertLibrary,
     LocalExpertLibrary,
     VirtualLocalLibrary,
+    load_expert_weights,
 )
 
 
@@ -33,6 +36,7 @@ def test_expert_lib(mocker):
 
     library._upload_metadata = mocker.MagicMock()
     library._upload_weights = mocker.MagicMock()
+    library._update_index = mocker.MagicMock()
     library._update_readme = mocker.MagicMock()
 
     # expert already there
@@ -77,6 +81,7 @@ def test_soft_delete(mocker):
     key = list(library.keys())[0]
 
     library._upload_metadata = mocker.MagicMock()
+    library._update_index = mocker.MagicMock()
     library._update_readme = mocker.MagicMock()
     library.remove_expert(key, soft_delete=True)
     assert len(library.data) == 1
@@ -161,6 +166,217 @@ def setup_repo():
     [e.delete_repo(r) for e, r in engine_repo_refs]
 
 
+@pytest.fixture
+def fake_blob_storage(monkeypatch):
+    """In-memory stand-in for Azure Blob Storage, patched in the blob engine."""
+    import datetime
+    import hashlib
+    from types import SimpleNamespace
+
+    from azure.core.exceptions import ResourceNotFoundError
+
+    storage = SimpleNamespace(
+        blobs={},
+        staged={},
+        clients=0,
+        running=0,
+        max_running=0,
+        calls=[],
+        fail_stage_block_after=None,
+    )
+
+    class FakeBlobClient:
+        def __init__(self, container, blob):
+            self.key = (container, blob)
+            self.blob_name = blob
+            self.url = f"https://fake/{container}/{blob}"
+
+        async def _call(self, name, *args):
+            storage.calls.append((name, self.blob_name) + args)
+            storage.running += 1
+            storage.max_running = max(storage.max_running, storage.running)
+            await asyncio.sleep(0.001)
+            storage.running -= 1
+
+        async def upload_blob(self, data, overwrite=False, content_settings=None, **_):
+            await self._call("upload_blob")
+            storage.blobs[self.key] = (bytes(data), content_settings.content_md5)
+
+        async def get_block_list(self, block_list_type):
+            if self.key not in storage.staged and self.key not in storage.blobs:
+                raise ResourceNotFoundError("blob not found")
+            blocks = storage.staged.get(self.key, {})
+            return [], [SimpleNamespace(id=block_id) for block_id in blocks]
+
+        async def stage_block(self, block_id, data, **_):
+            if storage.fail_stage_block_after is not None:
+                if storage.fail_stage_block_after == 0:
+                    raise ConnectionError("connection reset")
+                storage.fail_stage_block_after -= 1
+            await self._call("stage_block", block_id)
+            storage.staged.setdefault(self.key, {})[block_id] = data
+
+        async def commit_block_list(self, block_ids, content_settings=None, **_):
+            staged = storage.staged.pop(self.key)
+            data = b"".join(staged[block_id] for block_id in block_ids)
+            storage.blobs[self.key] = (data, content_settings.content_md5)
+
+        async def get_blob_properties(self):
+            if self.key not in storage.blobs:
+                raise ResourceNotFoundError("blob not found")
+            data, md5 = storage.blobs[self.key]
+            return SimpleNamespace(
+                size=len(data),
+                etag="etag",
+                content_settings=SimpleNamespace(content_md5=md5),
+            )
+
+        async def download_blob(self, offset=0, length=None, **_):
+            await self._call("download_blob", offset)
+            data = storage.blobs[self.key][0][offset : offset + length]
+
+            class Downloader:
+                async def readinto(self, stream):
+                    stream.write(data)
+
+            return Downloader()
+
+        async def delete_blob(self):
+            await self._call("delete_blob")
+            del storage.blobs[self.key]
+
+        async def upload_blob_from_url(self, source_url, overwrite=False):
+            await self._call("upload_blob_from_url")
+            container, blob = source_url[len("https://fake/") :].split("/", 1)
+            storage.blobs[self.key] = storage.blobs[(container, blob)]
+
+    class FakeAsyncBlobServiceClient:
+        def __init__(self, connection_string):
+            storage.clients += 1
+
+        def get_blob_client(self, container, blob):
+            return FakeBlobClient(container, blob)
+
+        async def close(self):
+            pass
+
+    class FakeBlobServiceClient:
+        def __init__(self, connection_string):
+            pass
+
+        def create_container(self, name):
+            pass
+
+        def get_container_client(self, container):
+            return SimpleNamespace(
+                list_blobs=lambda: [
+                    SimpleNamespace(name=blob)
+                    for c, blob in storage.blobs
+                    if c == container
+                ],
+                get_container_properties=lambda: SimpleNamespace(
+                    last_modified=datetime.datetime(2024, 1, 1)
+                ),
+            )
+
+    monkeypatch.setattr(
+        "mttl.models.library.backend_engine.AsyncBlobServiceClient",
+        FakeAsyncBlobServiceClient,
+    )
+    monkeypatch.setattr(
+        "mttl.models.library.backend_engine.BlobServiceClient", FakeBlobServiceClient
+    )
+    return storage
+
+
+def test_blob_engine_block_transfers(tmp_path, fake_blob_storage):
+    engine = BlobStorageEngine(
+        token="token",
+        cache_dir=tmp_path,
+        max_concurrency=3,
+        block_size=16,
+        max_block_concurrency=1,
+    )
+    repo_id = "account/container"
+    data = bytes(range(200))
+
+    # small blobs are uploaded at once, large blobs in blocks
+    asyncio.run(
+        engine.async_upload_blobs(
+            repo_id,
+            [f"file_{i}" for i in range(10)] + ["large"],
+            [b"small"] * 10 + [data],
+        )
+    )
+    assert fake_blob_storage.clients == 1
+    assert fake_blob_storage.max_running <= 3
+    calls = [call[0] for call in fake_blob_storage.calls]
+    assert calls.count("upload_blob") == 10
+    assert calls.count("stage_block") == 13
+
+    path = engine.hf_hub_download(repo_id, "large")
+    with open(path, "rb") as f:
+        assert f.read() == data
+
+    # staged blocks of an interrupted upload are not uploaded again
+    fake_blob_storage.fail_stage_block_after = 5
+    with pytest.raises(ConnectionError):
+        asyncio.run(engine.async_upload_blobs(repo_id, "large_2", [data[::-1]]))
+    fake_blob_storage.fail_stage_block_after = None
+    fake_blob_storage.calls.clear()
+    asyncio.run(engine.async_upload_blobs(repo_id, "large_2", [data[::-1]]))
+    assert [call[0] for call in fake_blob_storage.calls].count("stage_block") == 8
+    with open(engine.hf_hub_download(repo_id, "large_2"), "rb") as f:
+        assert f.read() == data[::-1]
+
+
+def test_blob_library_prefetch(tmp_path, fake_blob_storage, monkeypatch):
+    monkeypatch.setenv("BLOB_SAS_TOKEN", "token")
+    monkeypatch.setenv("BLOB_CACHE_DIR", str(tmp_path))
+    library = ExpertLibrary.get_expert_library(
+        "az://account/container", create=True, weights_format="safetensors"
+    )
+    with library.batched_commit():
+        for i in range(4):
+            library.add_expert(make_lora_expert(f"expert_{i}"))
+
+    expert_cache.invalidate(library._cache_repo)
+    fake_blob_storage.clients = 0
+    library = ExpertLibrary.get_expert_library("az://account/container")
+    experts = library.get_many(max_concurrency=2)
+    assert list(experts) == [f"expert_{i}" for i in range(4)]
+    # the index and the experts are downloaded through a client each
+    assert fake_blob_storage.clients == 2
+
+
+def test_blob_engine_resume_download(tmp_path, fake_blob_storage):
+    engine = BlobStorageEngine(token="token", cache_dir=tmp_path, block_size=16)
+    repo_id = "account/container"
+    data = bytes(range(100))
+    asyncio.run(engine.async_upload_blobs(repo_id, "file", [data]))
+
+    # an interrupted download left the first bytes on disk
+    local_filename = engine._get_local_filepath(repo_id, "file")
+    os.makedirs(local_filename.parent, exist_ok=True)
+    with open(f"{local_filename}.part", "wb") as f:
+        f.write(data[:40])
+
+    fake_blob_storage.calls.clear()
+    with open(engine.hf_hub_download(repo_id, "file"), "rb") as f:
+        assert f.read() == data
+    assert fake_blob_storage.calls == [("download_blob", "file", 40)]
+    assert not os.path.exists(f"{local_filename}.part")
+
+    # corrupted content is detected
+    fake_blob_storage.blobs[("container", "file")] = (
+        data[::-1],
+        fake_blob_storage.blobs[("container", "file")][1],
+    )
+    with pytest.raises(ValueError):
+        engine.hf_hub_download(repo_id, "file")
+    assert not os.path.exists(f"{local_filename}.part")
+
+
 @pytest.mark.skipif(token is None, reason="Requires access to Azure Blob Storage")
 def test_create_and_delete_repo(tmp_path, repo_id):
     engine = BlobStorageEngine(token=token, cache_dir=tmp_path)
@@ -414,7 +630,7 @@ def test_copy_library_blob_to_blob(tmp_path, build_meta_ckpt, setup_repo, repo_i
         new_lib = BlobExpertLibrary.from_expert_library(library, az_new_repo_id)
         assert set(new_lib.list_repo_files(new_repo_id)) == set(
             library.list_repo_files(repo_id)
-        )
+        ) | {LIBRARY_INDEX_FILE}
     finally:
         BlobExpertLibrary(az_new_repo_id).delete_repo(new_repo_id)
 
@@ -439,7 +655,7 @@ def test_copy_library_blob_to_local(tmp_path, build_meta_ckpt, setup_repo, repo_
     new_lib = LocalExpertLibrary.from_expert_library(library, new_repo_id)
     # drop the path and keep the filenames
     local_files = {f.split("/")[-1] for f in new_lib.list_repo_files(new_repo_id)}
-    assert local_files == set(library.list_repo_files(repo_id))
+    assert local_files == set(library.list_repo_files(repo_id)) | {LIBRARY_INDEX_FILE}
 
 
 def test_copy_library_local_to_local(tmp_path, build_meta_ckpt, setup_repo, repo_id):
@@ -525,6 +741,376 @@ def test_virtual_library_is_in_memory(tmp_path, build_meta_ckpt, setup_repo, rep
     }
 
 
+def make_lora_expert(expert_name):
+    from mttl.models.library.expert import Expert, ExpertInfo
+    from mttl.models.modifiers.lora import LoRAConfig
+
+    lora_a = torch.randn(8, 4)
+    return Expert(
+        expert_info=ExpertInfo(
+            expert_name=expert_name,
+            expert_task_name=expert_name,
+            expert_config=LoRAConfig(lora_rank=4),
+            expert_model="tiny",
+        ),
+        expert_weights={
+            "layer.0.q_proj.lora_a": lora_a,
+            # tied weights share storage, safetensors stores them once
+            "layer.0.k_proj.lora_a": lora_a,
+            "layer.0.q_proj.lora_b": torch.randn(4, 8),
+        },
+    )
+
+
+def test_local_library_safetensors(tmp_path):
+    repo_id = f"local://{tmp_path / 'repo'}"
+    library = ExpertLibrary.get_expert_library(
+        repo_id, create=True, weights_format="safetensors"
+    )
+    expert = make_lora_expert("expert_1")
+    library.add_expert(expert)
+
+    files = set(os.listdir(tmp_path / "repo"))
+    assert "expert_1.safetensors" in files
+    assert "expert_1.ckpt" not in files
+
+    # reload from disk, the format is read from the metadata
+    library = ExpertLibrary.get_expert_library(repo_id)
+    assert library.data["expert_1"].weights_format == "safetensors"
+    loaded = library["expert_1"]
+    for name, weight in expert.expert_weights.items():
+        assert torch.equal(loaded.expert_weights[name], weight)
+
+    library.rename_expert("expert_1", "expert_2")
+    assert set(os.listdir(tmp_path / "repo")) == {
+        "README.md",
+        LIBRARY_INDEX_FILE,
+        "expert_2.meta",
+        "expert_2.safetensors",
+    }
+    library.remove_expert("expert_2", soft_delete=False)
+    assert set(os.listdir(tmp_path / "repo")) == {"README.md", LIBRARY_INDEX_FILE}
+
+    with pytest.raises(ValueError):
+        ExpertLibrary.get_expert_library(repo_id, weights_format="pickle")
+
+
+def test_content_addressed_library(tmp_path):
+    from safetensors import safe_open
+
+    repo_path = tmp_path / "repo"
+    library = ExpertLibrary.get_expert_library(
+        f"local://{repo_path}",
+        create=True,
+        weights_format="safetensors",
+        content_addressed=True,
+    )
+    expert = make_lora_expert("expert_1")
+    with library.batched_commit():
+        library.add_expert(expert)
+        library.add_expert(expert, "expert_2")
+
+    # identical weights are stored once, under their hash
+    objects = os.listdir(repo_path / "objects")
+    assert len(objects) == 1
+    weights_file = library.data["expert_1"].weights_file
+    assert weights_file == f"objects/{objects[0]}"
+    assert library.data["expert_2"].weights_file == weights_file
+    assert weights_file == (
+        f"objects/{library.data['expert_1'].weights_hash}.safetensors"
+    )
+
+    # tied tensors are stored once and restored on load
+    with safe_open(repo_path / weights_file, framework="pt") as f:
+        assert set(f.keys()) == {"layer.0.q_proj.lora_a", "layer.0.q_proj.lora_b"}
+    library = ExpertLibrary.get_expert_library(
+        f"local://{repo_path}", weights_format="safetensors", content_addressed=True
+    )
+    loaded = library["expert_2"].expert_weights
+    assert (
+        loaded["layer.0.k_proj.lora_a"].data_ptr()
+        == loaded["layer.0.q_proj.lora_a"].data_ptr()
+    )
+    for name, weight in expert.expert_weights.items():
+        assert torch.equal(loaded[name], weight)
+
+    # renames and copies only write metadata
+    library.rename_expert("expert_1", "expert_3")
+    library.copy_expert("expert_3", "expert_4")
+    assert library.data["expert_4"].weights_file == weights_file
+    assert os.listdir(repo_path / "objects") == objects
+    assert {f for f in os.listdir(repo_path) if f.endswith(".meta")} == {
+        "expert_2.meta",
+        "expert_3.meta",
+        "expert_4.meta",
+    }
+    assert torch.equal(
+        library["expert_4"].expert_weights["layer.0.q_proj.lora_b"],
+        expert.expert_weights["layer.0.q_proj.lora_b"],
+    )
+
+    # copying the library to another content-addressed library keeps a single object
+    copy = LocalExpertLibrary.from_expert_library(library, str(tmp_path / "copy"))
+    assert copy.content_addressed
+    assert os.listdir(tmp_path / "copy" / "objects") == objects
+    assert set(copy.keys()) == {"expert_2", "expert_3", "expert_4"}
+
+    # the weights are deleted with the last expert referencing them
+    library.remove_expert("expert_2", soft_delete=False)
+    library.remove_expert("expert_3", soft_delete=False)
+    assert os.listdir(repo_path / "objects") == objects
+    library.remove_expert("expert_4", soft_delete=False)
+    assert os.listdir(repo_path / "objects") == []
+
+
+def test_convert_library_to_safetensors(tmp_path, build_meta_ckpt):
+    local_path = tmp_path / "repo"
+    local_path.mkdir()
+    # legacy checkpoint without a weights format in the metadata
+    build_meta_ckpt(local_path, 1)
+    repo_id = f"local://{local_path}"
+    library = ExpertLibrary.get_expert_library(repo_id)
+    assert library.data["expert_1"].weights_format is None
+    library.add_expert(make_lora_expert("lora_1"))
+    library.add_expert(make_lora_expert("lora_2"))
+    expected = {name: library[name].expert_weights for name in library.keys()}
+
+    # expert_1 has non-tensor weights and stays a .ckpt
+    assert library.convert_weights_format("safetensors") == 2
+    assert set(os.listdir(local_path)) == {
+        "README.md",
+        LIBRARY_INDEX_FILE,
+        "expert_1.meta",
+        "expert_1.ckpt",
+        "lora_1.meta",
+        "lora_1.safetensors",
+        "lora_2.meta",
+        "lora_2.safetensors",
+    }
+
+    library = ExpertLibrary.get_expert_library(repo_id)
+    for name in ["lora_1", "lora_2"]:
+        weights = library[name].expert_weights
+        assert weights.keys() == expected[name].keys()
+        for key, weight in weights.items():
+            assert torch.equal(weight, expected[name][key])
+    assert library["expert_1"].expert_weights == {"state_dict": {}}
+
+    # converting back to the legacy format
+    assert library.convert_weights_format("ckpt") == 2
+    assert not any(f.endswith(".safetensors") for f in os.listdir(local_path))
+
+
+def test_library_index(tmp_path, build_meta_ckpt):
+    local_path = tmp_path / "repo"
+    repo_id = f"local://{local_path}"
+    library = ExpertLibrary.get_expert_library(repo_id, create=True)
+    with library.batched_commit():
+        library.add_expert(make_lora_expert("lora_1"))
+        library.add_expert(make_lora_expert("lora_2"))
+        library.add_expert(make_lora_expert("lora_3"))
+    library.remove_expert("lora_3")
+    assert os.path.isfile(local_path / LIBRARY_INDEX_FILE)
+
+    # the index is read instead of the metadata files
+    with patch.object(
+        LocalExpertLibrary, "_load_metadata_files", side_effect=AssertionError
+    ):
+        library = ExpertLibrary.get_expert_library(repo_id)
+    assert set(library.keys()) == {"lora_1", "lora_2"}
+    assert library._index_entries["lora_3"].expert_deleted
+    assert library._index_revision == 2
+
+    # metadata files written without updating the index make it stale
+    build_meta_ckpt(local_path, 1)
+    library = ExpertLibrary.get_expert_library(repo_id)
+    assert set(library.keys()) == {"lora_1", "lora_2", "expert_1"}
+
+    library.rebuild_index()
+    with patch.object(
+        LocalExpertLibrary, "_load_metadata_files", side_effect=AssertionError
+    ):
+        library = ExpertLibrary.get_expert_library(repo_id)
+    assert set(library.keys()) == {"lora_1", "lora_2", "expert_1"}
+
+    # a corrupted index falls back to the metadata files
+    with open(local_path / LIBRARY_INDEX_FILE, "wb") as f:
+        f.write(b"corrupted")
+    library = ExpertLibrary.get_expert_library(repo_id)
+    assert set(library.keys()) == {"lora_1", "lora_2", "expert_1"}
+
+
+def test_expert_cache_lru():
+    cache = ExpertCache(max_bytes=3 * 8 * 4 * 4)
+    for i in range(3):
+        cache.put(("repo", f"expert_{i}", None), {"w": torch.zeros(8, 4)})
+    assert len(cache) == 3
+
+    # refresh expert_0, expert_1 is now the least recently used
+    assert cache.get(("repo", "expert_0", None)) is not None
+    cache.put(("repo", "expert_3", None), {"w": torch.zeros(8, 4)})
+    assert cache.get(("repo", "expert_1", None)) is None
+    assert cache.stats()["evictions"] == 1
+    assert cache.nbytes == 3 * 8 * 4 * 4
+
+    # tied weights are only counted once
+    weight = torch.zeros(8, 4)
+    cache.put(("repo", "expert_4", None), {"a": weight, "b": weight})
+    assert cache.nbytes == 3 * 8 * 4 * 4
+
+    # too large to be cached
+    cache.put(("repo", "expert_5", None), {"w": torch.zeros(8, 8, 4)})
+    assert cache.get(("repo", "expert_5", None)) is None
+
+    cache.invalidate("repo", "expert_4")
+    assert cache.get(("repo", "expert_4", None)) is None
+    cache.invalidate("repo")
+    assert len(cache) == 0 and cache.nbytes == 0
+
+
+def test_library_expert_cache(tmp_path):
+    repo_id = f"local://{tmp_path / 'repo'}"
+    library = ExpertLibrary.get_expert_library(repo_id, create=True)
+    library.add_expert(make_lora_expert("expert_1"))
+    assert library.data["expert_1"].weights_hash is not None
+
+    hits = expert_cache.hits
+    with patch(
+        "mttl.models.library.expert_library.load_expert_weights",
+        wraps=load_expert_weights,
+    ) as load:
+        weights = library["expert_1"].expert_weights
+        assert torch.equal(
+            library["expert_1"].expert_weights["layer.0.q_proj.lora_b"],
+            weights["layer.0.q_proj.lora_b"],
+        )
+        assert load.call_count == 1
+        assert expert_cache.hits == hits + 1
+
+        # overwriting the expert invalidates the cached weights
+        new_expert = make_lora_expert("expert_1")
+        library.add_expert(new_expert, force=True)
+        assert torch.equal(
+            library["expert_1"].expert_weights["layer.0.q_proj.lora_b"],
+            new_expert.expert_weights["layer.0.q_proj.lora_b"],
+        )
+        assert load.call_count == 2
+
+        library.rename_expert("expert_1", "expert_2")
+        library["expert_2"]
+        assert load.call_count == 3
+
+        library.refresh_from_remote()
+        library["expert_2"]
+        assert load.call_count == 4
+
+
+def test_library_prefetch(tmp_path):
+    repo_id = f"local://{tmp_path / 'repo'}"
+    library = ExpertLibrary.get_expert_library(repo_id, create=True)
+    with library.batched_commit():
+        for i in range(6):
+            library.add_expert(make_lora_expert(f"expert_{i}"))
+    names = [f"expert_{i}" for i in range(6)]
+
+    expert_cache.invalidate(library._cache_repo)
+    experts = list(library.prefetch(names[:4], max_concurrency=2))
+    assert sorted(expert.name for expert in experts) == names[:4]
+    for expert in experts:
+        assert torch.equal(
+            expert.expert_weights["layer.0.q_proj.lora_b"],
+            library[expert.name].expert_weights["layer.0.q_proj.lora_b"],
+        )
+
+    # get_many returns the experts in the requested order, cached or not
+    experts = library.get_many(names[::-1], max_concurrency=3)
+    assert list(experts) == names[::-1]
+
+    with pytest.raises(ValueError):
+        library.get_many(["expert_7"])
+
+
+def test_library_prefetch_on_error(tmp_path):
+    repo_path = tmp_path / "repo"
+    library = ExpertLibrary.get_expert_library(f"local://{repo_path}", create=True)
+    with library.batched_commit():
+        for i in range(4):
+            library.add_expert(make_lora_expert(f"expert_{i}"))
+    expert_cache.invalidate(library._cache_repo)
+
+    with open(repo_path / library._weights_file("expert_2"), "wb") as f:
+        f.write(b"corrupted")
+
+    with pytest.raises(Exception):
+        list(library.prefetch(max_concurrency=2))
+
+    # failures are reported per expert, the other experts are still loaded
+    errors = {}
+    experts = library.prefetch(
+        max_concurrency=2, on_error=lambda name, error: errors.update({name: error})
+    )
+    assert sorted(expert.name for expert in experts) == [
+        "expert_0",
+        "expert_1",
+        "expert_3",
+    ]
+    assert list(errors) == ["expert_2"]
+
+
+def test_content_addressed_library_prefetch(tmp_path):
+    library = ExpertLibrary.get_expert_library(
+        f"local://{tmp_path / 'repo'}",
+        create=True,
+        weights_format="safetensors",
+        content_addressed=True,
+    )
+    expert = make_lora_expert("expert_1")
+    with library.batched_commit():
+        library.add_expert(expert)
+        library.add_expert(expert, "expert_2")
+    expert_cache.invalidate(library._cache_repo)
+
+    # both experts are loaded from their shared weights file
+    experts = library.get_many(max_concurrency=2)
+    assert list(experts) == ["expert_1", "expert_2"]
+    assert torch.equal(
+        experts["expert_2"].expert_weights["layer.0.q_proj.lora_b"],
+        expert.expert_weights["layer.0.q_proj.lora_b"],
+    )
+
+
+def test_download_files_max_bytes_in_flight(tmp_path):
+    import threading
+    import time
+
+    engine = LocalFSEngine()
+    lock = threading.Lock()
+    in_flight, max_in_flight = [0], [0]
+
+    def hf_hub_download(repo_id, filename):
+        with lock:
+            in_flight[0] += sizes[filename]
+            max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+        time.sleep(0.01)
+        with lock:
+            in_flight[0] -= sizes[filename]
+        return os.path.join(repo_id, filename)
+
+    engine.hf_hub_download = hf_hub_download
+    sizes = {f"file_{i}": 10 * (i % 3 + 1) for i in range(12)}
+    downloaded = list(
+        engine.download_files(
+            str(tmp_path),
+            list(sizes),
+            max_concurrency=4,
+            max_bytes_in_flight=40,
+            sizes=sizes,
+        )
+    )
+    assert sorted(filename for filename, _ in downloaded) == sorted(sizes)
+    assert 0 < max_in_flight[0] <= 40
+
+
 @pytest.mark.skipif(token is None, reason="Requires access to Azure Blob Storage")
 @pytest.mark.parametrize(
     "expert_lib_class, repo_id",
@@ -109,6 +109,31 @@ def test_from_pretrained(tmp_path):
     assert "b" in model.experts_names
 
 
+def test_add_experts_from_library_reports_failures(tmp_path):
+    from mttl.models.library.expert_cache import expert_cache
+
+    model = MultiExpertModel(MultiExpertModelConfig("EleutherAI/gpt-neo-125m"))
+    for name in ["a", "b", "c"]:
+        model.add_empty_expert(name, LoRAConfig(modify_layers=".*out_proj.*"))
+    library = model.save_to_library(f"local://{tmp_path}")
+    expert_cache.invalidate(library._cache_repo)
+
+    with open(tmp_path / library._weights_file("b"), "wb") as f:
+        f.write(b"corrupted")
+
+    # the other experts are added before the failure is raised
+    model = MultiExpertModel(MultiExpertModelConfig("EleutherAI/gpt-neo-125m"))
+    with pytest.raises(ValueError, match="Failed to load 1 experts: b"):
+        model.add_experts_from_library(library)
+    assert sorted(model.experts_names) == ["a", "c"]
+
+    model = MultiExpertModel(MultiExpertModelConfig("EleutherAI/gpt-neo-125m"))
+    failed = model.add_experts_from_library(library, skip_failed=True)
+    assert list(failed) == ["b"]
+    assert sorted(model.experts_names) == ["a", "c"]
+    assert len(model.experts_containers) == 12
+
+
 def test_from_pretrained_with_arrow(tmp_path):
     # create a dummy library
     model = MultiExpertModel(MultiExpertModelConfig("EleutherAI/gpt-neo-125m"))
@@ -224,5 +249,79 @@ def test_save_load(tmp_path):
     assert model.config == new_model.config
 
 
+@pytest.mark.parametrize("coalesced", [False, True])
+def test_add_expert_instances(monkeypatch, coalesced):
+    import torch
+
+    from mttl.models.library.expert import ExpertInfo
+
+    monkeypatch.setenv("COALESCED_LORA_CONTAINER", "1" if coalesced else "0")
+    seed_everything(0)
+
+    # coalesced experts are stacked in a single parameter, which cannot be tied
+    config = LoRAConfig(
+        modify_layers="k_proj|q_proj",
+        tie_params=None if coalesced else "q_proj.*\\.lora_a|k_proj.*\\.lora_a",
+    )
+    experts = []
+    for name in ["a", "b", "c"]:
+        source = ExpertModel(
+            ExpertModelConfig("EleutherAI/gpt-neo-125m", modifier_config=config)
+        )
+        for n, p in source.model.named_parameters():
+            if "lora" in n:
+                torch.nn.init.normal_(p)
+        expert = source.as_expert()
+        expert.name = name
+        experts.append(expert)
+
+    selector_config = MOERKHSSelectorConfig(emb_dim=8)
+    one_by_one = MultiExpertModel(
+        MultiExpertModelConfig(
+            "EleutherAI/gpt-neo-125m", selector_config=selector_config
+        )
+    )
+    for expert in experts:
+        one_by_one.add_expert_instance(expert, is_default=expert.name == "b")
+
+    bulk = MultiExpertModel(
+        MultiExpertModelConfig(
+            "EleutherAI/gpt-neo-125m", selector_config=selector_config
+        )
+    )
+    assert bulk.add_expert_instances(experts, default_expert_name="b") == [
+        "a",
+        "b",
+        "c",
+    ]
+
+    assert bulk.experts_names == one_by_one.experts_names
+    assert len(bulk.experts_containers) == len(one_by_one.experts_containers) == 24
+    assert len(bulk.selectors["lora"]) == len(one_by_one.selectors["lora"])
+    for container, expected in zip(
+        bulk.experts_containers, one_by_one.experts_containers
+    ):
+        assert container.layer_name == expected.layer_name
+        assert container.expert_names == expected.expert_names
+        assert container.default_expert_name == "b"
+        assert container.selector.expert_names == expected.selector.expert_names
+
+    # same weights, tied in the same way
+    state_dict = one_by_one.model.state_dict()
+    bulk_state_dict = bulk.model.state_dict()
+    assert len(list(bulk.model.parameters())) == len(
+        list(one_by_one.model.parameters())
+    )
+    for name in ["a", "b", "c"]:
+        expert = bulk.get_expert_instance(name)
+        expected = one_by_one.get_expert_instance(name)
+        assert expert.expert_weights.keys() == expected.expert_weights.keys()
+        for k, v in expert.expert_weights.items():
+            assert torch.equal(v, expected.expert_weights[k])
+    assert all(
+        torch.equal(v, state_dict[k]) for k, v in bulk_state_dict.items() if "lora" in k
+    )
+
+
 if __name__ == "__main__":
     pytest.main([__file__])
@@ -1,6 +1,7 @@
 # unit test for adapter_ranker
 import copy
 import logging
+import os
 from collections import OrderedDict
 
 import numpy as np
@@ -26,6 +27,7 @@ from mttl.models.library.library_transforms import (
     TiesMergeConfig,
     WeightedLinearMerge,
     WeightedLinearMergeConfig,
+    abs_quantile,
 )
 
 
@@ -120,6 +122,109 @@ def test_arrow_with_tiedlora(tmp_path, create_dummy_expert):
     assert np.allclose(sums, [-13.642, -7.734], atol=1e-3)
 
 
+def test_hidden_state_transform_shared_base_model(
+    tmp_path, create_dummy_expert, monkeypatch
+):
+    from datasets import Dataset
+
+    from mttl.models.library import library_transforms
+    from mttl.models.library.dataset_library import DatasetLibrary
+
+    rng = np.random.RandomState(0)
+    words = ["hello", "world", "this", "is", "a", "test", "of", "tokens"]
+    n_examples = 40
+    dataset_id = f"local://{tmp_path}/flan"
+    DatasetLibrary.push_dataset(
+        Dataset.from_dict(
+            {
+                "source": [
+                    " ".join(rng.choice(words, rng.randint(2, 12)))
+                    for _ in range(n_examples)
+                ],
+                "target": [
+                    " ".join(rng.choice(words, rng.randint(1, 4)))
+                    for _ in range(n_examples)
+                ],
+                "task_name": [f"task_{i % 2}" for i in range(n_examples)],
+                "task_source": ["CoT"] * n_examples,
+                "template_type": ["zs_opt"] * n_examples,
+                "split": ["train"] * n_examples,
+            }
+        ),
+        dataset_id,
+    )
+
+    config = ExpertConfig(
+        **{
+            "model_modifier": "lora",
+            "lora_rank": 4,
+            "modify_layers": "k_proj|v_proj|q_proj|o_proj",
+            "trainable_param_names": ".*lora_[ab].*",
+            "output_dir": str(tmp_path / "output"),
+            "model": "EleutherAI/gpt-neo-125m",
+            "dataset": dataset_id,
+            "device_map": "cpu",
+            "dataset_type": "flan",
+            "predict_batch_size": 2,
+            "tokenized_cache_dir": str(tmp_path / "tokenized"),
+            "lora_init_b_random": True,
+        }
+    )
+
+    library = LocalExpertLibrary(str(tmp_path / "library"), create=True)
+    single_library = LocalExpertLibrary(str(tmp_path / "single"), create=True)
+    for task_name in ["task_0", "task_1"]:
+        config.finetune_task_name = task_name
+        expert = create_dummy_expert(config, task_name)
+        library.add_expert(expert)
+    single_library.add_expert(expert)
+
+    n_models = []
+
+    class CountingMultiExpertModel(MultiExpertModel):
+        def __init__(self, *args, **kwargs):
+            n_models.append(1)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(
+        library_transforms, "MultiExpertModel", CountingMultiExpertModel
+    )
+
+    hc = HiddenStateComputer(HiddenStateComputerConfig(max_samples_per_task=4))
+    centroids = hc.transform(library, persist=True, default_args=config)
+    assert len(n_models) == 1
+    assert list(centroids) == ["task_0", "task_1"]
+
+    # same centroids as with a model of its own
+    single = hc.transform(single_library, persist=False, default_args=config)
+    assert centroids["task_1"].keys() == single["task_1"].keys()
+    for layer, centroid in single["task_1"].items():
+        # the hidden states are summed in bfloat16, in the order of the shuffled batches
+        assert torch.allclose(centroids["task_1"][layer], centroid, atol=1e-2)
+
+    # an interrupted run is resumed from the saved centroids
+    os.remove(tmp_path / "library" / f"task_0.{hc.config.save_name}.bin")
+    n_models.clear()
+    loaded = []
+    prefetch = library.prefetch
+
+    def recording_prefetch(expert_names, **kwargs):
+        loaded.extend(expert_names)
+        return prefetch(expert_names, **kwargs)
+
+    monkeypatch.setattr(library, "prefetch", recording_prefetch)
+    resumed = hc.transform(library, persist=True, default_args=config)
+    assert loaded == ["task_0"] and len(n_models) == 1
+    for name in ["task_0", "task_1"]:
+        for layer, centroid in centroids[name].items():
+            assert torch.allclose(resumed[name][layer], centroid, atol=1e-2)
+
+    # nothing left to compute
+    n_models.clear()
+    assert hc.transform(library, default_args=config).keys() == centroids.keys()
+    assert len(n_models) == 0
+
+
 def test_phatgoose(tiny_flan, tmp_path, create_dummy_expert, monkeypatch):
     # disable wandb
     monkeypatch.setenv("WANDB_MODE", "disabled")
@@ -176,6 +281,90 @@ def test_phatgoose(tiny_flan, tmp_path, create_dummy_expert, monkeypatch):
     assert model.selectors["lora"][0].prototypes.shape[1] == 768
 
 
+def test_phatgoose_batched(tmp_path, create_dummy_expert, monkeypatch):
+    from datasets import Dataset
+
+    from mttl.models.library.dataset_library import DatasetLibrary
+
+    # disable wandb
+    monkeypatch.setenv("WANDB_MODE", "disabled")
+
+    # copies of a single example per task, the gates do not depend on the data order
+    examples = {
+        "task_0": ("hello world this is", "a test"),
+        "task_1": ("of tokens of tokens is a", "world"),
+        "task_2": ("this", "is a test of"),
+    }
+    rows = [(name, *examples[name]) for name in examples for _ in range(4)]
+    dataset_id = f"local://{tmp_path}/flan"
+    DatasetLibrary.push_dataset(
+        Dataset.from_dict(
+            {
+                "source": [source for _, source, _ in rows],
+                "target": [target for _, _, target in rows],
+                "task_name": [name for name, _, _ in rows],
+                "task_source": ["CoT"] * len(rows),
+                "template_type": ["zs_opt"] * len(rows),
+                "split": ["train"] * len(rows),
+            }
+        ),
+        dataset_id,
+    )
+
+    config = ExpertConfig(
+        **{
+            "model_modifier": "lora",
+            "lora_rank": 4,
+            "modify_layers": "k_proj|v_proj|q_proj|o_proj",
+            "trainable_param_names": ".*lora_[ab].*",
+            "output_dir": str(tmp_path / "output"),
+            "precision": "32",
+            "model": "EleutherAI/gpt-neo-125m",
+            "dataset": dataset_id,
+            "device_map": "cpu",
+            "dataset_type": "flan",
+            "tokenized_cache_dir": str(tmp_path / "tokenized"),
+            "lora_init_b_random": True,
+        }
+    )
+
+    library = LocalExpertLibrary(str(tmp_path / "library"), create=True)
+    for task_name in examples:
+        config.finetune_task_name = task_name
+        library.add_expert(create_dummy_expert(config, task_name))
+
+    pg_config = PhatgooseConfig(
+        n_steps=3,
+        warmup_ratio=0.0,
+        learning_rate=1e-2,
+        batch_size=2,
+        micro_batch_size=1,
+        max_experts_per_batch=2,
+    )
+    batched = PhatgooseTransform(pg_config).transform(
+        library, persist=True, default_args=config
+    )
+    assert list(batched) == list(examples)
+
+    sequential_config = copy.deepcopy(pg_config)
+    sequential_config.batched = False
+    sequential = PhatgooseTransform(sequential_config).transform(
+        library, persist=False, recompute=True, default_args=config
+    )
+
+    for name in examples:
+        assert batched[name].keys() == sequential[name].keys()
+        for layer, gate in sequential[name].items():
+            assert np.abs(gate).max() > 0
+            # adam steps of about the learning rate, up to float errors on small gradients
+            assert np.allclose(batched[name][layer], gate, atol=1e-4)
+
+    # the gates are saved per expert, and reused
+    assert library.get_auxiliary_data(data_type=pg_config.save_name).keys() == set(
+        examples
+    )
+
+
 def test_hidden_state_transform(tiny_flan, tmp_path, create_dummy_expert, monkeypatch):
     # disable wandb
     monkeypatch.setenv("WANDB_MODE", "disabled")
@@ -252,6 +441,75 @@ def test_compute_svd_embeddings():
     assert embeddings["abstract_algebra"].shape[0] == 2
 
 
+def test_streaming_svd_embeddings(tmp_path):
+    from mttl.models.library.expert import Expert, ExpertInfo
+    from mttl.models.library.library_transforms import (
+        SVDEmbeddingTransform,
+        SVDEmbeddingTransformConfig,
+    )
+    from mttl.models.modifiers.lora import LoRAConfig
+
+    seed_everything(0)
+    library = LocalExpertLibrary(str(tmp_path), create=True)
+    config = LoRAConfig(modify_layers="k_proj", lora_rank=4)
+    # experts close to a few directions, so that the top components are well separated
+    directions = torch.randn(3, 2, 2, 1024, 4)
+
+    def add_expert(i):
+        mixture = torch.randn(3, 1, 1, 1, 1) * torch.tensor([4.0, 2.0, 1.0]).view(
+            3, 1, 1, 1, 1
+        )
+        weights = (mixture * directions).sum(0) + 0.05 * torch.randn(2, 2, 1024, 4)
+        expert_weights = {}
+        for layer in range(2):
+            prefix = f"model.layers.{layer}.self_attn.k_proj"
+            expert_weights[f"{prefix}.lora_a"] = weights[layer, 0]
+            expert_weights[f"{prefix}.lora_b"] = weights[layer, 1].T.contiguous()
+        library.add_expert(
+            Expert(
+                expert_info=ExpertInfo(f"expert_{i}", expert_config=config),
+                expert_weights=expert_weights,
+            )
+        )
+
+    for i in range(10):
+        add_expert(i)
+
+    def similarities(embeddings):
+        embeddings = np.stack([embeddings[name] for name in sorted(embeddings)])
+        return embeddings @ embeddings.T
+
+    sklearn_embeddings = SVDEmbeddingTransform(
+        SVDEmbeddingTransformConfig(n_components=2, streaming=False), random_state=0
+    ).transform(library, persist=False)
+    transform = SVDEmbeddingTransform(
+        SVDEmbeddingTransformConfig(n_components=2, block_size=3)
+    )
+    embeddings = transform.transform(library)
+    assert transform.fit_stats["new_experts"] == 10
+    assert embeddings["expert_0"].shape == (2,)
+    # the same up to the sign of each component
+    assert np.allclose(
+        similarities(embeddings), similarities(sklearn_embeddings), atol=1e-3
+    )
+
+    # only the new experts are paired with the library
+    add_expert(10)
+    add_expert(11)
+    transform = SVDEmbeddingTransform(
+        SVDEmbeddingTransformConfig(n_components=2, block_size=3)
+    )
+    embeddings = transform.transform(library)
+    assert transform.fit_stats["new_experts"] == 2
+    assert transform.fit_stats["expert_loads"] == 12
+
+    refit = SVDEmbeddingTransform(SVDEmbeddingTransformConfig(n_components=2))
+    refit_embeddings = refit.transform(library, persist=False, recompute=True)
+    assert refit.fit_stats["new_experts"] == 12
+    for name, embedding in refit_embeddings.items():
+        assert np.allclose(embeddings[name], embedding, atol=1e-5)
+
+
 def test_mbc_clustering(tmp_path):
     library = HFExpertLibrary("sordonia/new-test-library")
     k = 2
@@ -447,5 +705,128 @@ def test_ties_merge():
         assert torch.allclose(expected_param, value)
 
 
+@pytest.mark.parametrize("only_sparsify", [False, True])
+def test_streaming_ties_merge(tmp_path, only_sparsify):
+    from mttl.models.library.expert import Expert, ExpertInfo
+    from mttl.models.modifiers.lora import LoRAConfig
+
+    vector = torch.randn(1001)
+    for q in [0.0, 0.37, 0.8, 1.0]:
+        assert torch.equal(abs_quantile(vector, q), vector.abs().quantile(q))
+
+    seed_everything(0)
+    library = LocalExpertLibrary(str(tmp_path), create=True)
+    config = LoRAConfig(modify_layers="k_proj|v_proj", lora_rank=4)
+    for i in range(6):
+        # enough weights for the fraction over the threshold to be top_k
+        weights = {}
+        for layer in range(3):
+            for proj in ["k_proj", "v_proj"]:
+                prefix = f"model.layers.{layer}.self_attn.{proj}"
+                weights[f"{prefix}.lora_a"] = torch.randn(256, 4)
+                weights[f"{prefix}.lora_b"] = torch.randn(4, 256)
+        # ties with other experts, on both sides of the threshold
+        weights["model.layers.0.self_attn.k_proj.lora_a"][0] = 0.5
+        library.add_expert(
+            Expert(
+                expert_info=ExpertInfo(f"expert_{i}", expert_config=config),
+                expert_weights=weights,
+            )
+        )
+
+    in_memory = TiesMerge(
+        TiesMergeConfig(top_k=0.2, only_sparsify=only_sparsify, streaming=False)
+    ).transform(library)
+    streamed = TiesMerge(
+        TiesMergeConfig(top_k=0.2, only_sparsify=only_sparsify, max_concurrency=2)
+    ).transform(library)
+
+    assert streamed.name == in_memory.name == "ties_weighted_expert"
+    assert set(streamed.expert_weights) == set(in_memory.expert_weights)
+    for name, value in in_memory.expert_weights.items():
+        assert value.abs().sum() > 0
+        assert torch.allclose(streamed.expert_weights[name], value, atol=1e-6)
+
+
+def test_incremental_arrow(tmp_path, monkeypatch):
+    from mttl.models.library.expert import Expert, ExpertInfo
+    from mttl.models.modifiers.lora import LoRAConfig
+
+    seed_everything(0)
+    library = LocalExpertLibrary(str(tmp_path), create=True)
+    config = LoRAConfig(modify_layers="k_proj|fc1", lora_rank=4)
+
+    def add_expert(name):
+        weights = {}
+        for layer in range(3):
+            # two shapes of layers, decomposed in two batches
+            for proj, (d_in, d_out) in [
+                ("attn.k_proj", (64, 32)),
+                ("mlp.fc1", (96, 64)),
+            ]:
+                weights[f"model.layers.{layer}.{proj}.lora_a"] = torch.randn(d_in, 4)
+                weights[f"model.layers.{layer}.{proj}.lora_b"] = torch.randn(4, d_out)
+        library.add_expert(
+            Expert(
+                expert_info=ExpertInfo(
+                    name, expert_config=config, expert_model="tiny-model"
+                ),
+                expert_weights=weights,
+            )
+        )
+
+    for i in range(3):
+        add_expert(f"expert_{i}")
+
+    loaded = []
+    prefetch = library.prefetch
+
+    def recording_prefetch(expert_names, **kwargs):
+        loaded.extend(expert_names)
+        return prefetch(expert_names, **kwargs)
+
+    monkeypatch.setattr(library, "prefetch", recording_prefetch)
+
+    transform = ArrowTransform(ArrowConfig(ab_only=True, scale=False))
+    protos = transform.transform(library, persist=True)
+    assert sorted(loaded) == ["expert_0", "expert_1", "expert_2"]
+
+    # same prototypes as the SVD of each layer on its own
+    for name in ["expert_0", "expert_1", "expert_2"]:
+        weights = library[name].expert_weights
+        assert len(protos[name]) == 6
+        for parent, vector in protos[name].items():
+            A, B = weights[f"{parent}.lora_a"], weights[f"{parent}.lora_b"]
+            U_W, _, _ = transform._low_rank_svd(A, B)
+            assert torch.allclose(vector, U_W[:, 0], atol=1e-5)
+            # top right singular vector of W = (A @ B).T
+            Vt = torch.linalg.svd((A @ B).T)[2]
+            assert torch.allclose(vector.abs(), Vt[0].abs(), atol=1e-4)
+
+    # only the new expert is loaded
+    loaded.clear()
+    add_expert("expert_3")
+    new_protos = transform.transform(library, persist=True)
+    assert loaded == ["expert_3"]
+    assert set(new_protos) == {"expert_0", "expert_1", "expert_2", "expert_3"}
+    for name in protos:
+        for parent, vector in protos[name].items():
+            assert torch.equal(new_protos[name][parent], vector)
+
+    # the base model prototypes are shared by the transforms
+    monkeypatch.setattr(ArrowTransform, "_base_protos", {})
+    base_model = torch.nn.Linear(16, 8)
+    vectors, eigvals = transform._compute_base_proto(library, base_model=base_model)
+    assert set(vectors) == {"weight"}
+
+    other = ArrowTransform(ArrowConfig(ab_only=True, scale=True))
+    assert other._compute_base_proto(library)[0] is vectors
+
+    # and persisted in the library
+    monkeypatch.setattr(ArrowTransform, "_base_protos", {})
+    persisted, _ = other._compute_base_proto(library)
+    assert np.allclose(persisted["weight"], vectors["weight"])
+
+
 if __name__ == "__main__":
     pytest.main([__file__])
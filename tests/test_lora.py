@@ -256,3 +256,223 @@ def test_skilled_lora_view():
 
 if __name__ == "__main__":
     pytest.main([__file__])
+
+
+def test_grouped_lora_forward():
+    from mttl.models.modifiers.grouped_lora import (
+        grouped_lora_forward,
+        grouped_lora_forward_reference,
+    )
+
+    seed_everything(0)
+    lora_a = [torch.randn(8, 2, requires_grad=True) for _ in range(4)]
+    lora_b = [torch.randn(2, 6) for _ in range(4)]
+    scaling = [1.0, 0.5, 2.0, 0.25]
+    input = torch.randn(20, 8)
+    # expert 3 receives no token
+    indices = torch.randint(0, 3, (20,))
+    weights = torch.rand(20)
+
+    output = grouped_lora_forward(input, lora_a, lora_b, indices, scaling, weights)
+    reference = grouped_lora_forward_reference(
+        input, lora_a, lora_b, indices, scaling, weights
+    )
+    assert output.shape == (20, 6)
+    assert torch.allclose(output, reference, atol=1e-5)
+
+    # gradients flow to the weights of the experts without copies
+    output.sum().backward()
+    assert lora_a[0].grad is not None
+    assert lora_a[3].grad is None
+
+
+def test_lora_parallel_forward_groups_examples():
+    seed_everything(0)
+    layer = torch.nn.Linear(4, 3)
+    config = LoRAConfig(lora_rank=2, lora_alpha=2, lora_init_b_random=True)
+    l1, l2 = LoRA(config, layer), LoRA(config, layer)
+
+    input = torch.randn(4, 5, 4)
+    loras = [l1, l2, l1, l1]
+    output = LoRA.parallel_linear_forward(input, loras)
+
+    expected = torch.stack(
+        [lora(example.unsqueeze(0)).squeeze(0) for lora, example in zip(loras, input)]
+    )
+    assert torch.allclose(output, expected, atol=1e-6)
+
+
+def test_skilled_lora_add_skill_reserve():
+    seed_everything(0)
+    layer = torch.nn.Linear(4, 6)
+    config = SkilledLoRAConfig(n_skills=0, n_splits=1, lora_rank=2)
+    skilled_lora = SkilledLoRA(config, layer)
+
+    loras, storages = [], set()
+    for _ in range(9):
+        loras.append(LoRA(LoRAConfig(lora_rank=2, lora_init_b_random=True), layer))
+        skilled_lora.add_skill(loras[-1])
+        storages.add(skilled_lora.lora_a.data.untyped_storage().data_ptr())
+
+    # capacity doubles, the weights are not copied for each new skill
+    assert len(storages) < 9
+    assert skilled_lora.n_skills == 9
+    assert skilled_lora.lora_a.shape == (9, 1, 4, 2)
+    assert skilled_lora.lora_b.shape == (9, 2, 1, 6)
+    for i, lora in enumerate(loras):
+        weights = skilled_lora.get_skill_weights(i)
+        assert torch.equal(weights["lora_a"].view(4, 2), lora.lora_a.data)
+        assert torch.equal(weights["lora_b"].view(2, 6), lora.lora_b.data)
+
+    # with a reservation, adding skills never reallocates
+    skilled_lora.reserve(20)
+    data_ptr = skilled_lora.lora_a.data_ptr()
+    for _ in range(11):
+        skilled_lora.add_skill(loras[0])
+    assert skilled_lora.lora_a.data_ptr() == data_ptr
+    assert skilled_lora.lora_a.shape[0] == 20
+    assert torch.equal(skilled_lora.lora_a[19], skilled_lora.lora_a[0])
+
+
+def test_lora_container_caches_skilled_lora_stack():
+    from mttl.models.containers.lora_containers import LoRAExpertContainer
+    from mttl.models.containers.selectors.selector_output import (
+        BatchSequenceExpertsAndWeightsSelectorOutput,
+        SelectorOutput,
+    )
+    from mttl.models.library.expert import Expert, ExpertInfo
+
+    seed_everything(0)
+    config = LoRAConfig(lora_rank=2, lora_init_b_random=True)
+    container = LoRAExpertContainer(config, torch.nn.Linear(4, 3))
+    container.__layer_name__ = "layer"
+    for name in ["a", "b", "c"]:
+        container.add_expert(Expert(expert_info=ExpertInfo(name, expert_config=config)))
+
+    input = torch.randn(2, 5, 4)
+
+    def route():
+        weights = torch.softmax(torch.randn(2, 5, len(container)), dim=-1)
+        selection = BatchSequenceExpertsAndWeightsSelectorOutput(
+            experts=SelectorOutput.ALL_EXPERTS, weights=weights
+        )
+        return container.route(input, selection), weights
+
+    def expected(weights):
+        # the weights of the experts are averaged per token
+        loras = [container[n] for n in container.expert_names]
+        A = torch.einsum(
+            "ble,edr->bldr", weights, torch.stack([l.lora_a for l in loras])
+        )
+        B = torch.einsum(
+            "ble,erd->blrd", weights, torch.stack([l.lora_b for l in loras])
+        )
+        adapter_out = torch.einsum("bld,bldr,blro->blo", input, A, B)
+        return (
+            container.layer(input) + adapter_out * config.lora_alpha / config.lora_rank
+        )
+
+    with torch.no_grad():
+        output, weights = route()
+        stack = container._get_skilled_lora(range(len(container)))
+        assert torch.allclose(output, expected(weights), atol=1e-5)
+
+        # reused across calls
+        route()
+        assert container._get_skilled_lora(range(len(container))) is stack
+
+        # rebuilt when the weights of an expert change in place
+        container["b"].lora_a.add_(1.0)
+        output, weights = route()
+        assert container._get_skilled_lora(range(len(container))) is not stack
+        assert torch.allclose(output, expected(weights), atol=1e-5)
+
+    # rebuilt when experts are added
+    container.add_expert(Expert(expert_info=ExpertInfo("d", expert_config=config)))
+    with torch.no_grad():
+        output, weights = route()
+    assert weights.shape[-1] == 4
+    assert torch.allclose(output, expected(weights), atol=1e-5)
+
+    # in training, gradients reach the experts
+    output, _ = route()
+    output.sum().backward()
+    assert container["a"].lora_a.grad is not None
+
+
+@pytest.mark.parametrize("merge_after", [False, True])
+@pytest.mark.parametrize("coalesced", [False, True])
+@pytest.mark.parametrize("per_token", [False, True])
+def test_lora_container_sparse_topk(monkeypatch, merge_after, coalesced, per_token):
+    from mttl.models.containers.lora_containers import (
+        CoalescedLoRAExpertContainer,
+        LoRAExpertContainer,
+    )
+    from mttl.models.containers.selectors.selector_output import (
+        BatchExpertsAndWeightsSelectorOutput,
+        BatchSequenceExpertsAndWeightsSelectorOutput,
+    )
+    from mttl.models.library.expert import Expert, ExpertInfo
+    from mttl.models.modifiers import grouped_lora
+
+    seed_everything(0)
+    config = LoRAConfig(lora_rank=2, lora_init_b_random=True)
+    container_cls = CoalescedLoRAExpertContainer if coalesced else LoRAExpertContainer
+    container = container_cls(
+        config, torch.nn.Linear(4, 3), lora_merge_after=merge_after
+    )
+    container.__layer_name__ = "layer"
+    for name in ["a", "b", "c", "d", "e"]:
+        expert = Expert(expert_info=ExpertInfo(name, expert_config=config))
+        container.add_expert(expert, is_default=name == "a")
+
+    input = torch.randn(2, 5, 4)
+    if per_token:
+        scores = torch.randn(2, 5, len(container))
+        selection_cls = BatchSequenceExpertsAndWeightsSelectorOutput
+    else:
+        scores = torch.randn(2, len(container))
+        selection_cls = BatchExpertsAndWeightsSelectorOutput
+    weights, experts = torch.topk(torch.softmax(scores, dim=-1), k=2, dim=-1)
+
+    def route():
+        return container.route(input, selection_cls(experts=experts, weights=weights))
+
+    with torch.no_grad():
+        sparse_output = route()
+        # top-2 out of 5 experts runs sparsely, force the dense mixing of the weights
+        monkeypatch.setattr(grouped_lora, "SPARSE_TOPK_MAX_RATIO", 0.0)
+        dense_output = route()
+
+    assert sparse_output.shape == dense_output.shape == (2, 5, 3)
+    assert torch.allclose(sparse_output, dense_output, atol=1e-5)
+
+
+def test_sparse_topk_lora_forward():
+    from mttl.models.modifiers.grouped_lora import (
+        grouped_lora_forward_reference,
+        sparse_topk_lora_forward,
+    )
+
+    seed_everything(0)
+    lora_a = torch.randn(6, 8, 2)
+    lora_b = torch.randn(6, 2, 4)
+    input = torch.randn(20, 8)
+    weights, indices = torch.topk(torch.rand(20, 6), k=3, dim=-1)
+
+    output = sparse_topk_lora_forward(
+        input, lora_a, lora_b, indices, weights, 0.5, merge_after=True
+    )
+    expected = grouped_lora_forward_reference(
+        input, lora_a, lora_b, indices, [0.5] * 6, weights
+    )
+    assert torch.allclose(output, expected, atol=1e-5)
+
+    # the weights of the selected experts are mixed before the low-rank product
+    output = sparse_topk_lora_forward(
+        input, lora_a, lora_b, indices, weights, 0.5, merge_after=False
+    )
+    A = torch.einsum("tk,tkdr->tdr", weights, lora_a[indices])
+    B = torch.einsum("tk,tkro->tro", weights, lora_b[indices])
+    expected = torch.einsum("td,tdr,tro->to", input, A, B) * 0.5
+    assert torch.allclose(output, expected, atol=1e-5)
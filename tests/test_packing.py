@@ -1,3 +1,5 @@
+import numpy as np
+import pytest
 import torch
 from transformers import AutoModelForCausalLM
 
@@ -122,3 +124,130 @@ def test_packing_and_attn(tiny_flan_id):
 
     # TEST 3 : Without monkey patching, packed sequences should give different results than without packing
     assert not torch.allclose(reg_out, rm_packed_out, atol=1)
+
+
+def _loop_packed_attn_mask(seq_lens, seq_len):
+    # mask built by the collator before the block-diagonal attention
+    bs = len(seq_lens)
+    mask = torch.zeros(bs, 1, seq_len, seq_len, dtype=torch.bool)
+    for i in range(bs):
+        start_idx = 0
+        for length in seq_lens[i]:
+            mask[
+                i, :, start_idx : start_idx + length, start_idx : start_idx + length
+            ] = True
+            start_idx += length
+        mask[i, :, start_idx:, :start_idx] = True
+    return mask.tril()
+
+
+def test_packed_sdpa_matches_dense_mask():
+    from mttl.models.packed_attention_monkey_patch import (
+        packed_attention_mask,
+        packed_scaled_dot_product_attention,
+    )
+
+    torch.manual_seed(0)
+    # the second row ends with padding tokens
+    seq_lens = torch.tensor([[5, 3, 8, 0], [2, 7, 1, 3]])
+    bs, heads, seq_len, head_dim = 2, 3, 16, 8
+
+    dense_mask = packed_attention_mask(seq_lens, seq_len)
+    assert (dense_mask == _loop_packed_attn_mask(seq_lens.tolist(), seq_len)).all()
+
+    query, key, value = (
+        torch.randn(bs, heads, seq_len, head_dim, requires_grad=True) for _ in range(3)
+    )
+    routing_infos = RoutingInfo(
+        seq_lens=seq_lens,
+        packed_seq_lens=torch.nn.functional.pad(seq_lens.flatten().cumsum(0), (1, 0)),
+    )
+    with InfoContainer(None, routing_infos):
+        # goes through the patched sdpa
+        packed = torch.nn.functional.scaled_dot_product_attention(query, key, value)
+    assert routing_infos.packed_segments() == [
+        [(0, 5), (5, 8), (8, 16)],
+        [(0, 2), (2, 9), (9, 10), (10, 13)],
+    ]
+
+    dense = torch.nn.functional._default_scaled_dot_product_attention(
+        query, key, value, attn_mask=dense_mask
+    )
+    assert torch.allclose(packed, dense, atol=1e-6)
+
+    packed_grads = torch.autograd.grad(packed.sum(), (query, key, value))
+    dense_grads = torch.autograd.grad(dense.sum(), (query, key, value))
+    for packed_grad, dense_grad in zip(packed_grads, dense_grads):
+        assert torch.allclose(packed_grad, dense_grad, atol=1e-5)
+
+    direct = packed_scaled_dot_product_attention(
+        query, key, value, routing_infos.packed_segments()
+    )
+    assert torch.allclose(direct, dense, atol=1e-6)
+
+
+@pytest.mark.parametrize(
+    "strategy", ["greedy", "first_fit_decreasing", "best_fit", "shuffled_window"]
+)
+def test_packing_strategies(strategy):
+    from mttl.datamodule.packing import PackingStrategy, packing_efficiency
+
+    rng = np.random.default_rng(0)
+    # skewed lengths, some longer than the packs
+    lengths = np.minimum(rng.lognormal(4, 1, size=2000).astype(int) + 1, 600).tolist()
+    packer = PackingStrategy.from_name(
+        strategy, max_length=512, max_sequences=4, seed=1
+    )
+    packs = packer.pack(lengths)
+
+    assert sorted(i for pack in packs for i in pack) == list(range(len(lengths)))
+    for pack in packs:
+        assert len(pack) <= 4
+        assert len(pack) == 1 or sum(lengths[i] for i in pack) <= 512
+    # deterministic under a fixed seed
+    assert packer.pack(lengths) == packs
+
+    # more slots than needed, the packs are bound by their length
+    packs = PackingStrategy.from_name(strategy, max_length=512, max_sequences=16).pack(
+        lengths
+    )
+    greedy = PackingStrategy.from_name("greedy", max_length=512, max_sequences=16).pack(
+        lengths
+    )
+    stats = packing_efficiency(packs, lengths, 512)
+    assert stats["sequences"] == len(lengths)
+    assert (
+        stats["padding_fraction"]
+        <= packing_efficiency(greedy, lengths, 512)["padding_fraction"]
+    )
+
+
+def test_pack_sequences_with_strategy():
+    from types import SimpleNamespace
+
+    from datasets import Dataset
+
+    from mttl.datamodule.base import DataModule, DatasetConfig
+
+    dataset = Dataset.from_dict(
+        {
+            "input_ids": [[i] * length for i, length in enumerate([6, 3, 5, 2, 9])],
+            "task_names": ["a", "b", "c", "d", "e"],
+        }
+    )
+    dm = SimpleNamespace(
+        config=DatasetConfig(
+            max_input_length=8, packing_strategy="best_fit", num_proc=1
+        )
+    )
+    packed = DataModule.pack_sequences(dm, dataset, max_sequences=4, shuffle=False)
+
+    # best fit decreasing: [9 -> 8], [6, 2], [5, 3]
+    assert packed["seq_lens"] == [[8], [6, 2], [5, 3]]
+    assert packed["input_ids"][1] == [0] * 6 + [3] * 2
+    assert packed["task_names"][2] == ["c", "b"]
+    assert dm.packing_stats["packs"] == 3
+    assert dm.packing_stats["padding_fraction"] == 0.0
+
+    with pytest.raises(ValueError):
+        DataModule.pack_sequences(dm, dataset, shuffle=False, strategy="unknown")
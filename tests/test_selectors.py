@@ -18,3 +18,157 @@ def test_load_selectors_from_config():
     config = TaskNameSelectorConfig()
     selector = get_selector(config)
     assert type(selector) == TaskNameSelector
+
+
+def test_per_token_selector_telemetry():
+    import torch
+
+    from mttl.models.containers.selectors.arrow_selector import ArrowSelectorConfig
+    from mttl.models.containers.selectors.base import get_selector
+    from mttl.models.expert_context import InfoContainer
+    from mttl.models.modifiers.routing import RoutingInfo
+    from mttl.models.utils import MetricLogger
+
+    torch.manual_seed(0)
+    selector = get_selector(ArrowSelectorConfig(), layer=torch.nn.Linear(8, 4))
+    selector.__layer_name__ = "layer"
+    selector.total_calls_per_forward = 1
+    for name in ["a", "b", "c"]:
+        selector.add_expert(name)
+    selector.overwrite_prototypes(torch.randn(3, 8))
+    selector.metric_logger = MetricLogger(sample_rate=0.5)
+
+    input = torch.randn(2, 5, 8)
+    attention_mask = torch.ones(2, 5)
+    attention_mask[1, 3:] = 0
+    routing_infos = RoutingInfo(attention_mask=attention_mask, task_names=["a", "b"])
+
+    with InfoContainer(None, routing_infos):
+        for _ in range(4):
+            selector(input)
+
+    # one forward out of two is logged, the statistics are kept as tensors
+    meter = selector.metric_logger.meters["layer/ent_routing"]
+    assert meter.count == 2
+    assert all(isinstance(value, torch.Tensor) for value in meter.deque)
+
+    # same as averaging over the tokens of the attention mask
+    logits = torch.nn.functional.linear(input, selector.prototypes).abs()
+    entropy = torch.distributions.Categorical(logits=logits).entropy()
+    assert meter.avg == pytest.approx(entropy[attention_mask == 1].mean().item())
+    assert meter.percentile(50) == pytest.approx(meter.median)
+    counts, edges = meter.histogram(bins=4)
+    assert counts.sum() == 2 and len(edges) == 5
+
+    expert_p = selector.metric_logger.meters["layer/expert_p"]
+    probs = torch.softmax(logits, dim=-1)
+    expected = torch.cat([probs[0, :, 0], probs[1, :3, 1]]).mean().item()
+    assert expert_p.avg == pytest.approx(expected)
+
+    # nothing is computed when disabled
+    selector.metric_logger = MetricLogger(enabled=False)
+    with InfoContainer(None, routing_infos):
+        selector(input)
+    assert len(selector.metric_logger) == 0
+
+
+def test_routing_cache_is_private_to_each_request():
+    import threading
+
+    import torch
+
+    from mttl.models.containers.selectors.arrow_selector import ArrowSelectorConfig
+    from mttl.models.containers.selectors.base import get_selector
+    from mttl.models.expert_context import InfoContainer
+    from mttl.models.modifiers.routing import RoutingInfo
+
+    torch.manual_seed(0)
+    selector = get_selector(
+        ArrowSelectorConfig(selector_logging=False), layer=torch.nn.Linear(8, 4)
+    )
+    selector.__layer_name__ = "layer"
+    for name in ["a", "b", "c"]:
+        selector.add_expert(name)
+    selector.overwrite_prototypes(torch.randn(3, 8))
+    # the selector is shared by two layers
+    view = selector.create_view()
+    selector.total_calls_per_forward = 2
+
+    n_steps = 3
+    barrier = threading.Barrier(2)
+    inputs = {stream: torch.randn(n_steps, 1, 2, 8) for stream in range(2)}
+    outputs, stats = {}, {}
+
+    def run_stream(stream):
+        routing_infos = RoutingInfo(attention_mask=torch.ones(1, 2), task_names=["a"])
+        with InfoContainer(None, routing_infos) as context:
+            for step in range(n_steps):
+                first = selector(inputs[stream][step])
+                # the other stream computes its routing in the meantime
+                barrier.wait()
+                second = view(torch.zeros(1, 2, 8))
+                barrier.wait()
+                outputs[stream, step] = (first, second)
+            stats[stream] = context.routing_cache.stats()
+
+    threads = [threading.Thread(target=run_stream, args=(i,)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for (stream, step), (first, second) in outputs.items():
+        # the second layer reuses the routing of the first layer of the same request
+        assert second is first
+        logits = torch.nn.functional.linear(inputs[stream][step], selector.prototypes)
+        assert torch.allclose(first.weights, torch.softmax(logits.abs(), dim=-1))
+
+    for stream in range(2):
+        assert stats[stream]["hits"] == stats[stream]["misses"] == n_steps
+        # only the routing of the current forward pass is kept
+        assert stats[stream]["entries"] == 1
+
+    # outside of a request, the routing is computed at every call
+    assert selector(inputs[0][0]) is not view(inputs[0][0])
+
+
+def test_artifacts_cache():
+    import threading
+    import time
+
+    import torch
+
+    from mttl.models.containers.selectors.base import ArtifactsCache
+
+    cache = ArtifactsCache(max_bytes=2 * 4 * 100)
+    loads = []
+
+    def load(key):
+        loads.append(key)
+        time.sleep(0.05)
+        return {"proto": torch.zeros(100)}
+
+    # concurrent requests of the same artifacts load them once
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(cache.get_or_load("a", lambda: load("a")))
+        )
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert loads == ["a"]
+    assert all(result is results[0] for result in results)
+    assert cache.stats()["misses"] == 1 and cache.stats()["hits"] == 3
+
+    # least recently used artifacts are evicted beyond the byte budget
+    cache.get_or_load("b", lambda: load("b"))
+    cache.get_or_load("a", lambda: load("a"))
+    cache.get_or_load("c", lambda: load("c"))
+    assert loads == ["a", "b", "c"]
+    assert cache.stats()["evictions"] == 1
+    cache.get_or_load("b", lambda: load("b"))
+    assert loads == ["a", "b", "c", "b"]